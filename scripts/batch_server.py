@@ -0,0 +1,19 @@
+"""Serve batches to trainers on this machine; see slippi_ai/batch_server.py."""
+
+from absl import app
+import fancyflags as ff
+
+from slippi_ai import batch_server, flag_utils
+
+CONFIG = ff.DEFINE_dict(
+    'config', **flag_utils.get_flags_from_dataclass(batch_server.ServerConfig))
+
+def main(_):
+  config = flag_utils.dataclass_from_dict(
+      batch_server.ServerConfig, CONFIG.value)
+  batch_server.serve(config)
+
+if __name__ == '__main__':
+  # https://github.com/python/cpython/issues/87115
+  __spec__ = None
+  app.run(main)
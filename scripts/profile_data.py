@@ -1,34 +1,261 @@
+"""Benchmarks data loading throughput.
+
+Sweeps data settings on a (by default synthetic) dataset and writes the
+results as JSON, so that runs can be compared across commits:
+
+python scripts/profile_data.py --root=/tmp/synthetic --synthetic_games=200 \
+  --compression=zlib,zstd_dict --num_workers=0,2 --cache=none,preload \
+  --output=data_benchmark.json
+
+With --synthetic_games, a dataset is generated (once) for each compression
+under root/<compression>; otherwise --root should hold an existing
+Parsed/ and meta.json, or --data_dir and --meta_path can be given.
+
+Each configuration reports batches and frames per second, the RSS of the
+main and worker processes, and for multiprocess sources the IPC time: the
+time to receive a batch that the workers have already produced.
+"""
+
+import dataclasses
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import tempfile
 import time
+from typing import Optional
+
 from absl import app, flags
+import numpy as np
 
-from slippi_ai import data, embed
+from slippi_ai import data, storage
+from slippi_db import parsing_utils, synthetic
 
-DATA_DIR = flags.DEFINE_string('data_dir', None, 'path to data directory')
+ROOT = flags.DEFINE_string('root', None, 'Dataset root.')
+DATA_DIR = flags.DEFINE_string('data_dir', None, 'Defaults to root/Parsed.')
+META_PATH = flags.DEFINE_string('meta_path', None, 'Defaults to root/meta.json.')
 
-BATCH_SIZE = flags.DEFINE_integer('batch_size', 32, 'batch size')
-UNROLL_LENGTH = flags.DEFINE_integer('unroll_length', 32, 'unroll length')
-RUNTIME = flags.DEFINE_integer('runtime', 15, 'runtime in seconds')
+SYNTHETIC_GAMES = flags.DEFINE_integer(
+    'synthetic_games', 0, 'Generate a synthetic dataset with this many games.')
+SYNTHETIC_FRAMES = flags.DEFINE_integer(
+    'synthetic_frames', 8000, 'Mean length of the synthetic games.')
+STORAGE_PROFILE = flags.DEFINE_enum_class(
+    'storage_profile', storage.StorageProfile.DEFAULT, storage.StorageProfile,
+    'Storage profile of the synthetic games.')
 
-def main(_):
-  dataset_config = data.DatasetConfig(data_dir=DATA_DIR.value)
-  train, _ = data.train_test_split(dataset_config)
+COMPRESSION = flags.DEFINE_list(
+    'compression', ['zlib'],
+    'Compression types to sweep (synthetic datasets only); see '
+    'parsing_utils.CompressionType.')
+NUM_WORKERS = flags.DEFINE_list('num_workers', ['0'], 'Worker counts.')
+BATCH_SIZE = flags.DEFINE_list('batch_size', ['32'], 'Batch sizes.')
+UNROLL_LENGTH = flags.DEFINE_list('unroll_length', ['64'], 'Unroll lengths.')
+CACHE = flags.DEFINE_list(
+    'cache', ['none'], 'Cache settings: none, memory, disk or preload.')
+SHARED_MEMORY = flags.DEFINE_bool('shared_memory', False, 'See DataConfig.')
+READ_AHEAD = flags.DEFINE_integer('read_ahead', 0, 'See DataConfig.')
+
+RUNTIME = flags.DEFINE_float('runtime', 15, 'Seconds to run each config.')
+WARMUP = flags.DEFINE_integer('warmup', 5, 'Batches to skip per config.')
+SETTLE = flags.DEFINE_float(
+    'settle', 2, 'Seconds to let workers fill their buffers before timing IPC.')
+OUTPUT = flags.DEFINE_string('output', None, 'Where to write the JSON results.')
+
+CACHES = {
+    'none': {},
+    'memory': dict(cache_size_gb=4),
+    'disk': dict(disk_cache_size_gb=16),  # disk_cache_dir is set per config
+    'preload': dict(preload=True),
+}
+
+@dataclasses.dataclass
+class Dataset:
+  compression: str
+  data_dir: str
+  meta_path: str
+  compressed: bool
+  zstd_dict_dir: Optional[str] = None
+
+def _rss_mb(pid: int) -> Optional[float]:
+  """Resident set size of a process, on Linux."""
+  try:
+    with open(f'/proc/{pid}/statm') as f:
+      resident_pages = int(f.read().split()[1])
+  except OSError:
+    return None
+  return resident_pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+def _git_commit() -> Optional[str]:
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
 
-  data_config = data.CONFIG.copy()
-  data_config.update(
-      batch_size=BATCH_SIZE.value,
-      unroll_length=UNROLL_LENGTH.value,
+def _datasets() -> list[Dataset]:
+  if not SYNTHETIC_GAMES.value:
+    root = ROOT.value
+    data_dir = DATA_DIR.value or os.path.join(root, 'Parsed')
+    meta_path = META_PATH.value or os.path.join(root, 'meta.json')
+    with open(meta_path) as f:
+      compression = json.load(f)[0].get('compression', 'zlib')
+    zstd_dict_dir = os.path.join(root, 'ZstdDicts') if root else None
+    if zstd_dict_dir and not os.path.isdir(zstd_dict_dir):
+      zstd_dict_dir = None
+    return [Dataset(
+        compression=compression,
+        data_dir=data_dir,
+        meta_path=meta_path,
+        compressed=parsing_utils.CompressionType(compression).is_whole_file(),
+        zstd_dict_dir=zstd_dict_dir,
+    )]
+
+  datasets = []
+  for compression in COMPRESSION.value:
+    compression_type = parsing_utils.CompressionType(compression)
+    root = os.path.join(ROOT.value, compression)
+    zstd_dict_dir = os.path.join(root, 'ZstdDicts')
+    meta_path = os.path.join(root, 'meta.json')
+    if not os.path.exists(meta_path):
+      print(f'Generating {SYNTHETIC_GAMES.value} games in {root}.')
+      synthetic.make_dataset(
+          root,
+          num_games=SYNTHETIC_GAMES.value,
+          num_frames=SYNTHETIC_FRAMES.value,
+          compression_type=compression_type,
+          profile=STORAGE_PROFILE.value,
+          zstd_dict_dir=zstd_dict_dir,
+      )
+    datasets.append(Dataset(
+        compression=compression,
+        data_dir=os.path.join(root, 'Parsed'),
+        meta_path=meta_path,
+        compressed=compression_type.is_whole_file(),
+        zstd_dict_dir=(
+            zstd_dict_dir if os.path.isdir(zstd_dict_dir) else None),
+    ))
+  return datasets
+
+def _stop(source):
+  for worker in getattr(source, 'sources', []):
+    worker.process.terminate()
+    worker.process.join()
+  ring = getattr(source, 'ring', None)
+  if ring is not None:
+    ring.unlink()
+  arena = getattr(source, 'arena', None)
+  if arena is not None:
+    arena.unlink()
+
+def benchmark(
+    dataset: Dataset,
+    num_workers: int,
+    batch_size: int,
+    unroll_length: int,
+    cache: str,
+) -> dict:
+  replays = data.replays_from_meta(data.DatasetConfig(
+      data_dir=dataset.data_dir, meta_path=dataset.meta_path))
+
+  cache_dir = None
+  source_kwargs = dict(CACHES[cache])
+  if cache == 'disk':
+    cache_dir = tempfile.mkdtemp()
+    source_kwargs.update(disk_cache_dir=cache_dir)
+  if num_workers == 0:
+    # Each batch is dropped before the next, so buffers can be reused.
+    source_kwargs.update(num_buffers=2)
+
+  source = data.make_source(
+      replays=replays,
+      num_workers=num_workers,
+      shared_memory=SHARED_MEMORY.value,
+      batch_size=batch_size,
+      unroll_length=unroll_length,
+      compressed=dataset.compressed,
+      zstd_dict_dir=dataset.zstd_dict_dir,
+      read_ahead=READ_AHEAD.value,
+      **source_kwargs,
   )
-  del data_config['in_parallel']
 
-  source = data.DataSource(
-      train,
-      embed_controller=embed.get_controller_embedding(axis_spacing=16),
-      **data_config,
+  try:
+    for _ in range(WARMUP.value):
+      next(source)
+
+    num_batches = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < RUNTIME.value:
+      next(source)
+      num_batches += 1
+    elapsed = time.perf_counter() - start
+
+    workers = getattr(source, 'sources', [])
+    worker_pids = [worker.process.pid for worker in workers]
+
+    # Receiving batches that are already waiting only costs the IPC.
+    ipc_time = None
+    if worker_pids:
+      time.sleep(SETTLE.value)
+      ipc_times = []
+      for _ in range(2):
+        ipc_start = time.perf_counter()
+        next(source)
+        ipc_times.append(time.perf_counter() - ipc_start)
+      ipc_time = float(np.mean(ipc_times))
+
+    batches_per_sec = num_batches / elapsed
+    return dict(
+        compression=dataset.compression,
+        num_workers=num_workers,
+        batch_size=batch_size,
+        unroll_length=unroll_length,
+        cache=cache,
+        num_batches=num_batches,
+        batches_per_sec=batches_per_sec,
+        frames_per_sec=batches_per_sec * batch_size * unroll_length,
+        ipc_time=ipc_time,
+        main_rss_mb=_rss_mb(os.getpid()),
+        worker_rss_mb=[_rss_mb(pid) for pid in worker_pids],
+        hit_rates=data.cache_hit_rates(source.get_stats()),
+    )
+  finally:
+    _stop(source)
+    if cache_dir is not None:
+      shutil.rmtree(cache_dir)
+
+def main(_):
+  results = []
+  sweep = itertools.product(
+      _datasets(),
+      map(int, NUM_WORKERS.value),
+      map(int, BATCH_SIZE.value),
+      map(int, UNROLL_LENGTH.value),
+      CACHE.value,
   )
+  for dataset, num_workers, batch_size, unroll_length, cache in sweep:
+    result = benchmark(dataset, num_workers, batch_size, unroll_length, cache)
+    print(json.dumps(result))
+    results.append(result)
 
-  start = time.perf_counter()
-  while time.perf_counter() - start < RUNTIME.value:
-    next(source)
+  if OUTPUT.value:
+    settings = dict(
+        runtime=RUNTIME.value,
+        warmup=WARMUP.value,
+        shared_memory=SHARED_MEMORY.value,
+        read_ahead=READ_AHEAD.value,
+        synthetic_games=SYNTHETIC_GAMES.value,
+        synthetic_frames=SYNTHETIC_FRAMES.value,
+        storage_profile=STORAGE_PROFILE.value.value,
+    )
+    with open(OUTPUT.value, 'w') as f:
+      json.dump(dict(
+          commit=_git_commit(),
+          time=time.time(),
+          settings=settings,
+          results=results,
+      ), f, indent=2)
 
 if __name__ == '__main__':
   app.run(main)
@@ -0,0 +1,308 @@
+"""A local server that decodes games once for several trainers.
+
+Each trainer process normally decodes the dataset with its own workers, so
+running a sweep on one machine multiplies the decoding work. Instead, a
+batch server owns the game reader and its caches (or a preloaded arena) for
+a dataset, and trainers get batches from it by setting data.batch_server:
+
+python scripts/batch_server.py --config.socket_dir=/tmp/slippi_ai_batches \
+  --config.dataset.data_dir=... --config.dataset.meta_path=... \
+  --config.preload=True
+
+The server listens on a Unix socket in socket_dir, which must be private to
+the user (mode 0700). Connections are authenticated with a key that the
+server generates at startup and writes next to the socket, readable only by
+the user; trainers give the same directory as data.batch_server.
+
+Trainers send their dataset config rather than their replays, and the
+server makes and caches the train/test split itself. Every trainer stream
+is a connection on the socket, whose DataSource (with the trainer's sampler,
+seed, batch size, column projection, ...) the server adds on demand to one
+SharedWorkerPool. The pool's worker processes decode the games of all
+streams, sharing a GameReader and its caches per column projection, and
+write batches into shared memory that the server owns; see BatchClient for
+the client side. The protocol is:
+
+  client: ('open', data_source_kwargs, prefetch)
+  server: (frames_spec, ring_name, num_slots, num_workers)
+  client: ('next', slot)  # any number ahead, up to num_slots - 1
+  server: [(count, meta, epoch, stats, cursor)]  # per worker, once per 'next'
+
+where data_source_kwargs also hold the dataset and the split. Errors are
+sent back as the exception.
+"""
+
+import atexit
+import dataclasses
+import itertools
+import multiprocessing as mp
+import os
+import secrets
+import signal
+import stat
+import sys
+import tempfile
+import threading
+from multiprocessing import connection as mp_connection
+from typing import Optional
+
+from absl import logging
+
+from slippi_ai import data, shm, utils, worker_pool
+
+_field = utils.field
+
+SOCKET_NAME = 'socket'
+AUTHKEY_NAME = 'authkey'
+
+def default_socket_dir() -> str:
+  return os.path.join(tempfile.gettempdir(), f'slippi_ai_batches_{os.getuid()}')
+
+def check_private_dir(path: str):
+  """Raises unless path is a directory that only this user can access."""
+  info = os.lstat(path)
+  if not stat.S_ISDIR(info.st_mode):
+    raise PermissionError(f'{path} is not a directory.')
+  if info.st_uid != os.getuid() or info.st_mode & 0o077:
+    raise PermissionError(
+        f'{path} must be owned by and only accessible to the current user.')
+
+def _write_private(path: str, contents: bytes):
+  tmp_path = path + '.tmp'
+  fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+  with os.fdopen(fd, 'wb') as f:
+    f.write(contents)
+  os.replace(tmp_path, path)
+
+@dataclasses.dataclass
+class ServerConfig:
+  # Holds the socket and authkey; created with mode 0700 if missing.
+  socket_dir: str = _field(default_socket_dir)
+  # Processes decoding the games of all streams. Trainers' batch sizes must
+  # be multiples of it.
+  num_workers: int = 4
+  # Only used to preload the games; trainers send their own datasets.
+  dataset: data.DatasetConfig = _field(data.DatasetConfig)
+  compressed: bool = True
+  zstd_dict_dir: Optional[str] = None
+  disk_cache_dir: Optional[str] = None
+  disk_cache_size_gb: float = 16
+  # Per-worker in-memory cache of each column projection's games.
+  cache_size_gb: float = 0
+  # Decode all games (with all columns) of the dataset up front into shared
+  # memory, which all workers read from.
+  preload: bool = False
+  read_threads: int = 4
+
+def reader_kwargs(config: ServerConfig) -> dict:
+  """Arguments of the workers' readers, see data.make_game_reader."""
+  arena = None
+  if config.preload:
+    replays = data.as_replay_table(data.load_replays(config.dataset))
+    arena = data.preload_games(
+        replays, config.compressed, num_threads=config.read_threads,
+        zstd_dict_dir=config.zstd_dict_dir)
+    atexit.register(arena.unlink)
+  return dict(
+      compressed=config.compressed,
+      disk_cache_dir=config.disk_cache_dir,
+      disk_cache_size_gb=config.disk_cache_size_gb,
+      cache_size_gb=config.cache_size_gb,
+      arena=arena,
+      zstd_dict_dir=config.zstd_dict_dir,
+  )
+
+class BatchServer:
+
+  def __init__(self, config: ServerConfig):
+    socket_dir = config.socket_dir
+    os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+    check_private_dir(socket_dir)
+
+    self.pool = worker_pool.SharedWorkerPool(
+        {}, config.num_workers, shared_memory=True,
+        reader_kwargs=reader_kwargs(config))
+    # The stream arguments that depend on how the server reads games.
+    self._source_kwargs = dict(
+        compressed=config.compressed,
+        cache_size_gb=config.cache_size_gb,
+        preload=False,
+    )
+    # Train/test splits by dataset and name map; views of one shared table.
+    self._splits: dict[tuple, dict[str, data.ReplayTable]] = {}
+    self._splits_lock = threading.Lock()
+    self._stream_ids = itertools.count()
+
+    self.address = os.path.join(socket_dir, SOCKET_NAME)
+    if os.path.exists(self.address):
+      # Left behind by a server that didn't shut down cleanly.
+      os.unlink(self.address)
+    authkey = secrets.token_bytes(32)
+    _write_private(os.path.join(socket_dir, AUTHKEY_NAME), authkey)
+    self.listener = mp_connection.Listener(
+        self.address, family='AF_UNIX', authkey=authkey)
+    self._closed = threading.Event()
+
+  def serve_forever(self):
+    logging.info('Serving batches on %s', self.address)
+    while not self._closed.is_set():
+      try:
+        conn = self.listener.accept()
+      except (mp.AuthenticationError, EOFError, ConnectionError) as e:
+        if self._closed.is_set():
+          break
+        logging.warning('Rejected a connection: %r', e)
+        continue
+      except OSError:
+        if self._closed.is_set():
+          break
+        raise
+      # Only relays requests and results; the pool's workers make batches.
+      threading.Thread(
+          target=self._serve, args=(conn,), name='BatchServer',
+          daemon=True).start()
+
+  def close(self):
+    """Stops serving and frees the shared memory of all streams."""
+    self._closed.set()
+    self.listener.close()
+    self.pool.close()
+
+  def split(
+      self,
+      dataset: data.DatasetConfig,
+      split: str,
+      name_map: Optional[dict[str, int]] = None,
+  ) -> data.ReplayTable:
+    """One split of the dataset, see data.train_test_split.
+
+    Splits are made once per dataset and name map, and shared by all
+    streams in shared memory.
+    """
+    if split not in ('train', 'test'):
+      raise ValueError(f'Unknown split {split}.')
+    name_map = name_map or {}
+    key = (repr(dataset), tuple(sorted(name_map.items())))
+    with self._splits_lock:
+      if key not in self._splits:
+        train, test = data.train_test_split(dataset)
+        # Encodes the names of both splits, which share their columns.
+        data.as_replay_table(train, name_map).share()
+        self._splits[key] = dict(train=train, test=test)
+      return self._splits[key][split]
+
+  def _serve(self, conn: mp_connection.Connection):
+    name: Optional[str] = None
+    try:
+      kind, kwargs, prefetch = conn.recv()
+      assert kind == 'open'
+      replays = self.split(
+          kwargs.pop('dataset'), kwargs.pop('split'), kwargs.get('name_map'))
+      name = f'stream_{next(self._stream_ids)}'
+      stream = self.pool.add_stream(
+          name, replays, prefetch=prefetch,
+          **dict(kwargs, **self._source_kwargs))
+      ring = stream.ring
+      conn.send((
+          ring.layout.spec, ring.name, ring.num_slots, self.pool.num_workers))
+
+      requested = 0
+      while True:
+        # Pass on every request as it comes, so that the workers can make
+        # batches ahead, and answer them in order.
+        while not requested or conn.poll():
+          kind, slot = conn.recv()
+          assert kind == 'next'
+          self.pool.request(name, slot)
+          requested += 1
+        conn.send(self.pool.receive(name))
+        requested -= 1
+    except (EOFError, ConnectionError):
+      pass  # The trainer is gone.
+    except Exception as e:
+      logging.exception('Stream failed.')
+      try:
+        conn.send(e)
+      except OSError:
+        pass
+    finally:
+      conn.close()
+      if name in self.pool.streams:
+        self.pool.remove_stream(name)
+
+def serve(config: ServerConfig):
+  # Shut down cleanly when killed, e.g. by a job scheduler, so that the
+  # shared memory is freed.
+  signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+  server = BatchServer(config)
+  try:
+    server.serve_forever()
+  finally:
+    server.close()
+
+class BatchClient:
+  """Gets batches from a BatchServer over a socket.
+
+  Each stream is a connection for which the server adds a stream to its
+  worker pool, with the given split of the dataset and DataSource arguments.
+  The workers write batches into a ring of shared memory that the server
+  owns; only slot numbers and chunk metadata go through the socket.
+  """
+
+  def __init__(self, socket_dir: str):
+    check_private_dir(socket_dir)
+    self.address = os.path.join(socket_dir, SOCKET_NAME)
+    with open(os.path.join(socket_dir, AUTHKEY_NAME), 'rb') as f:
+      self._authkey = f.read()
+    self._connections: dict[str, mp_connection.Connection] = {}
+
+  def open(
+      self,
+      name: str,
+      dataset: data.DatasetConfig,
+      split: str = 'train',
+      prefetch: int = 2,
+      cursor: Optional[dict] = None,
+      **kwargs,
+  ) -> worker_pool.PoolStream:
+    """Opens a stream; kwargs are passed to the server's DataSources.
+
+    Args:
+      dataset: The dataset to split, see data.train_test_split. It is read
+        by the server, so its paths must be valid there.
+      split: Either 'train' or 'test'.
+      prefetch: Batches to request ahead, as in SharedWorkerPool.
+      cursor: A stream cursor to resume from, see PoolStream.get_cursor.
+    """
+    if name in self._connections:
+      raise ValueError(f'Stream {name} is already open.')
+    conn = mp_connection.Client(
+        self.address, family='AF_UNIX', authkey=self._authkey)
+    conn.send((
+        'open', dict(kwargs, dataset=dataset, split=split, cursor=cursor),
+        prefetch))
+    spec, ring_name, num_slots, num_workers = self._recv(conn)
+    self._connections[name] = conn
+
+    ring = shm.SharedRing.attach(shm.NestLayout(spec), num_slots, ring_name)
+    worker_cursors = cursor['workers'] if cursor else [None] * num_workers
+    return worker_pool.PoolStream(
+        self, name, kwargs.get('batch_size', 64),
+        kwargs.get('time_major', False), prefetch, ring, worker_cursors)
+
+  def _recv(self, conn: mp_connection.Connection):
+    result = conn.recv()
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+  def request(self, name: str, slot: int):
+    self._connections[name].send(('next', slot))
+
+  def receive(self, name: str) -> list[tuple]:
+    return self._recv(self._connections[name])
+
+  def close(self):
+    for conn in self._connections.values():
+      conn.close()
+    self._connections.clear()
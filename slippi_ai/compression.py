@@ -0,0 +1,134 @@
+"""Whole-file compression of parsed games.
+
+Compressed games are either zlib-compressed parquet files, or zstd frames
+compressed with a dictionary trained on a sample of games. Games are small
+and very similar to each other, so a trained dictionary gives better ratios
+than zlib and decompresses several times faster.
+
+Readers tell the two apart by the zstd magic number, and find the dictionary
+by the id that zstd records in each frame. Dictionaries are saved as
+<dict_id>.zdict files and must be registered (see load_dir) before games
+compressed with them can be read.
+
+python slippi_db/scripts/train_zstd_dict.py --root=Root
+"""
+
+import functools
+import os
+import random
+import threading
+import zlib
+from typing import Iterable, Optional
+
+import zstandard
+
+DICT_SUFFIX = '.zdict'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+PARQUET_MAGIC = b'PAR1'
+
+# The default level; decompression speed barely depends on it.
+DEFAULT_ZSTD_LEVEL = 9
+
+_dictionaries: dict[int, zstandard.ZstdCompressionDict] = {}
+_lock = threading.Lock()
+# zstd (de)compressors are not thread-safe, so keep one per thread.
+_local = threading.local()
+
+def is_zstd(contents) -> bool:
+  return bytes(contents[:4]) == ZSTD_MAGIC
+
+def dict_id(contents) -> int:
+  """Id of the dictionary a zstd frame was compressed with; 0 if none."""
+  return zstandard.get_frame_parameters(contents).dict_id
+
+def train_dict(
+    samples: Iterable[bytes],
+    dict_size: int = 112 * 1024,
+    level: int = DEFAULT_ZSTD_LEVEL,
+    block_size: int = 16 * 1024,
+) -> zstandard.ZstdCompressionDict:
+  """Trains a dictionary on uncompressed (parquet) games.
+
+  The trainer wants many small samples, so games are split into blocks.
+  """
+  blocks = [
+      sample[i:i + block_size]
+      for sample in samples
+      for i in range(0, len(sample), block_size)]
+  return zstandard.train_dictionary(dict_size, blocks, level=level)
+
+def save_dict(dictionary: zstandard.ZstdCompressionDict, dict_dir: str) -> str:
+  os.makedirs(dict_dir, exist_ok=True)
+  path = os.path.join(dict_dir, f'{dictionary.dict_id()}{DICT_SUFFIX}')
+  with open(path, 'wb') as f:
+    f.write(dictionary.as_bytes())
+  return path
+
+def register_dict(dictionary: zstandard.ZstdCompressionDict):
+  with _lock:
+    _dictionaries[dictionary.dict_id()] = dictionary
+
+@functools.lru_cache
+def load_dict(path: str) -> zstandard.ZstdCompressionDict:
+  """Loads and registers a dictionary."""
+  with open(path, 'rb') as f:
+    dictionary = zstandard.ZstdCompressionDict(f.read())
+  register_dict(dictionary)
+  return dictionary
+
+def load_dir(dict_dir: str):
+  """Registers all dictionaries in dict_dir."""
+  for name in os.listdir(dict_dir):
+    if name.endswith(DICT_SUFFIX):
+      load_dict(os.path.join(dict_dir, name))
+
+def _get_dict(id_: int) -> zstandard.ZstdCompressionDict:
+  with _lock:
+    dictionary = _dictionaries.get(id_)
+  if dictionary is None:
+    raise KeyError(
+        f'Unknown zstd dictionary {id_}; register it with load_dir, '
+        'e.g. by setting data.zstd_dict_dir.')
+  return dictionary
+
+def _decompressor(id_: int) -> zstandard.ZstdDecompressor:
+  decompressors = getattr(_local, 'decompressors', None)
+  if decompressors is None:
+    decompressors = _local.decompressors = {}
+  decompressor = decompressors.get(id_)
+  if decompressor is None:
+    dict_data = _get_dict(id_) if id_ else None
+    decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+    decompressors[id_] = decompressor
+  return decompressor
+
+def compress_zstd(
+    contents: bytes,
+    dictionary: Optional[zstandard.ZstdCompressionDict],
+    level: Optional[int] = None,
+) -> bytes:
+  if level is None:
+    level = DEFAULT_ZSTD_LEVEL
+  compressor = zstandard.ZstdCompressor(
+      level=level, dict_data=dictionary, write_content_size=True)
+  return compressor.compress(contents)
+
+def decompress(contents) -> bytes:
+  """Decompresses a zlib- or zstd-compressed game."""
+  if is_zstd(contents):
+    return _decompressor(dict_id(contents)).decompress(contents)
+  return zlib.decompress(contents)
+
+def sample_games(data_dir: str, num_samples: int, seed: int = 0) -> list[bytes]:
+  """Reads a random sample of the (uncompressed) games in data_dir."""
+  names = sorted(os.listdir(data_dir))
+  names = random.Random(seed).sample(names, min(num_samples, len(names)))
+
+  samples = []
+  for name in names:
+    with open(os.path.join(data_dir, name), 'rb') as f:
+      contents = f.read()
+    if bytes(contents[:4]) != PARQUET_MAGIC:
+      contents = decompress(contents)
+    samples.append(contents)
+  return samples
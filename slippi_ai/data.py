@@ -1,16 +1,17 @@
 import atexit
 import collections
+from concurrent import futures
 import dataclasses
+import hashlib
 import itertools
 import json
 import multiprocessing as mp
 import os
-import random
+import threading
 from typing import (
-    Any, Callable, Iterable, List, Optional, Set, Tuple, Iterator, NamedTuple,
-    Union,
+    Any, Callable, Collection, Iterable, List, Optional, Set, Tuple, Iterator,
+    NamedTuple, Union, Generic, TypeVar,
 )
-import zlib
 
 import numpy as np
 import pyarrow
@@ -18,8 +19,17 @@ import pyarrow.parquet as pq
 
 import melee
 
-from slippi_ai import reward, utils, nametags, paths
-from slippi_ai.types import Game, game_array_to_nt, Controller
+from slippi_ai import (
+    compression, game_cache, meta_index, reward, utils, nametags, pack_files,
+    paths, shm, storage,
+)
+from slippi_ai.types import Game, game_array_to_nt, Controller, leaf_paths
+
+# A path to a leaf of the Game struct, e.g. ('p0', 'controller', 'shoulder').
+GamePath = Tuple[str, ...]
+GAME_PATHS: List[GamePath] = leaf_paths(Game)
+_GAME_TEMPLATE: Game = utils.reify_tuple_type(Game)
+_GAME_DTYPES = utils.flatten_nt(_GAME_TEMPLATE)
 
 class PlayerMeta(NamedTuple):
   character: int
@@ -36,6 +46,7 @@ class ReplayMeta(NamedTuple):
   p1: PlayerMeta
   stage: int
   slp_md5: str
+  num_frames: int = 0  # 0 if unknown
 
   @classmethod
   def from_metadata(cls, metadata: dict) -> 'ReplayMeta':
@@ -44,7 +55,8 @@ class ReplayMeta(NamedTuple):
         p0=PlayerMeta.from_metadata(metadata['players'][0], raw),
         p1=PlayerMeta.from_metadata(metadata['players'][1], raw),
         stage=metadata['stage'],
-        slp_md5=metadata['slp_md5'])
+        slp_md5=metadata['slp_md5'],
+        num_frames=metadata['lastFrame'] - meta_index.FIRST_FRAME + 1)
 
 class ReplayInfo(NamedTuple):
   path: str
@@ -62,7 +74,7 @@ class ChunkMeta(NamedTuple):
   info: ReplayInfo
 
 class Chunk(NamedTuple):
-  states: Game
+  frames: 'Frames'
   meta: ChunkMeta
 
 # Action = TypeVar('Action')
@@ -102,6 +114,7 @@ NONE = 'none'
 @dataclasses.dataclass
 class DatasetConfig:
   data_dir: Optional[str] = None  # required
+  # Either meta.json or a metadata index (.parquet), see meta_index.py.
   meta_path: Optional[str] = None
   test_ratio: float = 0.1
   # comma-separated lists of characters, or "all"
@@ -138,8 +151,9 @@ def create_name_filter(
   return is_allowed
 
 def replays_from_meta(config: DatasetConfig) -> List[ReplayInfo]:
-  replays = []
+  return list(_iter_replays_from_meta(config))
 
+def _iter_replays_from_meta(config: DatasetConfig) -> Iterator[ReplayInfo]:
   with open(config.meta_path) as f:
     meta_rows: list[dict] = json.load(f)
 
@@ -167,7 +181,7 @@ def replays_from_meta(config: DatasetConfig) -> List[ReplayInfo]:
           or replay_meta.p1.character not in allowed_opponents):
         continue
 
-      replays.append(ReplayInfo(replay_path, False, replay_meta))
+      yield ReplayInfo(replay_path, False, replay_meta)
 
       continue
 
@@ -189,47 +203,133 @@ def replays_from_meta(config: DatasetConfig) -> List[ReplayInfo]:
         banned_counts[p0.name] += 1
         continue
 
-      replays.append(ReplayInfo(replay_path, swap, replay_meta))
+      yield ReplayInfo(replay_path, swap, replay_meta)
 
   print('Banned names:', banned_counts)
 
-  return replays
+def replays_from_index(config: DatasetConfig) -> List[ReplayInfo]:
+  """Like replays_from_meta, but with vectorized filters over an index."""
+  return list(_iter_replays_from_index(config))
 
-def train_test_split(
-    config: DatasetConfig,
-) -> Tuple[List[ReplayInfo], List[ReplayInfo]]:
-  filenames = sorted(os.listdir(config.data_dir))
-  print(f"Found {len(filenames)} files.")
+def _iter_replays_from_index(config: DatasetConfig) -> Iterator[ReplayInfo]:
+  allowed_characters = _charset(chars_from_string(config.allowed_characters))
+  allowed_opponents = _charset(chars_from_string(config.allowed_opponents))
 
-  replays: list[ReplayInfo] = []
+  table = meta_index.read_index(
+      config.meta_path,
+      allowed_characters=(
+          None if config.allowed_characters == ALL else allowed_characters),
+      allowed_opponents=(
+          None if config.allowed_opponents == ALL else allowed_opponents),
+      swap=config.swap,
+  )
 
-  if config.meta_path is not None:
-    replays = replays_from_meta(config)
+  masks = meta_index.perspective_masks(
+      table,
+      allowed_characters=allowed_characters,
+      allowed_opponents=allowed_opponents,
+      allowed_names=(
+          None if config.allowed_names == ALL
+          else set(config.allowed_names.split(','))),
+      banned_names=(
+          () if config.banned_names == NONE
+          else config.banned_names.split(',')),
+      swap=config.swap,
+  )
 
-    # check that we have the right metadata
-    filenames_set = set(filenames)
-    assert all(info.meta.slp_md5 in filenames_set for info in replays)
-  else:
+  # Only build metadata for the selected games.
+  selected = np.flatnonzero(np.logical_or.reduce(list(masks.values())))
+  columns = table.take(selected).to_pydict()
+  replay_metas = (
+      ReplayMeta(
+          p0=PlayerMeta(character=p0_char, name=p0_name),
+          p1=PlayerMeta(character=p1_char, name=p1_name),
+          stage=stage,
+          slp_md5=md5,
+          num_frames=num_frames)
+      for p0_char, p0_name, p1_char, p1_name, stage, md5, num_frames in zip(
+          columns['p0_character'], columns['p0_name'],
+          columns['p1_character'], columns['p1_name'],
+          columns['stage'], columns['slp_md5'], columns['num_frames'])
+  )
+
+  for i, replay_meta in zip(selected, replay_metas):
+    replay_path = os.path.join(config.data_dir, replay_meta.slp_md5)
+    for swap, mask in masks.items():
+      if mask[i]:
+        yield ReplayInfo(replay_path, swap, replay_meta)
+
+def load_replays(config: DatasetConfig) -> List[ReplayInfo]:
+  return list(_iter_replays(config))
+
+def _iter_replays(config: DatasetConfig) -> Iterator[ReplayInfo]:
+  if config.meta_path is None:
     if not (config.allowed_characters == ALL
             and config.allowed_opponents == ALL):
       raise ValueError(
           "Can't filter by character without metadata. "
           "Please provide a metadata file.")
 
-    for filename in filenames:
+    for filename in iter_games(config.data_dir):
       replay_path = os.path.join(config.data_dir, filename)
-      replays.append(ReplayInfo(replay_path, False))
-      replays.append(ReplayInfo(replay_path, True))
-
-  # TODO: stable partition
-  rng = random.Random(config.seed)
-  rng.shuffle(replays)
-  num_test = int(config.test_ratio * len(replays))
-
-  train_replays = replays[num_test:]
-  test_replays = replays[:num_test]
+      yield ReplayInfo(replay_path, False)
+      yield ReplayInfo(replay_path, True)
+  elif meta_index.is_index_path(config.meta_path):
+    yield from _iter_replays_from_index(config)
+  else:
+    yield from _iter_replays_from_meta(config)
+
+def iter_games(data_dir: str) -> Iterator[str]:
+  """Names of the games in data_dir, which may be a pack directory."""
+  if pack_files.is_pack_dir(data_dir):
+    yield from pack_files.read_index(data_dir)
+    return
+  with os.scandir(data_dir) as entries:
+    for entry in entries:
+      yield entry.name
+
+def partition_hash(md5: str, seed: int = 0) -> float:
+  """Stable hash of a game, uniform in [0, 1).
+
+  The hash only depends on the game (its md5, or file name without metadata)
+  and the seed, so both perspectives of a game land in the same split, and
+  games stay in the same split as the dataset grows.
+  """
+  digest = hashlib.blake2b(
+      md5.encode(), digest_size=8, salt=str(seed).encode()).digest()
+  return int.from_bytes(digest, 'little') / 2. ** 64
 
-  return train_replays, test_replays
+def train_test_split(
+    config: DatasetConfig,
+) -> Tuple['ReplayTable', 'ReplayTable']:
+  """Splits the replays by hashing each game, see partition_hash.
+
+  The split is decided for each replay in one pass over the metadata, and
+  both splits are views of one ReplayTable. Replays keep the metadata's
+  order; the samplers shuffle them, see DataSource.
+  """
+  builder = _ReplayTableBuilder()
+  splits: tuple[list[int], list[int]] = ([], [])
+  md5, is_test = None, False
+
+  for info in _iter_replays(config):
+    # The perspectives of a game come one after the other.
+    game = os.path.basename(info.path)
+    if game != md5:
+      md5 = game
+      is_test = partition_hash(md5, config.seed) < config.test_ratio
+    splits[is_test].append(builder.append(info))
+
+  table = builder.build()
+  print(f"Found {len(table)} replays.")
+
+  train_rows, test_rows = [np.array(rows, dtype=np.int64) for rows in splits]
+  if 0 < config.test_ratio < 1 and not (len(train_rows) and len(test_rows)):
+    # Only possible with very few games, e.g. the toy dataset.
+    print("Warning: too few games to hold any out; "
+          "training and testing on the same replays.")
+    train_rows = test_rows = np.concatenate([train_rows, test_rows])
+  return table.take(train_rows), table.take(test_rows)
 
 name_to_character = {c.name.lower(): c for c in melee.Character}
 
@@ -243,49 +343,252 @@ def chars_from_string(chars: str) -> Optional[List[melee.Character]]:
 def game_len(game: Game):
   return len(game.stage)
 
+def dummy_game(length: int) -> Game:
+  return utils.map_nt(lambda t: np.zeros([length], t), _GAME_TEMPLATE)
+
+def swap_path(path: GamePath) -> GamePath:
+  player, *rest = path
+  if player == 'p0':
+    return ('p1', *rest)
+  if player == 'p1':
+    return ('p0', *rest)
+  return path
+
+def required_game_paths(
+    state_action_paths: Iterable[Tuple[str, ...]],
+) -> Set[GamePath]:
+  """The Game leaves needed to make Frames for the given StateAction leaves.
+
+  Args:
+    state_action_paths: The StateAction leaves read by the model, as given by
+      the paths() of its state-action embedding.
+  Returns:
+    Paths from the main player's perspective, also covering the rewards and
+    character filters.
+  """
+  paths = set(reward.REQUIRED_PATHS)
+  paths.update([('p0', 'character'), ('p1', 'character')])
+
+  for field, *rest in state_action_paths:
+    if field == 'state':
+      paths.add(tuple(rest))
+    elif field == 'action':
+      # The action is the main player's controller, see make_frames.
+      paths.add(('p0', 'controller', *rest))
+
+  return paths
+
+def make_frames(
+    game: Game,
+    name_code: int,
+    needs_reset: bool,
+    damage_ratio: float,
+) -> Frames:
+  game_length = game_len(game)
+  # Rewards could be deferred to the learner.
+  rewards = reward.compute_rewards(game, damage_ratio=damage_ratio)
+  name_codes = np.full([game_length], name_code, np.int32)
+  state_action = StateAction(game, game.p0.controller, name_codes)
+  is_resetting = np.full([game_length], False)
+  is_resetting[0] = needs_reset
+  return Frames(
+      state_action=state_action, reward=rewards, is_resetting=is_resetting)
+
+def slice_frames(frames: Frames, start: int, end: int) -> Frames:
+  """Slices the frames of a whole game, as made by make_frames."""
+  # faster than tree.map_structure
+  return Frames(
+      state_action=utils.map_nt(lambda a: a[start:end], frames.state_action),
+      is_resetting=frames.is_resetting[start:end],
+      reward=frames.reward[start:end - 1],
+  )
+
+def pack_frames(pieces: List[Frames]) -> Frames:
+  """Concatenates slices of consecutive games into one chunk.
+
+  Each piece after the first must start a new game, so that is_resetting
+  marks the boundary. The reward of the step across a boundary is 0.
+  """
+  if len(pieces) == 1:
+    return pieces[0]
+
+  rewards = [pieces[0].reward]
+  for piece in pieces[1:]:
+    assert piece.is_resetting[0]
+    rewards.extend([np.zeros([1], piece.reward.dtype), piece.reward])
+
+  return Frames(
+      state_action=utils.concat_nest_nt([p.state_action for p in pieces]),
+      is_resetting=np.concatenate([p.is_resetting for p in pieces]),
+      reward=np.concatenate(rewards),
+  )
+
+def frames_spec(
+    chunk_size: int,
+    batch_size: int,
+    time_major: bool = False,
+    preprocess: Optional[Callable[[StateAction], Any]] = None,
+) -> Frames:
+  """ArraySpecs of a batch of Frames, laid out [B, T] or [T, B]."""
+  example = make_frames(dummy_game(chunk_size), 0, False, damage_ratio=0)
+  if preprocess is not None:
+    example = example._replace(
+        state_action=preprocess(example.state_action))
+
+  def to_spec(x: np.ndarray) -> shm.ArraySpec:
+    time, *rest = x.shape
+    leading = (time, batch_size) if time_major else (batch_size, time)
+    return shm.ArraySpec(leading + tuple(rest), x.dtype)
+
+  return utils.map_nt(to_spec, example)
+
+def _default_process_game(game: Game, name_code: int) -> Frames:
+  return make_frames(game, name_code, needs_reset=True, damage_ratio=0.01)
+
+def load_game(reader: 'GameReader', info: ReplayInfo) -> Game:
+  """Reads a game from the perspective of the replay's main player."""
+  game = reader.read(info.path, info.swap)
+  if info.swap:
+    game = swap_players(game)
+  return game
+
+T = TypeVar('T')
+U = TypeVar('U')
+
+class ReadAhead(Generic[T, U]):
+  """Loads upcoming items of a source on a thread pool.
+
+  Yields (item, loaded) pairs in source order, keeping up to `size` loads in
+  flight. File reads, zlib and Arrow release the GIL, so a few threads hide
+  most of the read and decode latency. Errors are raised when the failed
+  item is reached.
+  """
+
+  def __init__(
+      self,
+      source: Iterator[T],
+      load: Callable[[T], U],
+      size: int,
+      num_threads: int = 4,
+  ):
+    self.source = source
+    self.load = load
+    self.size = size
+    self._pool = futures.ThreadPoolExecutor(
+        num_threads, thread_name_prefix='read_ahead')
+    self._pending: collections.deque[Tuple[T, futures.Future]] = (
+        collections.deque())
+
+  def _fill(self):
+    for item in itertools.islice(self.source, self.size - len(self._pending)):
+      self._pending.append((item, self._pool.submit(self.load, item)))
+
+  def __iter__(self):
+    return self
+
+  def __next__(self) -> Tuple[T, U]:
+    self._fill()
+    if not self._pending:
+      raise StopIteration
+    item, future = self._pending.popleft()
+    result = future.result()
+    self._fill()
+    return item, result
+
+  def close(self):
+    self._pool.shutdown(wait=False, cancel_futures=True)
+
 class TrajectoryManager:
   # TODO: manage recurrent state? can also do it in the learner
 
   def __init__(
       self,
-      source: Iterator[ReplayInfo],
+      source: Iterator[int],
+      replays: 'ReplayTable',
       unroll_length: int,
       overlap: int = 1,
       compressed: bool = True,
       game_filter: Optional[Callable[[Game], bool]] = None,
+      reader: Optional['GameReader'] = None,
+      process_game: Callable[[Game, int], Frames] = _default_process_game,
+      games: Optional[Iterator[Tuple[int, Game]]] = None,
+      pack: bool = False,
   ):
+    """
+    Args:
+      source: Yields indices into replays.
+      replays: The replays to read from.
+      games: Optionally yields (index, game) pairs of already loaded games,
+        e.g. from a ReadAhead; source is then unused.
+      process_game: Computes the Frames of a whole game, including derived
+        columns like rewards. Called once per game; chunks are slices.
+      pack: Continue chunks into the next game instead of dropping the end
+        of each game, see pack_frames. Games of any length are then used.
+    """
     self.source = source
+    self.replays = replays
     self.compressed = compressed
+    self.reader = reader or GameReader(compressed)
     self.unroll_length = unroll_length
     self.overlap = overlap
     self.game_filter = game_filter or (lambda _: True)
+    self.process_game = process_game
+    self.games = games
+    self.pack = pack
 
     self.game: Game = None
+    self.frames: Frames = None
     self.frame: int = None
     self.info: ReplayInfo = None
+    self.row: int = None
 
   def load_game(self, info: ReplayInfo) -> Game:
-    game = read_table(info.path, compressed=self.compressed)
-    if info.swap:
-      game = swap_players(game)
-    return game
+    return load_game(self.reader, info)
+
+  def next_game(self) -> Tuple[int, Game]:
+    if self.games is not None:
+      return next(self.games)
+    row = next(self.source)
+    return row, self.load_game(self.replays[row])
 
   def find_game(self):
     while True:
-      info = next(self.source)
-      game = self.load_game(info)
-      if game_len(game) < self.unroll_length:
+      row, game = self.next_game()
+      info = self.replays[row]
+      min_length = 1 if self.pack else self.unroll_length
+      if game_len(game) < min_length:
         continue
       if not self.game_filter(game):
         continue
       break
+    self._set_game(row, game, frame=0)
+
+  def _set_game(self, row: int, game: Game, frame: int):
+    # Processed first, so that a failure leaves the manager between games.
+    self.frames = self.process_game(game, self.replays.name_code(row))
     self.game = game
-    self.frame = 0
-    self.info = info
+    self.frame = frame
+    self.info = self.replays[row]
+    self.row = row
+
+  def get_cursor(self) -> Optional[Tuple[int, int]]:
+    """The (row, frame) that the next chunk starts at; None between games."""
+    if self.game is None:
+      return None
+    return self.row, self.frame
+
+  def restore(self, cursor: Optional[Tuple[int, int]]):
+    """Resumes from a get_cursor result, reloading the current game."""
+    if cursor is None:
+      self.game = None
+      return
+    row, frame = cursor
+    self._set_game(row, self.load_game(self.replays[row]), frame)
 
   def grab_chunk(self) -> Chunk:
     """Grabs a chunk from a trajectory."""
-    # TODO: write a unit test for this
+    if self.pack:
+      return self._grab_packed_chunk()
 
     needs_reset = (
         self.game is None or
@@ -296,33 +599,751 @@ class TrajectoryManager:
 
     start = self.frame
     end = start + self.unroll_length
-    slice = lambda a: a[start:end]
-    # faster than tree.map_structure
-    states = utils.map_nt(slice, self.game)
+    frames = slice_frames(self.frames, start, end)
     self.frame = end - self.overlap
 
-    return Chunk(states, ChunkMeta(start, end, self.info))
+    return Chunk(frames, ChunkMeta(start, end, self.info))
+
+  def _grab_packed_chunk(self) -> Chunk:
+    """Grabs a chunk that may continue into the following games.
+
+    The meta describes the game the chunk starts in; end may lie past it.
+    """
+    if self.game is None:
+      self.find_game()
+
+    start = self.frame
+    info = self.info
+    pieces = []
+    remaining = self.unroll_length
+    while True:
+      end = min(self.frame + remaining, game_len(self.game))
+      pieces.append(slice_frames(self.frames, self.frame, end))
+      remaining -= end - self.frame
+      if remaining == 0:
+        break
+      self.find_game()
+
+    # Overlap with the previous chunk at most back to the start of this game;
+    # the next chunk then begins with a reset anyway.
+    self.frame = max(end - self.overlap, 0)
+    if self.frame == game_len(self.game):
+      self.game = None
+
+    frames = pack_frames(pieces)
+    return Chunk(frames, ChunkMeta(start, start + self.unroll_length, info))
+
+class RandomChunkSampler:
+  """Samples chunks uniformly over the frames of all replays.
+
+  Unlike TrajectoryManager, which walks through each game, this picks the
+  replay and start frame of each chunk directly from the per-game frame
+  counts in the metadata. Games that are too short are skipped without being
+  read, and the ends of games are sampled as often as any other frames.
+  Chunks are unrelated to each other, so each one starts with a reset.
+
+  Only the frames of each chunk are decoded (see GameReader.read_range),
+  which is cheapest for games written with small parquet row groups.
+  """
+
+  def __init__(
+      self,
+      replays: 'ReplayTable',
+      unroll_length: int,
+      overlap: int = 1,
+      compressed: bool = True,
+      allowed: Optional[np.ndarray] = None,
+      reader: Optional['GameReader'] = None,
+      process_game: Callable[[Game, int], Frames] = _default_process_game,
+      seed: Optional[int] = None,
+  ):
+    """
+    Args:
+      replays: The replays to sample from; must have frame counts.
+      unroll_length: The number of frames in each chunk.
+      overlap: Frames shared by consecutive chunks of the same game; only
+        used to count epochs.
+      compressed: Whether the games are compressed.
+      allowed: Optional mask of the replays to sample from.
+      reader: Used to read games.
+      process_game: Computes the Frames of a chunk of a game.
+      seed: Seed for sampling; None for a random seed.
+    """
+    self.replays = replays
+    self.unroll_length = unroll_length
+    self.overlap = overlap
+    self.reader = reader or GameReader(compressed)
+    self.process_game = process_game
+    self.rng = np.random.default_rng(seed)
+
+    num_frames = replays.columns.num_frames[replays.rows].astype(np.int64)
+    if allowed is not None:
+      num_frames = np.where(allowed, num_frames, 0)
+    self.num_starts = np.maximum(num_frames - unroll_length + 1, 0)
+    self.cumulative_starts = np.cumsum(self.num_starts)
+    self.total_frames = int(np.sum(num_frames[self.num_starts > 0]))
+
+    if self.total_frames == 0:
+      raise ValueError(
+          'No replays have at least unroll_length frames. Random sampling '
+          'uses the frame counts from the dataset metadata.')
+
+    self.num_chunks = 0
+
+  @property
+  def epoch(self) -> float:
+    new_frames = self.unroll_length - self.overlap
+    return self.num_chunks * new_frames / self.total_frames
+
+  def get_cursor(self) -> dict:
+    return dict(
+        rng=self.rng.bit_generator.state,
+        num_chunks=self.num_chunks,
+    )
+
+  def restore(self, cursor: dict):
+    self.rng.bit_generator.state = cursor['rng']
+    self.num_chunks = cursor['num_chunks']
+
+  def grab_chunk(self) -> Chunk:
+    index = self.rng.integers(self.cumulative_starts[-1])
+    row = int(np.searchsorted(self.cumulative_starts, index, side='right'))
+    start = int(index - self.cumulative_starts[row] + self.num_starts[row])
+    end = start + self.unroll_length
+
+    info = self.replays[row]
+    try:
+      states = self.reader.read_range(info.path, info.swap, start, end)
+    except ValueError as e:
+      raise ValueError(
+          f'{info.path} is shorter than the {info.meta.num_frames} frames '
+          'in the metadata.') from e
+    if info.swap:
+      states = swap_players(states)
+
+    frames = self.process_game(states, self.replays.name_code(row))
+    self.num_chunks += 1
+
+    return Chunk(frames, ChunkMeta(start, end, info))
+
+def _slice_game(game: Game, start: int, end: int) -> Game:
+  if game_len(game) < end:
+    raise ValueError(
+        f'Frames [{start}, {end}) out of range [0, {game_len(game)}).')
+  return utils.map_nt(lambda a: a[start:end], game)
 
 def swap_players(game: Game) -> Game:
   return game._replace(p0=game.p1, p1=game.p0)
 
-def read_table(path: str, compressed: bool) -> Game:
+def _selected_paths(
+    columns: Optional[Collection[GamePath]],
+) -> Optional[List[GamePath]]:
+  if columns is None:
+    return None
+  return [path for path in GAME_PATHS if path in columns]
+
+def _column_names(selected: Optional[List[GamePath]]) -> Optional[List[str]]:
+  if selected is None:
+    return None
+  return ['.'.join(('root',) + path) for path in selected]
+
+def _table_to_game(
+    table: pyarrow.Table,
+    selected: Optional[List[GamePath]],
+) -> Game:
+  # Quantized columns (see storage.py) are decoded to the usual dtypes.
+  if selected is None:
+    game_struct = table['root'].combine_chunks()
+    return storage.dequantize(game_array_to_nt(game_struct))
+
+  if table.num_columns and pyarrow.types.is_struct(table.schema[0].type):
+    # ParquetFile keeps selected leaves nested in a pruned struct.
+    while any(pyarrow.types.is_struct(f.type) for f in table.schema):
+      table = table.flatten()
+    columns = [table[name] for name in _column_names(selected)]
+  else:
+    # pq.read_table returns them as flat columns, in the requested order.
+    columns = table.columns
+  arrays = dict(zip(selected, columns))
+
+  leaves = []
+  for path, dtype in zip(GAME_PATHS, _GAME_DTYPES):
+    if path in arrays:
+      leaves.append(storage.dequantize_leaf(path, arrays[path].to_numpy()))
+    else:
+      # Zero-strided, so unread columns take no memory.
+      leaves.append(np.broadcast_to(np.zeros((), dtype), [table.num_rows]))
+  return utils.unflatten_nt(_GAME_TEMPLATE, leaves)
+
+def _read_game(source, columns: Optional[Collection[GamePath]] = None) -> Game:
+  selected = _selected_paths(columns)
+  table = pq.read_table(source, columns=_column_names(selected))
+  return _table_to_game(table, selected)
+
+def _read_game_range(
+    source,
+    start: int,
+    end: int,
+    columns: Optional[Collection[GamePath]] = None,
+) -> Game:
+  pq_file = pq.ParquetFile(source)
+  metadata = pq_file.metadata
+
+  row_groups = []
+  first_row = None
+  group_start = 0
+  for i in range(metadata.num_row_groups):
+    group_end = group_start + metadata.row_group(i).num_rows
+    if group_start < end and group_end > start:
+      row_groups.append(i)
+      if first_row is None:
+        first_row = group_start
+    group_start = group_end
+
+  if group_start < end:
+    raise ValueError(f'Frames [{start}, {end}) out of range [0, {group_start}).')
+
+  selected = _selected_paths(columns)
+  table = pq_file.read_row_groups(row_groups, columns=_column_names(selected))
+  table = table.slice(start - first_row, end - start)
+  return _table_to_game(table, selected)
+
+def read_table_from_bytes(
+    contents: bytes,
+    compressed: bool,
+    columns: Optional[Collection[GamePath]] = None,
+) -> Game:
+  if compressed:
+    contents = compression.decompress(contents)
+  return _read_game(pyarrow.BufferReader(contents), columns)
+
+def read_table(
+    path: str,
+    compressed: bool,
+    columns: Optional[Collection[GamePath]] = None,
+) -> Game:
+  """Reads a parsed game.
+
+  Args:
+    path: Path to the parsed game.
+    compressed: Whether the game is compressed (see compression.py).
+    columns: If given, only these leaves are decoded. The others are filled
+      with read-only zero placeholders.
+  """
   if compressed:
     with open(path, 'rb') as f:
-      contents = f.read()
-    contents = zlib.decompress(contents)
-    reader = pyarrow.BufferReader(contents)
-    table = pq.read_table(reader)
-  else:
-    table = pq.read_table(path)
+      return read_table_from_bytes(f.read(), compressed, columns)
+
+  return _read_game(path, columns)
+
+def read_frames_from_bytes(
+    contents,
+    compressed: bool,
+    start: int,
+    end: int,
+    columns: Optional[Collection[GamePath]] = None,
+) -> Game:
+  if compressed:
+    contents = compression.decompress(contents)
+  return _read_game_range(pyarrow.BufferReader(contents), start, end, columns)
+
+def read_frames(
+    path: str,
+    compressed: bool,
+    start: int,
+    end: int,
+    columns: Optional[Collection[GamePath]] = None,
+) -> Game:
+  """Reads frames [start, end) of a parsed game.
+
+  Only the parquet row groups overlapping the window are decoded, so for
+  games written with a small row_group_size (see parsing_utils.convert_game)
+  this costs about as much as the window itself. Compressed games are still
+  decompressed in full.
+
+  Args:
+    path: Path to the parsed game.
+    compressed: Whether the game is compressed (see compression.py).
+    start: First frame to read.
+    end: One past the last frame to read.
+    columns: If given, only these leaves are decoded, as in read_table.
+  """
+  if compressed:
+    with open(path, 'rb') as f:
+      return read_frames_from_bytes(f.read(), compressed, start, end, columns)
 
-  game_struct = table['root'].combine_chunks()
-  return game_array_to_nt(game_struct)
+  return _read_game_range(path, start, end, columns)
+
+_NUM_GAME_LOCKS = 64
+
+class GameReader:
+  """Reads games by path, from either per-game files or pack files.
+
+  A game path is data_dir/md5. If data_dir is a pack directory, the game is
+  read from its pack through a lazily opened, per-reader file handle.
+
+  Decoded games can be cached in memory, and on local disk where later
+  reads are memory-mapped. Games are named by md5, so the caches can be
+  shared across datasets. Games in a preloaded arena (see preload_games) are
+  served from it before anything else.
+
+  If columns are given, they are from the perspective of the main player,
+  and only those leaves are decoded. Projected games are cached under a key
+  that includes the projection.
+
+  Games compressed with a zstd dictionary need the dictionary's directory,
+  see compression.py.
+
+  Reads are thread-safe, see ReadAhead.
+  """
+
+  def __init__(
+      self,
+      compressed: bool = True,
+      disk_cache: Optional[game_cache.DiskGameCache] = None,
+      memory_cache: Optional[game_cache.MemoryGameCache] = None,
+      columns: Optional[Collection[GamePath]] = None,
+      arena: Optional[game_cache.SharedGameArena] = None,
+      zstd_dict_dir: Optional[str] = None,
+  ):
+    self.compressed = compressed
+    if zstd_dict_dir is not None:
+      compression.load_dir(zstd_dict_dir)
+    self.disk_cache = disk_cache
+    self.memory_cache = memory_cache
+    self.arena = arena
+
+    # Maps swap to the columns to read from the file, and a cache key suffix.
+    self._projections: dict[bool, Tuple[Optional[frozenset], str]] = {}
+    for swap in [False, True]:
+      if columns is None:
+        self._projections[swap] = (None, '')
+        continue
+      file_columns = frozenset(
+          swap_path(path) if swap else path for path in columns)
+      digest = hashlib.md5(repr(sorted(file_columns)).encode())
+      self._projections[swap] = (file_columns, '-' + digest.hexdigest()[:8])
+
+    self._pack_readers: dict[str, Optional[pack_files.PackReader]] = {}
+    self._lock = threading.Lock()
+    # Serializes reads of the same game (e.g. both perspectives, read ahead
+    # concurrently), so that the second one hits the memory cache.
+    self._game_locks = [threading.Lock() for _ in range(_NUM_GAME_LOCKS)]
+
+  def _get_pack_reader(self, data_dir: str) -> Optional[pack_files.PackReader]:
+    with self._lock:
+      if data_dir not in self._pack_readers:
+        pack_reader = None
+        if pack_files.is_pack_dir(data_dir):
+          pack_reader = pack_files.PackReader(data_dir)
+        self._pack_readers[data_dir] = pack_reader
+      return self._pack_readers[data_dir]
+
+  def decode(self, path: str, swap: bool = False) -> Game:
+    columns, _ = self._projections[swap]
+    data_dir, name = os.path.split(path)
+    pack_reader = self._get_pack_reader(data_dir)
+    if pack_reader is None:
+      return read_table(path, self.compressed, columns)
+    return read_table_from_bytes(
+        pack_reader.read(name), self.compressed, columns)
+
+  def decode_range(
+      self, path: str, swap: bool, start: int, end: int) -> Game:
+    columns, _ = self._projections[swap]
+    data_dir, name = os.path.split(path)
+    pack_reader = self._get_pack_reader(data_dir)
+    if pack_reader is None:
+      return read_frames(path, self.compressed, start, end, columns)
+    # A memory-mapped view, so only the footer and the row groups we need
+    # are paged in.
+    return read_frames_from_bytes(
+        pack_reader.buffer(name), self.compressed, start, end, columns)
+
+  def num_frames(self, path: str) -> int:
+    """Reads the length of a game from the pack index or parquet footer."""
+    data_dir, name = os.path.split(path)
+    pack_reader = self._get_pack_reader(data_dir)
+    if pack_reader is not None:
+      return pack_reader.index[name].num_frames
+    if self.compressed:
+      with open(path, 'rb') as f:
+        return pack_files.num_frames_from_bytes(f.read(), compressed=True)
+    return pq.read_metadata(path).num_rows
+
+  def _key(self, path: str, swap: bool) -> str:
+    _, suffix = self._projections[swap]
+    return os.path.basename(path) + suffix
+
+  def _read_through_disk_cache(self, path: str, swap: bool) -> Game:
+    if self.disk_cache is None:
+      return self.decode(path, swap)
+
+    key = self._key(path, swap)
+    game = self.disk_cache.get(key)
+    if game is None:
+      game = self.decode(path, swap)
+      self.disk_cache.put(key, game)
+    return game
+
+  def read(self, path: str, swap: bool = False) -> Game:
+    """Reads the game as stored, with the columns needed for this perspective.
+
+    The players are not swapped; swap only selects the projection.
+    """
+    if self.arena is not None:
+      game = self.arena.get(path)
+      if game is not None:
+        return game
+
+    if self.memory_cache is None:
+      return self._read_through_disk_cache(path, swap)
+
+    key = self._key(path, swap)
+    with self._game_locks[hash(path) % _NUM_GAME_LOCKS]:
+      game = self.memory_cache.get(key)
+      if game is None:
+        game = self._read_through_disk_cache(path, swap)
+        self.memory_cache.put(key, game)
+    return game
+
+  def read_range(
+      self, path: str, swap: bool, start: int, end: int) -> Game:
+    """Reads frames [start, end) of the game, as in read.
+
+    Cached games are sliced. Otherwise only the overlapping row groups are
+    decoded, and nothing is added to the caches.
+    """
+    if self.arena is not None:
+      game = self.arena.get(path)
+      if game is not None:
+        return _slice_game(game, start, end)
+
+    if self.memory_cache is not None:
+      game = self.memory_cache.get(self._key(path, swap))
+      if game is not None:
+        return _slice_game(game, start, end)
+
+    if self.disk_cache is not None:
+      game = self.disk_cache.get(self._key(path, swap))
+      if game is not None:
+        return _slice_game(game, start, end)
+
+    return self.decode_range(path, swap, start, end)
+
+  def get_stats(self) -> dict:
+    """Cumulative hit/miss counters for each enabled cache."""
+    stats = {}
+    for name in ['memory_cache', 'disk_cache']:
+      cache = getattr(self, name)
+      if cache is not None:
+        stats[name] = dict(hits=cache.hits, misses=cache.misses)
+    return stats
+
+class ReplayColumns(NamedTuple):
+  filename: np.ndarray  # bytes; the md5 if there is metadata
+  data_dir: np.ndarray  # index into ReplayTable.data_dirs
+  swap: np.ndarray
+  stage: np.ndarray
+  p0_character: np.ndarray
+  p1_character: np.ndarray
+  p0_name: np.ndarray  # index into names
+  p1_name: np.ndarray
+  num_frames: np.ndarray  # 0 if unknown
+  # Encoded main player name, see ReplayTable.encode_names.
+  name_code: np.ndarray
+
+class _SharedColumns(NamedTuple):
+  columns: ReplayColumns
+  names: np.ndarray
+
+class _ColumnStore:
+  """The columns underlying a ReplayTable and all of its views."""
+
+  def __init__(self, columns: ReplayColumns, names: np.ndarray):
+    self.columns = columns
+    self.names = names
+    self.ring: Optional[shm.SharedRing[_SharedColumns]] = None
+    # The name map that the name_code column was computed with.
+    self.name_map: Optional[dict[str, int]] = None
+
+  def share(self):
+    if self.ring is not None:
+      return
+    self.ring = shm.shared_copy(_SharedColumns(self.columns, self.names))
+    self.columns, self.names = self.ring[0]
+    atexit.register(self.ring.unlink)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    if self.ring is not None:
+      # Attach to the shared columns instead of copying them.
+      del state['columns'], state['names']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    if self.ring is not None:
+      self.columns, self.names = self.ring[0]
+
+class ReplayTable:
+  """Compact, array-backed list of ReplayInfos.
+
+  Each replay is a row of integer columns, with names and data directories
+  interned. Tables are views of the rows of an underlying set of columns, so
+  splitting a table doesn't copy the columns. Once share()d, the columns live
+  in shared memory, for this table and all other views of them, and pickling
+  a table (e.g. to send it to a worker process) only sends the row indices.
+  """
+
+  def __init__(
+      self,
+      columns: ReplayColumns,
+      names: np.ndarray,
+      data_dirs: Tuple[str, ...],
+      has_meta: bool,
+      rows: Optional[np.ndarray] = None,
+      store: Optional[_ColumnStore] = None,
+  ):
+    self._store = store or _ColumnStore(columns, names)
+    self.data_dirs = data_dirs
+    self.has_meta = has_meta
+    if rows is None:
+      rows = np.arange(len(columns.swap), dtype=np.int64)
+    self.rows = rows
+
+  @property
+  def columns(self) -> ReplayColumns:
+    return self._store.columns
+
+  @property
+  def names(self) -> np.ndarray:
+    return self._store.names
+
+  @property
+  def name_map(self) -> Optional[dict[str, int]]:
+    """The name map that the name_code column was computed with."""
+    return self._store.name_map
+
+  @classmethod
+  def from_replays(
+      cls,
+      replays: Iterable[ReplayInfo],
+      name_map: Optional[dict[str, int]] = None,
+  ) -> 'ReplayTable':
+    builder = _ReplayTableBuilder()
+    for info in replays:
+      builder.append(info)
+    return builder.build(name_map)
+
+  def encode_names(self, name_map: dict[str, int]):
+    """Sets the name_code column for all underlying rows."""
+    self._store.name_map = dict(name_map)
+    encode_name = nametags.name_encoder(name_map)
+    codes = np.array(
+        [encode_name(name.decode()) for name in self.names], dtype=np.int32)
+    main_name = np.where(
+        self.columns.swap, self.columns.p1_name, self.columns.p0_name)
+    self.columns.name_code[:] = codes[main_name] if len(codes) else 0
+
+  def __len__(self) -> int:
+    return len(self.rows)
+
+  def name_code(self, i: int) -> int:
+    return int(self.columns.name_code[self.rows[i]])
+
+  def __getitem__(self, i: int) -> ReplayInfo:
+    row = self.rows[i]
+    c = self.columns
+    path = os.path.join(
+        self.data_dirs[c.data_dir[row]], c.filename[row].decode())
+    if not self.has_meta:
+      return ReplayInfo(path, bool(c.swap[row]))
+
+    meta = ReplayMeta(
+        p0=PlayerMeta(
+            character=int(c.p0_character[row]),
+            name=self.names[c.p0_name[row]].decode()),
+        p1=PlayerMeta(
+            character=int(c.p1_character[row]),
+            name=self.names[c.p1_name[row]].decode()),
+        stage=int(c.stage[row]),
+        slp_md5=c.filename[row].decode(),
+        num_frames=int(c.num_frames[row]))
+    return ReplayInfo(path, bool(c.swap[row]), meta)
+
+  def __iter__(self) -> Iterator[ReplayInfo]:
+    for i in range(len(self)):
+      yield self[i]
+
+  def take(self, indices: np.ndarray) -> 'ReplayTable':
+    """A view of the given rows of this table."""
+    return ReplayTable(
+        self.columns, self.names, self.data_dirs, self.has_meta,
+        rows=self.rows[indices], store=self._store)
+
+  def group_by_path(self) -> List[np.ndarray]:
+    """Groups the perspectives of each game, in order of first appearance.
+
+    Returns:
+      Arrays of indices into this table.
+    """
+    c = self.columns
+    keys = np.rec.fromarrays(
+        [c.data_dir[self.rows], c.filename[self.rows]])
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first[inverse], kind='stable')
+    boundaries = np.flatnonzero(np.diff(first[inverse][order])) + 1
+    return np.split(order, boundaries)
+
+  def main_player_name_counts(self) -> collections.Counter:
+    c = self.columns
+    main_name = np.where(c.swap, c.p1_name, c.p0_name)[self.rows]
+    name_ids, counts = np.unique(main_name, return_counts=True)
+    return collections.Counter({
+        self.names[i].decode(): int(count)
+        for i, count in zip(name_ids, counts)})
+
+  def share(self):
+    """Moves the underlying columns into shared memory, once for all views.
+
+    The columns are unlinked when this process exits.
+    """
+    self._store.share()
+
+  def unlink(self):
+    if self._store.ring is not None:
+      self._store.ring.unlink()
+
+class _ReplayTableBuilder:
+  """Accumulates ReplayInfos into the columns of a ReplayTable, one by one."""
+
+  def __init__(self):
+    self.has_meta: Optional[bool] = None
+    self._data_dirs: dict[str, int] = {}
+    self._names: dict[str, int] = {}
+    self._columns: dict[str, list] = {
+        field: [] for field in ReplayColumns._fields if field != 'name_code'}
+
+  def _intern(self, interned: dict[str, int], value: str) -> int:
+    return interned.setdefault(value, len(interned))
+
+  def append(self, info: ReplayInfo) -> int:
+    """Adds a replay and returns its row."""
+    if self.has_meta is None:
+      self.has_meta = info.meta != ()
+    columns = self._columns
+    data_dir, filename = os.path.split(info.path)
+    columns['filename'].append(filename.encode())
+    columns['data_dir'].append(self._intern(self._data_dirs, data_dir))
+    columns['swap'].append(info.swap)
+
+    meta = info.meta if self.has_meta else None
+    columns['stage'].append(meta.stage if meta else 0)
+    columns['num_frames'].append(meta.num_frames if meta else 0)
+    for p in ['p0', 'p1']:
+      player = getattr(meta, p) if meta else None
+      columns[f'{p}_character'].append(player.character if player else 0)
+      columns[f'{p}_name'].append(
+          self._intern(self._names, player.name if player else ''))
+    return len(columns['swap']) - 1
+
+  def build(
+      self, name_map: Optional[dict[str, int]] = None) -> 'ReplayTable':
+    dtypes = dict(
+        filename=bytes, data_dir=np.int32, swap=bool, stage=np.uint8,
+        p0_character=np.uint8, p1_character=np.uint8, p0_name=np.int32,
+        p1_name=np.int32, num_frames=np.int32)
+    columns = {
+        field: np.array(values, dtype=dtypes[field])
+        for field, values in self._columns.items()}
+    columns['name_code'] = np.zeros([len(columns['swap'])], dtype=np.int32)
+
+    table = ReplayTable(
+        columns=ReplayColumns(**columns),
+        names=np.array(
+            [name.encode('utf-8') for name in self._names], dtype=bytes),
+        data_dirs=tuple(self._data_dirs),
+        has_meta=bool(self.has_meta))
+    table.encode_names(name_map or {})
+    return table
+
+def as_replay_table(
+    replays: Union[ReplayTable, Iterable[ReplayInfo]],
+    name_map: Optional[dict[str, int]] = None,
+) -> ReplayTable:
+  name_map = name_map or {}
+  if not isinstance(replays, ReplayTable):
+    return ReplayTable.from_replays(replays, name_map)
+  if replays.name_map != name_map:
+    replays.encode_names(name_map)
+  return replays
+
+def preload_games(
+    replays: ReplayTable,
+    compressed: bool = True,
+    columns: Optional[Collection[GamePath]] = None,
+    num_threads: int = 8,
+    zstd_dict_dir: Optional[str] = None,
+) -> game_cache.SharedGameArena:
+  """Decodes every game of the replays once into a shared-memory arena.
+
+  Both perspectives of a game share its entry, so the columns (from the main
+  player's perspective) are stored for both players.
+  """
+  stored = None
+  if columns is not None:
+    columns = set(columns) | set(map(swap_path, columns))
+    stored = [path in columns for path in GAME_PATHS]
+  reader = GameReader(compressed, columns=columns, zstd_dict_dir=zstd_dict_dir)
+
+  paths = []
+  num_frames = []
+  for group in replays.group_by_path():
+    path = replays[group[0]].path
+    paths.append(path)
+    known_frames = replays.columns.num_frames[replays.rows[group[0]]]
+    num_frames.append(known_frames or reader.num_frames(path))
+
+  arena = game_cache.SharedGameArena.build(
+      paths, num_frames, reader.read, stored, num_threads)
+  print(f'Preloaded {len(arena)} games ({arena.nbytes / 1024 ** 3:.2f} GB).')
+  return arena
+
+def make_game_reader(
+    compressed: bool = True,
+    disk_cache_dir: Optional[str] = None,
+    disk_cache_size_gb: float = 16,
+    cache_size_gb: float = 0,
+    columns: Optional[Collection[GamePath]] = None,
+    arena: Optional[game_cache.SharedGameArena] = None,
+    zstd_dict_dir: Optional[str] = None,
+) -> GameReader:
+  """A GameReader with the caches that a DataSource's arguments ask for."""
+  disk_cache = None
+  if disk_cache_dir:
+    disk_cache = game_cache.DiskGameCache(disk_cache_dir, disk_cache_size_gb)
+  memory_cache = None
+  if cache_size_gb:
+    memory_cache = game_cache.MemoryGameCache(cache_size_gb)
+  if cache_size_gb and columns is not None:
+    # Both perspectives of a game share one decode.
+    columns = set(columns) | set(map(swap_path, columns))
+  return GameReader(
+      compressed, disk_cache=disk_cache, memory_cache=memory_cache,
+      columns=columns, arena=arena, zstd_dict_dir=zstd_dict_dir)
+
+def cache_hit_rates(stats: dict) -> dict[str, float]:
+  hit_rates = {}
+  for name, counts in stats.items():
+    total = counts['hits'] + counts['misses']
+    hit_rates[name] = counts['hits'] / total if total else 0.
+  return hit_rates
 
 class DataSource:
   def __init__(
       self,
-      replays: List[ReplayInfo],
+      replays: Union[ReplayTable, List[ReplayInfo]],
       compressed: bool = True,
       batch_size: int = 64,
       unroll_length: int = 64,
@@ -332,7 +1353,71 @@ class DataSource:
       allowed_characters: Optional[list[melee.Character]] = None,
       allowed_opponents: Optional[list[melee.Character]] = None,
       name_map: Optional[dict[str, int]] = None,
+      disk_cache_dir: Optional[str] = None,
+      disk_cache_size_gb: float = 16,
+      cache_size_gb: float = 0,
+      time_major: bool = False,
+      num_buffers: int = 0,
+      columns: Optional[Collection[GamePath]] = None,
+      sampler: str = 'sequential',
+      read_ahead: int = 0,
+      read_threads: int = 4,
+      preprocess: Optional[Callable[[StateAction], Any]] = None,
+      preload: bool = False,
+      arena: Optional[game_cache.SharedGameArena] = None,
+      zstd_dict_dir: Optional[str] = None,
+      pack_games: bool = False,
+      cursor: Optional[dict] = None,
+      seed: Optional[int] = None,
+      reader: Optional['GameReader'] = None,
   ):
+    """
+    Args:
+      sampler: Either 'sequential', which walks through each game in turn,
+        or 'random', see RandomChunkSampler.
+      pack_games: With the sequential sampler, let chunks run on into the
+        next game rather than dropping the end of each game. Chunks then
+        contain mid-chunk resets; see TrajectoryManager.
+      read_ahead: With the sequential sampler, load up to this many upcoming
+        games in the background, see ReadAhead. 0 loads games on demand.
+      read_threads: Number of threads loading games ahead.
+      preprocess: Applied to the StateAction of each game (or chunk) as it
+        is loaded, e.g. an embedding's from_state_narrow. The batch frames
+        then hold its outputs.
+      preload: Decode all games up front into a shared-memory arena, see
+        preload_games, unless one is given.
+      arena: Preloaded games, e.g. shared by several worker processes.
+      zstd_dict_dir: Where to find the dictionaries of zstd-compressed games.
+      time_major: Lay out the batch frames as [T, B] instead of [B, T].
+      num_buffers: Batches are assembled into a round-robin of this many
+        preallocated buffers, so a batch is only valid until num_buffers
+        more batches have been produced; only for consumers that are done
+        with each batch before the next. 0 allocates fresh arrays per batch.
+      columns: Only decode these Game leaves, see required_game_paths.
+      cursor: Resume from the position of a source created with the same
+        arguments, see get_cursor.
+      seed: Seed of the random sampler; None for a random seed. Also seeds
+        the order in which the sequential sampler visits replays (None is 0).
+      reader: Read games with this (thread-safe) reader, e.g. one shared by
+        the streams of a batch server's workers. The cache, preload, arena,
+        column and zstd arguments then don't apply.
+    """
+    self.name_map = name_map or {}
+    self.encode_name = nametags.name_encoder(self.name_map)
+    replays = as_replay_table(replays, self.name_map)
+    if sampler == 'sequential' and len(replays):
+      # Visit the games in a pseudo-random order that is fixed by the seed,
+      # so that cursors stay valid. With a cache, visit both perspectives of
+      # a game back to back, so that the second one is served from the cache
+      # as a swapped view of the first.
+      rng = np.random.default_rng(0 if seed is None else seed)
+      if cache_size_gb:
+        groups = replays.group_by_path()
+        order = np.concatenate(
+            [groups[i] for i in rng.permutation(len(groups))])
+      else:
+        order = rng.permutation(len(replays))
+      replays = replays.take(order)
     self.replays = replays
     self.batch_size = batch_size
     self.unroll_length = unroll_length
@@ -340,27 +1425,121 @@ class DataSource:
     self.damage_ratio = damage_ratio
     self.compressed = compressed
     self.batch_counter = 0
+    self.time_major = time_major
 
-    self.replay_counter = 0
-    replays = self.iter_replays()
-    self.managers = [
-        TrajectoryManager(
-            replays,
-            unroll_length=self.chunk_size,
-            overlap=extra_frames,
-            compressed=compressed,
-            game_filter=self.is_allowed)
-        for _ in range(batch_size)]
+    self.preprocess = preprocess
+    self.spec = frames_spec(
+        self.chunk_size, batch_size, time_major, preprocess)
+    self._buffers = [self.allocate_frames() for _ in range(num_buffers)]
 
     self.allowed_characters = _charset(allowed_characters)
     self.allowed_opponents = _charset(allowed_opponents)
-    self.name_map = name_map or {}
-    self.encode_name = nametags.name_encoder(self.name_map)
 
-  def iter_replays(self) -> Iterator[ReplayInfo]:
-    for replay in itertools.cycle(self.replays):
+    self.replay_counter = 0
+    if reader is None:
+      # Shared by all managers, so that each pack is opened once per source.
+      if preload and arena is None:
+        arena = preload_games(
+            self.replays, compressed, columns, read_threads, zstd_dict_dir)
+      reader = make_game_reader(
+          compressed, disk_cache_dir, disk_cache_size_gb, cache_size_gb,
+          columns, arena, zstd_dict_dir)
+    self.reader = reader
+    self.sampler = sampler
+    self.read_ahead = None
+    if cursor is not None:
+      self._check_cursor(cursor)
+      self.batch_counter = cursor['batch_counter']
+      self.replay_counter = cursor['replay_counter']
+    if sampler == 'sequential':
+      replays = self.iter_replays(self.replay_counter)
+      games = None
+      if read_ahead:
+        self.read_ahead = ReadAhead(
+            replays, self.load_replay, size=read_ahead,
+            num_threads=read_threads)
+        games = self._count_replays(self.read_ahead)
+      else:
+        replays = self._count_replays(replays)
+      self.managers = [
+          TrajectoryManager(
+              replays,
+              self.replays,
+              unroll_length=self.chunk_size,
+              overlap=extra_frames,
+              compressed=compressed,
+              game_filter=self.is_allowed,
+              reader=self.reader,
+              process_game=self.process_game,
+              games=games,
+              pack=pack_games)
+          for _ in range(batch_size)]
+    elif sampler == 'random':
+      if pack_games:
+        raise ValueError('pack_games requires the sequential sampler.')
+      self.random_sampler = RandomChunkSampler(
+          self.replays,
+          unroll_length=self.chunk_size,
+          overlap=extra_frames,
+          compressed=compressed,
+          allowed=self.allowed_replays(),
+          reader=self.reader,
+          process_game=self.process_game,
+          seed=seed)
+      self.managers = [self.random_sampler] * batch_size
+    else:
+      raise ValueError(f'Unknown sampler {sampler}.')
+
+    if cursor is not None:
+      if sampler == 'sequential':
+        for manager, manager_cursor in zip(self.managers, cursor['managers']):
+          manager.restore(manager_cursor)
+      else:
+        self.random_sampler.restore(cursor['random_sampler'])
+
+  def iter_replays(self, start: int = 0) -> Iterator[int]:
+    rows = itertools.cycle(range(len(self.replays)))
+    return itertools.islice(rows, start % len(self.replays), None)
+
+  def _count_replays(self, items: Iterator[T]) -> Iterator[T]:
+    """Counts the replays taken by the managers, for epochs and cursors."""
+    for item in items:
       self.replay_counter += 1
-      yield replay
+      yield item
+
+  def get_cursor(self) -> dict:
+    """The position of the source after the last batch, for resuming.
+
+    The cursor is small and picklable: the batch and replay counters (the
+    replay order itself is fixed), each manager's game and frame, or the
+    random sampler's RNG state.
+    """
+    cursor = dict(
+        num_replays=len(self.replays),
+        batch_size=self.batch_size,
+        sampler=self.sampler,
+        batch_counter=self.batch_counter,
+        replay_counter=self.replay_counter,
+    )
+    if self.sampler == 'sequential':
+      cursor['managers'] = [m.get_cursor() for m in self.managers]
+    else:
+      cursor['random_sampler'] = self.random_sampler.get_cursor()
+    return cursor
+
+  def _check_cursor(self, cursor: dict):
+    expected = dict(
+        num_replays=len(self.replays),
+        batch_size=self.batch_size,
+        sampler=self.sampler,
+    )
+    actual = {key: cursor.get(key) for key in expected}
+    if actual != expected:
+      raise ValueError(
+          f'Cursor is for a different source: {actual} != {expected}.')
+
+  def load_replay(self, row: int) -> Game:
+    return load_game(self.reader, self.replays[row])
 
   def is_allowed(self, game: Game) -> bool:
     # TODO: handle Zelda/Sheik transformation
@@ -369,45 +1548,78 @@ class DataSource:
         and
         game.p1.character[0] in self.allowed_opponents)
 
-  def process_game(
-      self, game: Game, name_code: int, needs_reset: bool) -> Frames:
-    game_length = game_len(game)
-    assert game_length == self.chunk_size
-    # Rewards could be deferred to the learner.
-    rewards = reward.compute_rewards(game, damage_ratio=self.damage_ratio)
-    name_codes = np.full([game_length], name_code, np.int32)
-    state_action = StateAction(game, game.p0.controller, name_codes)
-    is_resetting = np.full([game_length], False)
-    is_resetting[0] = needs_reset
-    return Frames(
-        state_action=state_action, reward=rewards, is_resetting=is_resetting)
-
-  def process_batch(self, chunks: list[Chunk]) -> Batch:
-    batches: List[Batch] = []
-
-    for chunk in chunks:
-      name_code = self.encode_name(chunk.meta.info.main_player.name)
-      needs_reset = chunk.meta.start == 0
-      batches.append(Batch(
-          frames=self.process_game(chunk.states, name_code, needs_reset),
-          count=self.batch_counter,
-          meta=chunk.meta))
-
-    return utils.batch_nest_nt(batches)
-
-  def __next__(self) -> Tuple[Batch, float]:
-    batch: Batch = self.process_batch(
-        [m.grab_chunk() for m in self.managers])
-    epoch = self.replay_counter / len(self.replays)
+  def allowed_replays(self) -> np.ndarray:
+    """Like is_allowed, but for all replays at once using the metadata."""
+    columns = self.replays.columns
+    rows = self.replays.rows
+    swap = columns.swap[rows]
+    p0_character = columns.p0_character[rows]
+    p1_character = columns.p1_character[rows]
+    main_character = np.where(swap, p1_character, p0_character)
+    opponent_character = np.where(swap, p0_character, p1_character)
+    return (
+        np.isin(main_character, list(self.allowed_characters))
+        & np.isin(opponent_character, list(self.allowed_opponents)))
+
+  def epoch(self) -> float:
+    if self.sampler == 'random':
+      return self.random_sampler.epoch
+    return self.replay_counter / len(self.replays)
+
+  def process_game(self, game: Game, name_code: int) -> Frames:
+    """Computes the frames of a game (or chunk) once, when it is loaded."""
+    frames = make_frames(
+        game, name_code, needs_reset=True, damage_ratio=self.damage_ratio)
+    if self.preprocess is not None:
+      frames = frames._replace(
+          state_action=self.preprocess(frames.state_action))
+    return frames
+
+  def allocate_frames(self) -> Frames:
+    return utils.map_nt(lambda spec: spec.allocate(), self.spec)
+
+  def process_batch(self, chunks: list[Chunk], frames: Frames) -> Batch:
+    """Writes the processed chunks into frames, one batch row per chunk."""
+    for i, chunk in enumerate(chunks):
+      assert len(chunk.frames.is_resetting) == self.chunk_size
+      row = (slice(None), i) if self.time_major else i
+
+      def write_row(dst: np.ndarray, src: np.ndarray):
+        dst[row] = src
+
+      utils.map_nt(write_row, frames, chunk.frames)
+
+    return Batch(
+        frames=frames,
+        count=np.full([len(chunks)], self.batch_counter),
+        meta=utils.batch_nest_nt([chunk.meta for chunk in chunks]))
+
+  def next_into(self, frames: Frames) -> Tuple[Batch, float]:
+    """Like __next__, but assembles the batch frames into the given arrays."""
+    batch = self.process_batch(
+        [m.grab_chunk() for m in self.managers], frames)
+    epoch = self.epoch()
     self.batch_counter += 1
-    assert batch.frames.state_action.state.stage.shape[-1] == self.chunk_size
-    assert batch.frames.reward.shape[-1] == self.chunk_size - 1
     return batch, epoch
 
+  def __next__(self) -> Tuple[Batch, float]:
+    if self._buffers:
+      frames = self._buffers[self.batch_counter % len(self._buffers)]
+    else:
+      frames = self.allocate_frames()
+    return self.next_into(frames)
+
+  def get_stats(self) -> dict:
+    return self.reader.get_stats()
+
 def produce_batches(data_source_kwargs, batch_queue):
-  data_source = DataSource(**data_source_kwargs)
+  # Batches are pickled asynchronously by the queue's feeder thread, so
+  # they can't share reused buffers.
+  data_source = DataSource(num_buffers=0, **data_source_kwargs)
   while True:
-    batch_queue.put(next(data_source))
+    batch = next(data_source)
+    batch_queue.put(
+        (batch, data_source.get_stats(), data_source.get_cursor()))
 
 class DataSourceMP:
   def __init__(self, buffer=4, **kwargs):
@@ -428,47 +1640,236 @@ class DataSourceMP:
     atexit.register(self.batch_queue.close)
     atexit.register(self.process.terminate)
 
+    self._stats = {}
+    self._cursor = kwargs.get('cursor')
+
   def __next__(self) -> Tuple[Batch, float]:
-    return self.batch_queue.get()
+    result, self._stats, self._cursor = self.batch_queue.get()
+    return result
+
+  def get_stats(self) -> dict:
+    return self._stats
+
+  def get_cursor(self) -> Optional[dict]:
+    """The worker's cursor as of the last batch received."""
+    return self._cursor
+
+  def __del__(self):
+    self.process.terminate()
+
+def produce_batches_to_ring(
+    data_source_kwargs: dict,
+    ring: shm.SharedRing[Frames],
+    rows: slice,
+    free_slots: mp.Queue,
+    handles: mp.Queue,
+):
+  data_source = DataSource(num_buffers=0, **data_source_kwargs)
+  index = (slice(None), rows) if data_source.time_major else rows
+  while True:
+    slot = free_slots.get()
+    # Assemble the batch directly into our rows of the slot.
+    frames = utils.map_nt(lambda x: x[index], ring[slot])
+    batch, epoch = data_source.next_into(frames)
+    handles.put((
+        slot, batch.count, batch.meta, epoch, data_source.get_stats(),
+        data_source.get_cursor()))
+
+class RingWorkerMP:
+  """Worker process that writes its rows of each batch into a SharedRing.
+
+  Only slot handles and the (small) per-row metadata go through the queues.
+  Slots are handed out and released in order, so all workers of a ring
+  write the same logical batch into the same slot.
+  """
+
+  def __init__(self, ring: shm.SharedRing[Frames], rows: slice, **kwargs):
+    context = mp.get_context('spawn')
+
+    self.free_slots = context.Queue()
+    for slot in range(ring.num_slots):
+      self.free_slots.put(slot)
+    self.handles = context.Queue()
+
+    self.process = context.Process(
+        target=produce_batches_to_ring,
+        args=(kwargs, ring, rows, self.free_slots, self.handles),
+        name='RingWorkerMP')
+    self.process.start()
+
+    atexit.register(self.free_slots.close)
+    atexit.register(self.handles.close)
+    atexit.register(self.process.terminate)
+
+    self._stats = {}
+    self._cursor = kwargs.get('cursor')
+
+  def release(self, slot: int):
+    self.free_slots.put(slot)
+
+  def get(self) -> tuple[int, np.ndarray, ChunkMeta, float]:
+    slot, count, meta, epoch, self._stats, self._cursor = self.handles.get()
+    return slot, count, meta, epoch
+
+  def get_stats(self) -> dict:
+    return self._stats
+
+  def get_cursor(self) -> Optional[dict]:
+    return self._cursor
 
   def __del__(self):
     self.process.terminate()
 
+def split_replays(
+    replays: Union[ReplayTable, List[ReplayInfo]],
+    num_workers: int,
+    batch_size: int,
+    kwargs: dict,
+) -> List[ReplayTable]:
+  """Divides the replays between worker processes.
+
+  With preload, also decodes the games into an arena in kwargs, which the
+  workers then share.
+  """
+  if num_workers > len(replays):
+    raise ValueError(
+        f"num_workers ({num_workers}) must be less than the number of "
+        f"replays ({len(replays)})")
+
+  if batch_size % num_workers != 0:
+    raise ValueError(
+        f"batch_size ({batch_size}) must be divisible by num_workers "
+        f"({num_workers})")
+
+  # Encode names once here rather than in each worker, and give the
+  # workers views of the shared columns instead of pickled copies.
+  replays = as_replay_table(replays, kwargs.get('name_map'))
+  replays.share()
+
+  if kwargs.get('cache_size_gb'):
+    # Keep the perspectives of each game on the same worker's cache.
+    groups = replays.group_by_path()
+    if num_workers > len(groups):
+      raise ValueError(
+          f"num_workers ({num_workers}) must be less than the number of "
+          f"games ({len(groups)}) when caching")
+    worker_rows = [
+        np.concatenate(groups[i::num_workers]) for i in range(num_workers)]
+  else:
+    rows = np.arange(len(replays))
+    worker_rows = [rows[i::num_workers] for i in range(num_workers)]
+
+  if kwargs.get('preload'):
+    # Decode once here; the workers all read from the same arena.
+    kwargs['arena'] = preload_games(
+        replays, kwargs.get('compressed', True), kwargs.get('columns'),
+        kwargs.get('read_threads', 4), kwargs.get('zstd_dict_dir'))
+    atexit.register(kwargs['arena'].unlink)
+
+  return [replays.take(rows) for rows in worker_rows]
+
 class MultiDataSourceMP:
+  """Splits each batch across several worker processes.
+
+  With shared_memory=True, workers write their rows of each batch directly
+  into a ring of preallocated shared-memory slots, avoiding pickling the
+  frames and concatenating the per-worker batches. The frames of a batch are
+  then only valid until the next call to __next__.
+  """
 
   def __init__(
       self,
-      replays: List[ReplayInfo],
+      replays: Union[ReplayTable, List[ReplayInfo]],
       num_workers: int,
       batch_size: int,
+      shared_memory: bool = False,
+      num_slots: int = 4,
+      cursor: Optional[dict] = None,
       **kwargs,
   ):
-    if num_workers > len(replays):
-      raise ValueError(
-          f"num_workers ({num_workers}) must be less than the number of "
-          f"replays ({len(replays)})")
-
-    if batch_size % num_workers != 0:
-      raise ValueError(
-          f"batch_size ({batch_size}) must be divisible by num_workers "
-          f"({num_workers})")
-
-    self.sources: list[DataSourceMP] = []
+    worker_replays = split_replays(replays, num_workers, batch_size, kwargs)
+
+    self.shared_memory = shared_memory
+    self.ring: Optional[shm.SharedRing[Frames]] = None
+    self._last_slot: Optional[int] = None
+
+    self.time_major = kwargs.get('time_major', False)
+
+    if shared_memory:
+      chunk_size = (
+          kwargs.get('unroll_length', 64) + kwargs.get('extra_frames', 1))
+      spec = frames_spec(
+          chunk_size, batch_size, self.time_major, kwargs.get('preprocess'))
+      self.ring = shm.SharedRing(shm.NestLayout(spec), num_slots)
+      atexit.register(self.ring.unlink)
+
+    worker_cursors = [None] * num_workers
+    if cursor is not None:
+      worker_cursors = cursor['workers']
+      if len(worker_cursors) != num_workers:
+        raise ValueError(
+            f'Cursor has {len(worker_cursors)} workers, not {num_workers}.')
+
+    worker_batch_size = batch_size // num_workers
+    self.sources: list[Union[DataSourceMP, RingWorkerMP]] = []
     for i in range(num_workers):
-      self.sources.append(DataSourceMP(
-          replays=replays[i::num_workers],
-          batch_size=batch_size // num_workers,
-          **kwargs
-      ))
+      worker_kwargs = dict(
+          replays=worker_replays[i],
+          batch_size=worker_batch_size,
+          cursor=worker_cursors[i],
+          **kwargs)
+
+      if shared_memory:
+        rows = slice(i * worker_batch_size, (i + 1) * worker_batch_size)
+        self.sources.append(RingWorkerMP(self.ring, rows, **worker_kwargs))
+      else:
+        self.sources.append(DataSourceMP(**worker_kwargs))
 
     self.batch_size = batch_size
     for k in kwargs:
       setattr(self, k, kwargs[k])
 
+  def _next_from_ring(self) -> Tuple[Batch, float]:
+    if self._last_slot is not None:
+      for source in self.sources:
+        source.release(self._last_slot)
+
+    slots, counts, metas, epochs = zip(
+        *[source.get() for source in self.sources])
+    slot = slots[0]
+    assert all(s == slot for s in slots)
+    self._last_slot = slot
+
+    batch = Batch(
+        frames=self.ring[slot],
+        count=np.concatenate(counts),
+        meta=utils.concat_nest_nt(metas),
+    )
+    return batch, np.mean(epochs)
+
   def __next__(self) -> Tuple[Batch, float]:
+    if self.shared_memory:
+      return self._next_from_ring()
+
     results = [next(source) for source in self.sources]
     batches, epochs = zip(*results)
-    return utils.concat_nest_nt(batches), np.mean(epochs)
+    batch = Batch(
+        frames=utils.concat_nest_nt(
+            [b.frames for b in batches], axis=1 if self.time_major else 0),
+        count=np.concatenate([b.count for b in batches]),
+        meta=utils.concat_nest_nt([b.meta for b in batches]),
+    )
+    return batch, np.mean(epochs)
+
+  def get_stats(self) -> dict:
+    stats = [source.get_stats() for source in self.sources]
+    if not all(stats):
+      return {}
+    return utils.map_nt(lambda *xs: sum(xs), *stats)
+
+  def get_cursor(self) -> dict:
+    """Cursors of the workers as of the last batch, see DataSource."""
+    return dict(workers=[source.get_cursor() for source in self.sources])
 
 @dataclasses.dataclass
 class DataConfig:
@@ -476,15 +1877,55 @@ class DataConfig:
   unroll_length: int = 64
   damage_ratio: float = 0.01
   compressed: bool = True
+  # Dictionaries of games compressed with zstd_dict, see compression.py.
+  zstd_dict_dir: Optional[str] = None
   num_workers: int = 0
+  # Optional local-disk cache of decoded games, shared between workers.
+  disk_cache_dir: Optional[str] = None
+  disk_cache_size_gb: float = 16
+  # Per-source in-memory cache of decoded games; 0 disables.
+  cache_size_gb: float = 0
+  # Send batches from workers through shared memory instead of pipes. The
+  # frames of each batch are then overwritten by later batches, so consumers
+  # must be done with (or copy) a batch before asking for the next one.
+  shared_memory: bool = False
+  # 'sequential' or 'random'; the latter needs metadata with frame counts.
+  sampler: str = 'sequential'
+  # Produce [T, B] batches, which the learner then doesn't need to transpose.
+  time_major: bool = False
+  # Games to load ahead on a thread pool in each source; 0 disables.
+  read_ahead: int = 0
+  read_threads: int = 4
+  # Apply the model's embedding (from_state) in the data sources and send
+  # the narrowest dtypes, with buttons packed into a bitmask; the learner
+  # casts and unpacks them on device.
+  embed_in_workers: bool = False
+  # Decode the whole dataset once into shared memory, for datasets that fit
+  # in RAM. Workers then only slice games out of it.
+  preload: bool = False
+  # Pack consecutive games into chunks, resetting the model's state at game
+  # boundaries, instead of dropping each game's last partial chunk. Not
+  # supported by train_q_lib.
+  pack_games: bool = False
+  # Serve train and test batches from one pool of num_workers processes;
+  # test batches are then only made when needed.
+  shared_pool: bool = False
+  # Seed of the random sampler (None for a random seed) and of the order in
+  # which the sequential sampler visits replays (None is 0).
+  seed: Optional[int] = None
+  # Socket directory of a batch server to get batches from instead of
+  # decoding games here, see batch_server.py.
+  batch_server: Optional[str] = None
 
 def make_source(
     num_workers: int,
+    shared_memory: bool = False,
     **kwargs):
   if num_workers == 0:
     return DataSource(**kwargs)
 
-  return MultiDataSourceMP(num_workers=num_workers, **kwargs)
+  return MultiDataSourceMP(
+      num_workers=num_workers, shared_memory=shared_memory, **kwargs)
 
 def toy_data_source(**kwargs) -> DataSource:
   dataset_config = DatasetConfig(
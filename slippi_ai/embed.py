@@ -15,7 +15,7 @@ import numpy as np
 import tensorflow as tf
 import tensorflow_probability as tfp
 
-from slippi_ai import utils
+from slippi_ai import types, utils
 from slippi_ai.types import Buttons, Controller, Game, Nest, Player, Stick
 from slippi_ai.controller_lib import LEGAL_BUTTONS
 from slippi_ai.data import Action, StateAction
@@ -38,6 +38,10 @@ class Embedding(Generic[In, Out], abc.ABC):
   def map(self, f, *args: Out) -> Out:
     return f(self, *args)
 
+  def paths(self) -> Iterator[tuple[str, ...]]:
+    """Field paths of the input leaves that this embedding reads."""
+    yield ()
+
   def flatten(self, struct: Out) -> Iterator[Any]:
     yield struct
 
@@ -48,6 +52,23 @@ class Embedding(Generic[In, Out], abc.ABC):
     """Inverse of `from_state`."""
     return out
 
+  def transfer_dtype(self) -> np.dtype:
+    """Narrowest dtype that holds the outputs of from_state exactly."""
+    return np.dtype(self.dtype)
+
+  def from_state_narrow(self, state: In) -> Out:
+    """Like from_state, but in the transfer dtypes; see widen."""
+    return self.map(
+        lambda e, x: x.astype(e.transfer_dtype(), copy=False),
+        self.from_state(state))
+
+  def widen(self, narrow: Out) -> Out:
+    """Casts (on device) the outputs of from_state_narrow to from_state's."""
+    def cast(e: Embedding, t):
+      dtype = tf.as_dtype(e.dtype)
+      return t if t.dtype == dtype else tf.cast(t, dtype)
+    return self.map(cast, narrow)
+
   # def preprocess(self, x: In):
   #   """Used by discretization."""
   #   return x
@@ -174,6 +195,9 @@ class OneHotEmbedding(Embedding[int, np.int32]):
     else:
       return one_hot
 
+  def transfer_dtype(self) -> np.dtype:
+    return np.min_scalar_type(self.size - 1)
+
   def to_input(self, logits):
     return tf.nn.softmax(logits)
 
@@ -231,6 +255,11 @@ class StructEmbedding(Embedding[NT, NT]):
     for k, e in self.embedding:
       yield from e.flatten(self.getter(struct, k))
 
+  def paths(self) -> Iterator[tuple[str, ...]]:
+    for k, e in self.embedding:
+      for path in e.paths():
+        yield (k,) + path
+
   def unflatten(self, seq: Iterator[Any]) -> NT:
     return self.builder({k: e.unflatten(seq) for k, e in self.embedding})
 
@@ -238,6 +267,17 @@ class StructEmbedding(Embedding[NT, NT]):
     struct = {k: e.from_state(self.getter(state, k)) for k, e in self.embedding}
     return self.builder(struct)
 
+  # Recursive rather than via map, so that sub-embeddings may use a transfer
+  # format with a different structure (see ButtonsEmbedding).
+  def from_state_narrow(self, state: NT) -> NT:
+    return self.builder({
+        k: e.from_state_narrow(self.getter(state, k))
+        for k, e in self.embedding})
+
+  def widen(self, narrow: NT) -> NT:
+    return self.builder({
+        k: e.widen(self.getter(narrow, k)) for k, e in self.embedding})
+
   def __call__(self, struct: NT, **kwargs) -> tf.Tensor:
     embed = []
 
@@ -424,12 +464,41 @@ def make_game_embedding(player_config={}):
 default_embed_game = make_game_embedding(
     player_config=dict(with_controller=False))
 
+class ButtonsEmbedding(StructEmbedding[Buttons]):
+  """Embeds buttons, which are transferred packed into a uint8 mask.
+
+  from_state_narrow packs the buttons with types.pack_buttons, and widen
+  unpacks them on device, so data sources move one small leaf instead of
+  eight bools.
+  """
+
+  def __init__(self, buttons: Sequence[str]):
+    """
+    Args:
+      buttons: All of the Buttons fields, in autoregressive order.
+    """
+    if sorted(buttons) != sorted(Buttons._fields):
+      raise ValueError(f'Expected all of {Buttons._fields}, got {buttons}.')
+    super().__init__(
+        name='buttons',
+        embedding=[(b, BoolEmbedding(name=b)) for b in buttons],
+        builder=SplatKwargs(Buttons),
+        getter=getattr,
+    )
+
+  def from_state_narrow(self, state: Buttons) -> np.ndarray:
+    return types.pack_buttons(self.from_state(state))
+
+  def widen(self, narrow: Union[Buttons, tf.Tensor]) -> Buttons:
+    if isinstance(narrow, Buttons):
+      return super().widen(narrow)
+    return Buttons(**{
+        name: tf.not_equal(tf.bitwise.bitwise_and(narrow, bit), 0)
+        for name, bit in types.BUTTON_BITS.items()
+    })
+
 # Embeddings for controllers
-embed_buttons = ordered_struct_embedding(
-    'buttons',
-    [(b.value, BoolEmbedding(name=b.value)) for b in LEGAL_BUTTONS],
-    Buttons,
-)
+embed_buttons = ButtonsEmbedding([b.value for b in LEGAL_BUTTONS])
 
 class DiscreteEmbedding(OneHotEmbedding):
   """Buckets float inputs in [0, 1]."""
@@ -1,5 +1,6 @@
 import collections
 import contextlib
+import functools
 import logging
 import multiprocessing as mp
 from multiprocessing.connection import Connection
@@ -13,7 +14,7 @@ import portpicker
 from melee.slippstream import EnetDisconnected
 from melee import GameState, Stage
 
-from slippi_ai import dolphin, utils
+from slippi_ai import dolphin, types, utils
 from slippi_ai.controller_lib import send_controller
 from slippi_ai.types import Controller, Game
 from slippi_ai import data
@@ -269,6 +270,26 @@ def build_environment(
   return BatchedEnvironment(
       num_envs, dolphin_kwargs, slippi_ports, num_retries, **env_kwargs)
 
+def _map_buttons(f: tp.Callable, game: Game) -> Game:
+  def map_player(player):
+    controller = player.controller
+    return player._replace(
+        controller=controller._replace(buttons=f(controller.buttons)))
+  return game._replace(p0=map_player(game.p0), p1=map_player(game.p1))
+
+def _map_gamestates(f: tp.Callable[[Game], Game], output):
+  """Applies f to the games of an EnvOutput or a list of them."""
+  if isinstance(output, list):
+    return [_map_gamestates(f, o) for o in output]
+  gamestates = {port: f(game) for port, game in output.gamestates.items()}
+  return output._replace(gamestates=gamestates)
+
+# Buttons cross the pipe packed into one mask, see types.pack_buttons.
+_pack_output = functools.partial(
+    _map_gamestates, functools.partial(_map_buttons, types.pack_buttons))
+_unpack_output = functools.partial(
+    _map_gamestates, functools.partial(_map_buttons, types.unpack_buttons))
+
 def _run_env(
     build_env_kwargs: dict,
     conn: Connection,
@@ -287,7 +308,7 @@ def _run_env(
     initial_state = env.current_state()
     if batch_time:
       initial_state = [initial_state]
-    send(initial_state)
+    send(_pack_output(initial_state))
 
     env_step = env.multi_step if batch_time else env.step
 
@@ -296,7 +317,7 @@ def _run_env(
       if controllers is None:
         send(None)  # signal end of outputs
         return
-      send(env_step(controllers))
+      send(_pack_output(env_step(controllers)))
 
     # conn.close()
   except KeyboardInterrupt:
@@ -409,7 +430,9 @@ class AsyncEnvMP:
     if isinstance(output, Exception):
       # Maybe rebuild the environment and start over?
       raise output
-    return output
+    if output is None:
+      return output
+    return _unpack_output(output)
 
 class AsyncBatchedEnvironmentMP:
   """A set of asynchronous environments with batched input/output."""
@@ -0,0 +1,353 @@
+"""Caches of decoded games.
+
+MemoryGameCache keeps recently used decoded games in memory under a byte
+budget, so that e.g. both perspectives of a swapped replay share one decode.
+
+DiskGameCache stores each game uncompressed in a flat, fixed-layout binary
+file, one contiguous column per Game leaf. Reads memory-map the file, so
+slicing a chunk out of a cached game is just a set of numpy views with no
+decompression or copying. Leaves outside a column projection aren't
+stored at all.
+
+SharedGameArena decodes a whole dataset up front into one shared-memory
+block, which any number of worker processes then read without decoding.
+"""
+
+import collections
+from concurrent import futures
+import os
+import tempfile
+import threading
+from typing import Callable, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from slippi_ai import shm, utils
+from slippi_ai.types import Game
+
+_GAME_TEMPLATE: Game = utils.reify_tuple_type(Game)
+
+def flatten_game(game: Game) -> list[np.ndarray]:
+  return utils.flatten_nt(game)
+
+def unflatten_game(leaves: list[np.ndarray]) -> Game:
+  return utils.unflatten_nt(_GAME_TEMPLATE, leaves)
+
+LEAF_DTYPES = [np.dtype(t) for t in flatten_game(_GAME_TEMPLATE)]
+
+# The file starts with the number of frames and a flag per leaf for whether
+# it is stored; columns are 8-byte aligned. Leaves outside a column projection
+# (zero-strided placeholders) aren't stored, and read back as placeholders.
+_HEADER_DTYPE = np.dtype(np.uint64)
+_STORED_DTYPE = np.dtype(np.uint8)
+_ALIGNMENT = 8
+
+_TMP_PREFIX = '.tmp'
+# Bumped when the file layout changes; files in older layouts are never read,
+# and eventually evicted.
+_FORMAT_SUFFIX = '.v2'
+
+def _align(n: int) -> int:
+  return -(-n // _ALIGNMENT) * _ALIGNMENT
+
+def _column_offsets(num_frames: int, stored: Sequence[bool]) -> list[int]:
+  offsets = []
+  offset = _align(_HEADER_DTYPE.itemsize + len(LEAF_DTYPES))
+  for dtype, store in zip(LEAF_DTYPES, stored):
+    offsets.append(offset)
+    if store:
+      offset = _align(offset + num_frames * dtype.itemsize)
+  offsets.append(offset)  # total file size
+  return offsets
+
+def write_flat_game(path: str, game: Game):
+  num_frames = len(game.stage)
+  leaves = flatten_game(game)
+  stored = [leaf.strides[0] != 0 for leaf in leaves]
+  offsets = _column_offsets(num_frames, stored)
+  buffer = np.zeros([offsets[-1]], dtype=np.uint8)
+  buffer[:_HEADER_DTYPE.itemsize].view(_HEADER_DTYPE)[0] = num_frames
+  buffer[_HEADER_DTYPE.itemsize:][:len(stored)] = stored
+
+  for leaf, dtype, store, offset in zip(leaves, LEAF_DTYPES, stored, offsets):
+    if not store:
+      continue
+    size = num_frames * dtype.itemsize
+    column = np.ascontiguousarray(leaf, dtype=dtype)
+    buffer[offset:offset + size] = column.view(np.uint8)
+
+  # Write then rename so that concurrent readers never see a partial file.
+  fd, tmp_path = tempfile.mkstemp(
+      dir=os.path.dirname(path), prefix=_TMP_PREFIX)
+  with os.fdopen(fd, 'wb') as f:
+    f.write(buffer.data)
+  os.replace(tmp_path, path)
+
+def read_flat_game(path: str) -> Game:
+  """Memory-maps a game; the returned arrays are read-only views."""
+  buffer = np.memmap(path, dtype=np.uint8, mode='r')
+  num_frames = int(buffer[:_HEADER_DTYPE.itemsize].view(_HEADER_DTYPE)[0])
+  stored = buffer[_HEADER_DTYPE.itemsize:][:len(LEAF_DTYPES)].astype(bool)
+  offsets = _column_offsets(num_frames, stored)
+
+  leaves = []
+  for dtype, store, offset in zip(LEAF_DTYPES, stored, offsets):
+    if store:
+      size = num_frames * dtype.itemsize
+      leaves.append(buffer[offset:offset + size].view(dtype))
+    else:
+      leaves.append(np.broadcast_to(np.zeros((), dtype), [num_frames]))
+  return unflatten_game(leaves)
+
+def game_nbytes(game: Game) -> int:
+  # Zero-strided placeholder columns don't take up any memory.
+  return sum(leaf.nbytes for leaf in flatten_game(game) if leaf.strides[0])
+
+class MemoryGameCache:
+  """In-memory LRU cache of decoded games with a byte budget; thread-safe."""
+
+  def __init__(self, max_size_gb: float):
+    self.max_size = max_size_gb * 1024 ** 3
+    self._games: collections.OrderedDict[str, Game] = collections.OrderedDict()
+    self._sizes: dict[str, int] = {}
+    self._lock = threading.Lock()
+    self.size = 0
+
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key: str) -> Optional[Game]:
+    with self._lock:
+      game = self._games.get(key)
+      if game is None:
+        self.misses += 1
+        return None
+      self._games.move_to_end(key)
+      self.hits += 1
+      return game
+
+  def put(self, key: str, game: Game):
+    size = game_nbytes(game)
+    if size > self.max_size:
+      return
+
+    with self._lock:
+      if key in self._games:
+        return
+
+      self._games[key] = game
+      self._sizes[key] = size
+      self.size += size
+
+      while self.size > self.max_size:
+        old_key, _ = self._games.popitem(last=False)
+        self.size -= self._sizes.pop(old_key)
+
+  def __len__(self) -> int:
+    return len(self._games)
+
+class DiskGameCache:
+  """Local-disk cache of decoded games with a size budget and LRU eviction.
+
+  The cache directory may be shared by several processes. File modification
+  times serve as the LRU clock, and each process tracks the cache size
+  approximately, rescanning the directory whenever it needs to evict.
+  """
+
+  def __init__(self, cache_dir: str, max_size_gb: float):
+    self.cache_dir = cache_dir
+    self.max_size = max_size_gb * 1024 ** 3
+    os.makedirs(cache_dir, exist_ok=True)
+    self._size = self._scan_size()
+
+    self.hits = 0
+    self.misses = 0
+
+  def _path(self, key: str) -> str:
+    return os.path.join(self.cache_dir, key + _FORMAT_SUFFIX)
+
+  def _scan(self) -> list[os.DirEntry]:
+    return [
+        e for e in os.scandir(self.cache_dir)
+        if e.is_file() and not e.name.startswith(_TMP_PREFIX)]
+
+  def _scan_size(self) -> int:
+    return sum(e.stat().st_size for e in self._scan())
+
+  def get(self, key: str) -> Optional[Game]:
+    path = self._path(key)
+    try:
+      game = read_flat_game(path)
+      os.utime(path)  # mark as recently used
+    except FileNotFoundError:
+      # Might also have been evicted by another process.
+      self.misses += 1
+      return None
+    self.hits += 1
+    return game
+
+  def put(self, key: str, game: Game):
+    path = self._path(key)
+    try:
+      # Replacing an entry, e.g. one that another process just wrote.
+      old_size = os.path.getsize(path)
+    except FileNotFoundError:
+      old_size = 0
+    write_flat_game(path, game)
+    self._size += os.path.getsize(path) - old_size
+
+    if self._size > self.max_size:
+      self.evict()
+
+  def evict(self, target_fraction: float = 0.9):
+    """Removes least recently used games until under the target size."""
+    entries = []
+    for entry in self._scan():
+      try:
+        stat = entry.stat()
+      except FileNotFoundError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    entries.sort()
+    size = sum(size for _, size, _ in entries)
+    target_size = target_fraction * self.max_size
+
+    for _, file_size, path in entries:
+      if size <= target_size:
+        break
+      try:
+        # Existing memory maps of this file remain valid.
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      size -= file_size
+
+    self._size = size
+
+class _ArenaArrays(NamedTuple):
+  keys: np.ndarray  # bytes, sorted
+  starts: np.ndarray  # first frame of each game
+  lengths: np.ndarray
+  leaves: tuple  # stored leaves, all games concatenated
+
+class SharedGameArena:
+  """Decoded games packed into one shared-memory block, with an index.
+
+  Each stored Game leaf is a single column with every game concatenated, so
+  reading a game is a set of read-only numpy views. Leaves that aren't
+  stored (e.g. outside a column projection) read as zero placeholders.
+
+  The creating process owns the block. Pickling an arena (e.g. passing it
+  to a worker process) attaches to the same block rather than copying it.
+  Games read from an arena are views, only valid while the arena is alive.
+  """
+
+  def __init__(
+      self,
+      ring: shm.SharedRing[_ArenaArrays],
+      stored: Sequence[bool],
+  ):
+    self._ring = ring
+    self.stored = tuple(stored)
+    self._arrays: _ArenaArrays = ring[0]
+    for leaf in utils.flatten_nt(self._arrays):
+      leaf.flags.writeable = False
+
+  @classmethod
+  def build(
+      cls,
+      keys: Sequence[str],
+      num_frames: Sequence[int],
+      decode: Callable[[str], Game],
+      stored: Optional[Sequence[bool]] = None,
+      num_threads: int = 8,
+  ) -> 'SharedGameArena':
+    """Decodes the given games in parallel into a new arena.
+
+    Args:
+      keys: Identify the games, e.g. their paths.
+      num_frames: The length of each game, to lay out the arena up front.
+      decode: Decodes the game with the given key.
+      stored: Which Game leaves to store; defaults to all.
+      num_threads: Decoding threads; zlib and Arrow release the GIL.
+    """
+    if stored is None:
+      stored = [True] * len(LEAF_DTYPES)
+
+    encoded_keys = np.array([key.encode('utf-8') for key in keys], dtype=bytes)
+    order = np.argsort(encoded_keys, kind='stable')
+    sorted_keys = encoded_keys[order]
+    lengths = np.asarray(num_frames, dtype=np.int64)[order]
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    total_frames = int(np.sum(lengths))
+
+    spec = _ArenaArrays(
+        keys=shm.ArraySpec(sorted_keys.shape, sorted_keys.dtype),
+        starts=shm.ArraySpec(starts.shape, starts.dtype),
+        lengths=shm.ArraySpec(lengths.shape, lengths.dtype),
+        leaves=tuple(
+            shm.ArraySpec((total_frames,), dtype)
+            for dtype, store in zip(LEAF_DTYPES, stored) if store),
+    )
+    ring = shm.SharedRing(shm.NestLayout(spec), 1)
+    arrays = ring[0]
+    arrays.keys[:] = sorted_keys
+    arrays.starts[:] = starts
+    arrays.lengths[:] = lengths
+
+    def fill(i: int):
+      key = sorted_keys[i].decode('utf-8')
+      leaves = [
+          leaf for leaf, store in zip(flatten_game(decode(key)), stored)
+          if store]
+      if len(leaves[0]) != lengths[i]:
+        raise ValueError(
+            f'{key} has {len(leaves[0])} frames, expected {lengths[i]}.')
+      frames = slice(starts[i], starts[i] + lengths[i])
+      for dst, src in zip(arrays.leaves, leaves):
+        dst[frames] = src
+
+    try:
+      with futures.ThreadPoolExecutor(num_threads) as pool:
+        # list() to raise any decoding errors.
+        list(pool.map(fill, range(len(sorted_keys))))
+    except BaseException:
+      ring.unlink()
+      raise
+
+    return cls(ring, stored)
+
+  def __len__(self) -> int:
+    return len(self._arrays.keys)
+
+  @property
+  def nbytes(self) -> int:
+    return self._ring.layout.nbytes
+
+  def get(self, key: str) -> Optional[Game]:
+    keys = self._arrays.keys
+    encoded = key.encode('utf-8')
+    i = int(np.searchsorted(keys, encoded))
+    if i == len(keys) or keys[i] != encoded:
+      return None
+
+    start = self._arrays.starts[i]
+    length = self._arrays.lengths[i]
+    stored_leaves = iter(self._arrays.leaves)
+    leaves = []
+    for dtype, store in zip(LEAF_DTYPES, self.stored):
+      if store:
+        leaves.append(next(stored_leaves)[start:start + length])
+      else:
+        leaves.append(np.broadcast_to(np.zeros((), dtype), [length]))
+    return unflatten_game(leaves)
+
+  def unlink(self):
+    self._ring.unlink()
+
+  def __getstate__(self):
+    return dict(ring=self._ring, stored=self.stored)
+
+  def __setstate__(self, state):
+    self.__init__(**state)
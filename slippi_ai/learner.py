@@ -1,7 +1,6 @@
 import dataclasses
 from typing import List, Optional
 
-import numpy as np
 import sonnet as snt
 import tensorflow as tf
 
@@ -59,17 +58,25 @@ class Learner:
 
   def _step(
       self,
-      bm_frames: Frames,
+      frames: Frames,
       # batch: Batch,
       initial_states: RecurrentState,
       train: bool = True,
+      time_major: bool = False,
   ):
     policy_initial_states, value_initial_states = initial_states
     del initial_states
 
-    # switch axes to time-major
-    tm_frames: Frames = tf.nest.map_structure(
-        swap_axes, bm_frames)
+    # Data sources may send narrower dtypes than the embedding expects.
+    frames = frames._replace(
+        state_action=self.policy.embed_state_action.widen(
+            frames.state_action))
+
+    if time_major:
+      tm_frames = frames
+    else:
+      # switch axes to time-major
+      tm_frames: Frames = tf.nest.map_structure(swap_axes, frames)
 
     with tf.GradientTape() as tape:
       policy_loss, policy_final_states, policy_metrics = self.policy.imitation_loss(
@@ -114,21 +121,49 @@ class Learner:
 
     return metrics, final_states
 
+  def preprocess(
+      self,
+      frames: Frames,
+      embedded: bool = False,
+  ) -> Frames:
+    """Host-side preparation of a batch's frames before the compiled step.
+
+    Args:
+      embedded: Whether the data source already applied the embedding's
+        from_state_narrow to the state-actions.
+    """
+    if embedded:
+      return frames
+
+    return frames._replace(
+        state_action=self.policy.embed_state_action.from_state(
+            frames.state_action))
+
   def step(
       self,
       batch: Batch,
       initial_states: RecurrentState,
       train: bool = True,
       compile: Optional[bool] = None,
+      time_major: bool = False,
+      preprocessed: bool = False,
+      embedded: bool = False,
   ):
+    """Takes a training step.
+
+    Args:
+      time_major: Whether the batch frames are laid out [T, B], as produced by
+        a time-major data source, rather than [B, T].
+      preprocessed: Whether the frames already went through preprocess, e.g.
+        in a tf_data.TFDataSource.
+      embedded: Whether the data source already embedded the frames, see
+        preprocess.
+    """
     compile = compile if compile is not None else self.compile
     step = self._compiled_step if compile else self._step
 
-    frames = batch.frames._replace(
-        state_action=self.policy.embed_state_action.from_state(
-            batch.frames.state_action))
-
-    if np.any(frames.is_resetting[:, 1:]):
-      raise ValueError("Unexpected mid-episode reset.")
+    frames = batch.frames
+    if not preprocessed:
+      frames = self.preprocess(frames, embedded)
 
-    return step(frames, initial_states, train=train)
+    return step(frames, initial_states, train=train, time_major=time_major)
@@ -0,0 +1,160 @@
+"""Columnar index of replay metadata, for fast dataset selection.
+
+meta.json is a list of nested dicts, which is slow to load and filter for
+millions of replays. The index is a parquet file with one row per game and
+typed columns, including each player's resolved and normalized name. Dataset
+selection is then a handful of vectorized predicates, with the character
+filters pushed down into the parquet reader.
+
+python slippi_db/scripts/make_meta_index.py --meta_path=Root/meta.json
+"""
+
+from typing import Iterable, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from slippi_ai import nametags
+
+INDEX_SUFFIX = '.parquet'
+
+PLAYERS = ('p0', 'p1')
+
+def _player_fields(player: str) -> list[tuple[str, pa.DataType]]:
+  return [
+      (f'{player}_character', pa.uint8()),
+      (f'{player}_name', pa.string()),
+      (f'{player}_normalized_name', pa.string()),
+      (f'{player}_damage_taken', pa.float32()),
+  ]
+
+SCHEMA = pa.schema([
+    ('slp_md5', pa.string()),
+    ('stage', pa.uint8()),
+    ('num_frames', pa.int32()),
+    # Port of the winner, if known.
+    ('winner', pa.int8()),
+    # (id, game, tiebreaker) for games played as part of a match.
+    ('match_id', pa.string()),
+    ('raw', pa.string()),
+    *_player_fields('p0'),
+    *_player_fields('p1'),
+])
+
+# Games start on frame -123.
+FIRST_FRAME = -123
+
+def is_index_path(path: str) -> bool:
+  return str(path).endswith(INDEX_SUFFIX)
+
+def _match_id(row: dict) -> Optional[str]:
+  match = row.get('match')
+  if match is None:
+    return None
+  return f"{match['id']}/{match['game']}/{match['tiebreaker']}"
+
+def build_index(meta_rows: Iterable[dict]) -> pa.Table:
+  """Converts meta.json rows into an index table."""
+  columns = {field.name: [] for field in SCHEMA}
+
+  for row in meta_rows:
+    columns['slp_md5'].append(row['slp_md5'])
+    columns['stage'].append(row['stage'])
+    columns['num_frames'].append(row['lastFrame'] - FIRST_FRAME + 1)
+    columns['winner'].append(row.get('winner'))
+    columns['match_id'].append(_match_id(row))
+    columns['raw'].append(row['raw'])
+
+    for player, player_meta in zip(PLAYERS, row['players']):
+      name = nametags.name_from_metadata(player_meta, raw=row['raw'])
+      columns[f'{player}_character'].append(player_meta['character'])
+      columns[f'{player}_name'].append(name)
+      columns[f'{player}_normalized_name'].append(nametags.normalize_name(name))
+      columns[f'{player}_damage_taken'].append(player_meta.get('damage_taken'))
+
+  return pa.Table.from_pydict(columns, schema=SCHEMA)
+
+def write_index(path: str, table: pa.Table):
+  # Names, stages and raw archives repeat a lot.
+  pq.write_table(table, path, use_dictionary=True)
+
+def read_index(
+    path: str,
+    allowed_characters: Optional[set[int]] = None,
+    allowed_opponents: Optional[set[int]] = None,
+    swap: bool = True,
+) -> pa.Table:
+  """Reads the index, skipping games that fail the character filters.
+
+  Args:
+    path: The index file.
+    allowed_characters: Characters the main player may play; None means all.
+    allowed_opponents: Characters the opponent may play; None means all.
+    swap: Whether either player may be the main player.
+  """
+  filters = []
+  for main, opponent in [PLAYERS, PLAYERS[::-1]][:2 if swap else 1]:
+    conjunction = []
+    if allowed_characters is not None:
+      conjunction.append(
+          (f'{main}_character', 'in', sorted(allowed_characters)))
+    if allowed_opponents is not None:
+      conjunction.append(
+          (f'{opponent}_character', 'in', sorted(allowed_opponents)))
+    if conjunction:
+      filters.append(conjunction)
+
+  return pq.read_table(path, filters=filters or None)
+
+def _is_in(array: pa.ChunkedArray, values: Iterable) -> np.ndarray:
+  value_set = pa.array(sorted(values), type=array.type)
+  return pc.is_in(array, value_set=value_set).to_numpy(zero_copy_only=False)
+
+def perspective_masks(
+    table: pa.Table,
+    allowed_characters: set[int],
+    allowed_opponents: set[int],
+    allowed_names: Optional[set[str]] = None,
+    banned_names: Iterable[str] = (),
+    swap: bool = True,
+) -> dict[bool, np.ndarray]:
+  """Which games to use from each perspective, as in data.replays_from_meta.
+
+  Args:
+    table: The index.
+    allowed_characters: Characters the main player may play.
+    allowed_opponents: Characters the opponent may play.
+    allowed_names: Names the main player may have; None means all.
+    banned_names: Names the main player may not have.
+    swap: Whether to consider both perspectives. If False, only the
+      unswapped perspective is used, and no player may have a banned name.
+  Returns:
+    A dict mapping swap to a boolean mask over the rows of the table.
+  """
+  is_banned = {
+      player: _is_in(
+          table[f'{player}_normalized_name'], nametags.BANNED_NAMES)
+      for player in PLAYERS
+  }
+
+  if not swap:
+    mask = (
+        _is_in(table['p0_character'], allowed_characters)
+        & _is_in(table['p1_character'], allowed_opponents)
+        & ~is_banned['p0'] & ~is_banned['p1'])
+    return {False: mask}
+
+  masks = {}
+  for swap_, (main, opponent) in [(False, PLAYERS), (True, PLAYERS[::-1])]:
+    names = table[f'{main}_normalized_name']
+    mask = (
+        _is_in(table[f'{main}_character'], allowed_characters)
+        & _is_in(table[f'{opponent}_character'], allowed_opponents)
+        & ~is_banned[main]
+        & ~_is_in(names, banned_names))
+    if allowed_names is not None:
+      mask &= _is_in(names, allowed_names)
+    masks[swap_] = mask
+  return masks
@@ -0,0 +1,200 @@
+"""Pack files: many parsed games appended into a few large files.
+
+A pack directory looks like
+
+PackDir
+  index.parquet
+  <pack>.pack
+  ...
+
+Each game is stored as the exact bytes of its Parsed/<md5> file, so the
+same decoding (and compression) applies. The index maps each md5 to
+(pack, offset, length, num_frames), which lets us enumerate and filter games
+without listing a directory with millions of entries, and read a game with a
+single positioned read on an already-open file.
+"""
+
+import collections
+import os
+import threading
+from typing import Callable, Iterable, NamedTuple, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import melee
+
+from slippi_ai import compression
+
+INDEX_FILE = 'index.parquet'
+PACK_SUFFIX = '.pack'
+
+class PackEntry(NamedTuple):
+  pack: str
+  offset: int
+  length: int
+  num_frames: int
+
+INDEX_SCHEMA = pa.schema([
+    ('md5', pa.string()),
+    ('pack', pa.string()),
+    ('offset', pa.int64()),
+    ('length', pa.int64()),
+    ('num_frames', pa.int32()),
+])
+
+def is_pack_dir(path: str) -> bool:
+  return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+def write_index(pack_dir: str, index: dict[str, PackEntry]):
+  md5s = sorted(index)
+  columns = dict(md5=md5s)
+  for field in PackEntry._fields:
+    columns[field] = [getattr(index[md5], field) for md5 in md5s]
+  table = pa.Table.from_pydict(columns, schema=INDEX_SCHEMA)
+  # Pack names repeat a lot, so dictionary encoding keeps the index small.
+  pq.write_table(table, os.path.join(pack_dir, INDEX_FILE), use_dictionary=True)
+
+def read_index(pack_dir: str) -> dict[str, PackEntry]:
+  columns = pq.read_table(os.path.join(pack_dir, INDEX_FILE)).to_pydict()
+  entries = zip(*[columns[field] for field in PackEntry._fields])
+  return {md5: PackEntry(*entry) for md5, entry in zip(columns['md5'], entries)}
+
+def pack_path(pack_dir: str, pack: str) -> str:
+  return os.path.join(pack_dir, pack + PACK_SUFFIX)
+
+class PackWriter:
+  """Appends games to a single pack file."""
+
+  def __init__(self, pack_dir: str, name: str):
+    self.name = name
+    self._file = open(pack_path(pack_dir, name), 'wb')
+    self.size = 0
+
+  def add(self, contents: bytes, num_frames: int) -> PackEntry:
+    entry = PackEntry(self.name, self.size, len(contents), num_frames)
+    self._file.write(contents)
+    self.size += len(contents)
+    return entry
+
+  def close(self):
+    self._file.close()
+
+class PackReader:
+  """Reads games from a pack directory.
+
+  Keeps one open file descriptor per pack, so each process that reads from
+  the packs should create its own PackReader. Reads are thread-safe.
+  """
+
+  def __init__(self, pack_dir: str):
+    self._fds: dict[str, int] = {}
+    self._maps: dict[str, pa.MemoryMappedFile] = {}
+    self._lock = threading.Lock()
+    self.pack_dir = pack_dir
+    self.index = read_index(pack_dir)
+
+  def _get_fd(self, pack: str) -> int:
+    with self._lock:
+      fd = self._fds.get(pack)
+      if fd is None:
+        fd = os.open(pack_path(self.pack_dir, pack), os.O_RDONLY)
+        self._fds[pack] = fd
+      return fd
+
+  def read(self, md5: str) -> bytes:
+    entry = self.index[md5]
+    contents = os.pread(self._get_fd(entry.pack), entry.length, entry.offset)
+    if len(contents) != entry.length:
+      raise IOError(f'Short read of {md5} from pack {entry.pack}.')
+    return contents
+
+  def buffer(self, md5: str) -> pa.Buffer:
+    """A zero-copy view of the game's bytes in a memory-mapped pack.
+
+    Unlike read, nothing is read from disk until the bytes are accessed, so
+    parquet readers only page in the parts of the game they decode.
+    """
+    entry = self.index[md5]
+    with self._lock:
+      pack_map = self._maps.get(entry.pack)
+      if pack_map is None:
+        pack_map = pa.memory_map(pack_path(self.pack_dir, entry.pack))
+        self._maps[entry.pack] = pack_map
+    return pack_map.read_at(entry.length, entry.offset)
+
+  def close(self):
+    for fd in self._fds.values():
+      os.close(fd)
+    self._fds.clear()
+    for pack_map in self._maps.values():
+      pack_map.close()
+    self._maps.clear()
+
+  def __del__(self):
+    self.close()
+
+def num_frames_from_bytes(contents: bytes, compressed: bool) -> int:
+  """Reads the number of frames from the parquet footer."""
+  if compressed:
+    contents = compression.decompress(contents)
+  return pq.ParquetFile(pa.BufferReader(contents)).metadata.num_rows
+
+def matchup_key(meta_row: dict) -> str:
+  """Unordered character pair, so that swapped replays share a partition."""
+  chars = sorted(p['character'] for p in meta_row['players'])
+  return '-'.join(melee.Character(c).name.lower() for c in chars)
+
+def pack_games(
+    data_dir: str,
+    pack_dir: str,
+    md5s: Iterable[str],
+    compressed: bool = True,
+    partition_fn: Optional[Callable[[str], str]] = None,
+    max_pack_size_gb: float = 1.0,
+) -> dict[str, PackEntry]:
+  """Appends the given games from data_dir into packs under pack_dir.
+
+  Args:
+    data_dir: Directory of parsed games, one file per md5.
+    pack_dir: Output directory for the packs and index.
+    md5s: Which games to pack.
+    compressed: Whether the games are compressed (see compression.py).
+    partition_fn: Maps an md5 to a partition name. Each pack only contains
+      games from a single partition.
+    max_pack_size_gb: Start a new pack once the current one exceeds this.
+  Returns:
+    The index, which is also written to pack_dir.
+  """
+  os.makedirs(pack_dir, exist_ok=True)
+  max_pack_size = max_pack_size_gb * 1024 ** 3
+
+  writers: dict[str, PackWriter] = {}
+  pack_counts = collections.Counter()
+  index: dict[str, PackEntry] = {}
+
+  for md5 in md5s:
+    partition = partition_fn(md5) if partition_fn else 'games'
+
+    writer = writers.get(partition)
+    if writer is not None and writer.size >= max_pack_size:
+      writer.close()
+      writer = None
+
+    if writer is None:
+      name = f'{partition}-{pack_counts[partition]:04d}'
+      pack_counts[partition] += 1
+      writer = PackWriter(pack_dir, name)
+      writers[partition] = writer
+
+    with open(os.path.join(data_dir, md5), 'rb') as f:
+      contents = f.read()
+
+    index[md5] = writer.add(
+        contents, num_frames_from_bytes(contents, compressed))
+
+  for writer in writers.values():
+    writer.close()
+
+  write_index(pack_dir, index)
+  return index
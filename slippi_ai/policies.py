@@ -10,7 +10,7 @@ from slippi_ai.controller_heads import (
     DistanceOutputs,
     SampleOutputs,
 )
-from slippi_ai.rl_lib import discounted_returns
+from slippi_ai.rl_lib import cut_at_resets, discounted_returns
 from slippi_ai import data, networks, embed, types, tf_utils
 from slippi_ai.value_function import ValueOutputs
 
@@ -77,12 +77,16 @@ class Policy(snt.Module):
     self.imitation_loss(dummy_frames, initial_state)
 
   def _value_outputs(
-      self, outputs, last_input, is_resetting, final_state, rewards, discount):
+      self, outputs, last_input, is_resetting, final_state, rewards, discount,
+      reward_is_resetting=None):
     values = tf.squeeze(self.value_head(outputs), -1)
     last_output, _ = self.network.step_with_reset(
-        last_input, is_resetting, final_state)
+        last_input, is_resetting[-1], final_state)
     last_value = tf.squeeze(self.value_head(last_output), -1)
     discounts = tf.fill(tf.shape(rewards), tf.cast(discount, tf.float32))
+    if reward_is_resetting is None:
+      reward_is_resetting = is_resetting
+    discounts = cut_at_resets(discounts, reward_is_resetting)
     value_targets = discounted_returns(
         rewards=rewards,
         discounts=discounts,
@@ -113,6 +117,7 @@ class Policy(snt.Module):
       frames: data.Frames,
       initial_state: RecurrentState,
       discount: float = 0.99,
+      reward_is_resetting: tp.Optional[tf.Tensor] = None,
   ) -> UnrollOutputs:
     """Computes prediction loss on a batch of frames.
 
@@ -124,6 +129,8 @@ class Policy(snt.Module):
       initial_state: Batch of initial recurrent states.
       value_cost: Weighting of value function loss.
       discount: Per-frame discount factor for returns.
+      reward_is_resetting: Game starts aligned with the delayed rewards, at
+        which returns are cut; defaults to frames.is_resetting.
     """
     all_inputs = self.embed_state_action(frames.state_action)
     inputs, last_input = all_inputs[:-1], all_inputs[-1]
@@ -149,8 +156,8 @@ class Policy(snt.Module):
     )
 
     value_outputs = self._value_outputs(
-        outputs, last_input, frames.is_resetting[-1], final_state,
-        frames.reward, discount)
+        outputs, last_input, frames.is_resetting, final_state,
+        frames.reward, discount, reward_is_resetting)
     metrics['value'] = value_outputs.metrics
 
     return UnrollOutputs(
@@ -160,6 +167,14 @@ class Policy(snt.Module):
         final_state=final_state,
         metrics=metrics)
 
+  def _same_game_mask(
+      self, is_resetting: tf.Tensor, num_outputs: int) -> tf.Tensor:
+    """Whether frames [t, t + D + 1] all belong to the same game."""
+    crosses_reset = tf.zeros_like(is_resetting[:num_outputs])
+    for i in range(1, self.delay + 2):
+      crosses_reset |= is_resetting[i:i + num_outputs]
+    return 1. - tf.cast(crosses_reset, tf.float32)
+
   def imitation_loss(
       self,
       frames: data.Frames,
@@ -174,10 +189,19 @@ class Policy(snt.Module):
     # actions being [D, U + D - 1]). The final hidden state should be the one
     # preceding timestep U, meaning we compute it from game states [0, U-1]. We
     # will use game state U to bootstrap the value function.
+    #
+    # Chunks may also span several games, with is_resetting marking the first
+    # frame of each. The network resets its state there, and predictions whose
+    # target action [t + D + 1] lies in a later game than state t are masked,
+    # as are their value losses. Returns are cut where the delayed rewards
+    # cross into the next game.
 
     state_action = frames.state_action
     # Includes "overlap" frame.
     unroll_length = state_action.state.stage.shape[0] - self.delay
+    valid = self._same_game_mask(frames.is_resetting, unroll_length - 1)
+
+    reward_is_resetting = frames.is_resetting[self.delay:]
 
     frames = data.Frames(
         state_action=embed.StateAction(
@@ -195,13 +219,16 @@ class Policy(snt.Module):
     unroll_outputs = self.unroll(
         frames, initial_state,
         discount=discount,
+        reward_is_resetting=reward_is_resetting,
     )
 
     metrics = unroll_outputs.metrics
 
-    total_loss = -tf.reduce_mean(unroll_outputs.log_probs)
+    num_valid = tf.maximum(tf.reduce_sum(valid), 1.)
+    total_loss = -tf.reduce_sum(unroll_outputs.log_probs * valid) / num_valid
     if self.train_value_head:
-      value_loss = tf.reduce_mean(unroll_outputs.value_outputs.loss)
+      value_loss = tf.reduce_sum(
+          unroll_outputs.value_outputs.loss * valid) / num_valid
       total_loss += value_cost * value_loss
 
     metrics.update(
@@ -240,7 +267,7 @@ class Policy(snt.Module):
 
     # We're only really doing this to initialize the value_head...
     value_outputs = self._value_outputs(
-        outputs, last_input, frames.is_resetting[-1], final_state,
+        outputs, last_input, frames.is_resetting, final_state,
         frames.reward, discount)
     metrics['value'] = value_outputs.metrics
 
@@ -355,20 +355,29 @@ class Learner:
       initial_states: RecurrentState,
       train: bool = True,
       compile: bool = True,
+      time_major: bool = False,
+      embedded: bool = False,
   ) -> tuple[dict, RecurrentState]:
     del compile  # TODO: use this
 
     # Here we assume that the sample policy, q function, and q policy all have
     # the same state and action embeddings.
-    frames = batch.frames._replace(
-        state_action=self.sample_policy.embed_state_action.from_state(
-            batch.frames.state_action))
-
-    # switch axes to time-major
-    tm_frames: Frames = tf.nest.map_structure(
-        lambda a: np.swapaxes(a, 0, 1), frames)
+    embed_state_action = self.sample_policy.embed_state_action
+    frames = batch.frames
+    if not embedded:
+      frames = frames._replace(
+          state_action=embed_state_action.from_state(frames.state_action))
+
+    if time_major:
+      tm_frames = frames
+    else:
+      # switch axes to time-major
+      tm_frames: Frames = tf.nest.map_structure(
+          lambda a: np.swapaxes(a, 0, 1), frames)
     # Put on device memory once.
     tm_frames: Frames = tf.nest.map_structure(tf.convert_to_tensor, tm_frames)
+    tm_frames = tm_frames._replace(
+        state_action=embed_state_action.widen(tm_frames.state_action))
 
     # tm_batch = batch._replace(frames=tm_frames)
     # tm_batch: Batch = tf.nest.map_structure(tf.convert_to_tensor, tm_batch)
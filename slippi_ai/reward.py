@@ -100,6 +100,14 @@ def find_offstage_shine_stalls(player: Player, stage: np.ndarray):
       is_stalling_offstage(player, stage),
       is_aerial_shine(player))
 
+# The Game leaves read by compute_rewards.
+REQUIRED_PLAYER_FIELDS = ('action', 'percent', 'x', 'y', 'invulnerable')
+REQUIRED_PATHS = [
+    (player, field)
+    for player in ('p0', 'p1')
+    for field in REQUIRED_PLAYER_FIELDS
+] + [('stage',)]
+
 @dataclasses.dataclass
 class RewardConfig:
   damage_ratio: float = 0.01
@@ -20,3 +20,19 @@ def discounted_returns(
     The discounted returns, of shape [T, B].
   """
   return tf.scan(_bellman, (rewards, discounts), bootstrap, reverse=True)
+
+def cut_at_resets(
+    discounts: tf.Tensor,
+    is_resetting: tf.Tensor,
+) -> tf.Tensor:
+  """Zeroes the discounts of steps that are followed by a new episode.
+
+  Args:
+    discounts: The discount factors at each step. Shape [T, B].
+    is_resetting: Whether each frame starts an episode. Shape [T+1, B].
+
+  Returns:
+    Discounts that don't bootstrap across episode boundaries, e.g. in
+    chunks that pack several games back to back.
+  """
+  return tf.where(is_resetting[1:], tf.zeros_like(discounts), discounts)
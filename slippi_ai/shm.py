@@ -0,0 +1,118 @@
+"""Nests of numpy arrays backed by POSIX shared memory."""
+
+import dataclasses
+from multiprocessing import resource_tracker, shared_memory
+from typing import Generic, Optional, TypeVar
+
+import numpy as np
+
+from slippi_ai import utils
+
+T = TypeVar('T')
+
+_ALIGNMENT = 64
+
+def _align(n: int) -> int:
+  return -(-n // _ALIGNMENT) * _ALIGNMENT
+
+@dataclasses.dataclass(frozen=True)
+class ArraySpec:
+  shape: tuple[int, ...]
+  dtype: np.dtype
+
+  def allocate(self) -> np.ndarray:
+    return np.empty(self.shape, self.dtype)
+
+  @property
+  def nbytes(self) -> int:
+    return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+class NestLayout(Generic[T]):
+  """Layout of a nest of arrays in a flat buffer.
+
+  The spec is a nest with ArraySpec leaves; each array is stored
+  contiguously.
+  """
+
+  def __init__(self, spec: T):
+    self.spec = spec
+
+    self.offsets: list[int] = []
+    offset = 0
+    for leaf in utils.flatten_nt(spec):
+      self.offsets.append(offset)
+      offset = _align(offset + leaf.nbytes)
+    self.nbytes = offset
+
+  def views(self, buffer, offset: int = 0) -> T:
+    """Views into buffer, starting at the given byte offset."""
+    leaves = [
+        np.ndarray(
+            leaf.shape, leaf.dtype, buffer=buffer, offset=offset + leaf_offset)
+        for leaf, leaf_offset in zip(utils.flatten_nt(self.spec), self.offsets)
+    ]
+    return utils.unflatten_nt(self.spec, leaves)
+
+class SharedRing(Generic[T]):
+  """A ring of preallocated nests in one shared-memory block.
+
+  The creating process owns the block. Pickling a ring (e.g. passing it to
+  a worker process) attaches to the same block rather than copying it.
+  """
+
+  def __init__(
+      self,
+      layout: NestLayout[T],
+      num_slots: int,
+      name: Optional[str] = None,
+  ):
+    self.layout = layout
+    self.num_slots = num_slots
+    create = name is None
+    self._owner = False
+    self._shm = shared_memory.SharedMemory(
+        name=name, create=create,
+        size=max(1, layout.nbytes * num_slots))
+    self._owner = create
+    self._slots = [
+        layout.views(self._shm.buf, i * layout.nbytes)
+        for i in range(num_slots)]
+
+  @classmethod
+  def attach(
+      cls, layout: NestLayout[T], num_slots: int, name: str,
+  ) -> 'SharedRing[T]':
+    """Attaches to a ring created by an unrelated process, e.g. a server.
+
+    Unlike rings passed to child processes, this process' resource tracker
+    then mustn't unlink the block when we exit; the creator owns it.
+    """
+    ring = cls(layout, num_slots, name)
+    resource_tracker.unregister(ring._shm._name, 'shared_memory')
+    return ring
+
+  @property
+  def name(self) -> str:
+    return self._shm.name
+
+  def __getitem__(self, slot: int) -> T:
+    return self._slots[slot]
+
+  def __reduce__(self):
+    return SharedRing, (self.layout, self.num_slots, self.name)
+
+  def unlink(self):
+    """Frees the block once every process has unmapped it."""
+    if self._owner:
+      self._owner = False
+      self._shm.unlink()
+
+  def __del__(self):
+    self.unlink()
+
+def shared_copy(nest: T) -> SharedRing[T]:
+  """Copies a nest of arrays into a new single-slot SharedRing."""
+  spec = utils.map_nt(lambda x: ArraySpec(x.shape, x.dtype), nest)
+  ring = SharedRing(NestLayout(spec), 1)
+  utils.map_nt(np.copyto, ring[0], nest)
+  return ring
@@ -0,0 +1,60 @@
+"""Data sources for the named streams of a trainer, e.g. train and test."""
+
+from typing import List, Optional, Union
+
+from slippi_ai import batch_server as batch_server_lib
+from slippi_ai import data, worker_pool
+
+def make_sources(
+    streams: dict[str, Union[data.ReplayTable, List[data.ReplayInfo]]],
+    num_workers: int,
+    shared_memory: bool = False,
+    shared_pool: bool = False,
+    cursors: Optional[dict[str, Optional[dict]]] = None,
+    prefetch: Optional[dict[str, int]] = None,
+    weights: Optional[dict[str, float]] = None,
+    batch_server: Optional[str] = None,
+    dataset: Optional[data.DatasetConfig] = None,
+    **kwargs) -> dict:
+  """Makes a data source for each named set of replays.
+
+  With a batch_server directory, the streams come from that server, which
+  makes the splits of the dataset itself; the streams are then named by
+  split ('train' or 'test') and their replays aren't sent. With shared_pool
+  and workers, they are served by one SharedWorkerPool, which uses prefetch
+  and weights. Otherwise each stream gets its own data.make_source.
+  """
+  cursors = cursors or {}
+  if num_workers and batch_server is None:
+    # Streams split from one table (see train_test_split) share its columns,
+    # so they are only copied into shared memory once.
+    streams = {
+        name: data.as_replay_table(replays, kwargs.get('name_map'))
+        for name, replays in streams.items()}
+    for replays in streams.values():
+      replays.share()
+
+  if batch_server is not None:
+    if dataset is None:
+      raise ValueError('Getting batches from a batch_server needs the dataset.')
+    client = batch_server_lib.BatchClient(batch_server)
+    prefetch = prefetch or {}
+    return {
+        name: client.open(
+            name, dataset, split=name, prefetch=prefetch.get(name, 2),
+            cursor=cursors.get(name), **kwargs)
+        for name in streams
+    }
+
+  if shared_pool and num_workers:
+    pool = worker_pool.SharedWorkerPool(
+        streams, num_workers, shared_memory=shared_memory, cursors=cursors,
+        prefetch=prefetch, weights=weights, **kwargs)
+    return dict(pool.streams)
+
+  return {
+      name: data.make_source(
+          num_workers, shared_memory, replays=replays,
+          cursor=cursors.get(name), **kwargs)
+      for name, replays in streams.items()
+  }
@@ -0,0 +1,128 @@
+"""Compact storage of parsed games.
+
+By default, parsed games store every Game leaf in its in-memory dtype with
+parquet's default encodings. The compact profile instead
+
+- stores sticks and triggers as their raw integer values (see controller_lib),
+- run-length encodes booleans,
+- dictionary-encodes columns with few distinct values, like stage,
+  characters, actions and the raw controller values,
+- delta-encodes percents,
+- byte-stream-splits floats, which helps general-purpose compressors.
+
+Quantization is only applied to a column if it round-trips exactly, and
+readers undo it based on the stored dtypes (see dequantize), so decoding is
+lossless and yields the usual Game dtypes. Floats are not narrowed to
+float16, as positions wouldn't survive the round trip.
+"""
+
+import dataclasses
+import enum
+from typing import Callable, Optional
+
+import numpy as np
+
+from slippi_ai import controller_lib, utils
+from slippi_ai.types import Game, leaf_paths
+
+GamePath = tuple[str, ...]
+
+GAME_PATHS: list[GamePath] = leaf_paths(Game)
+_GAME_TEMPLATE = utils.reify_tuple_type(Game)
+GAME_DTYPES = [np.dtype(t) for t in utils.flatten_nt(_GAME_TEMPLATE)]
+
+class StorageProfile(enum.Enum):
+  DEFAULT = 'default'
+  COMPACT = 'compact'
+
+@dataclasses.dataclass(frozen=True)
+class Quantizer:
+  dtype: np.dtype  # stored dtype
+  encode: Callable[[np.ndarray], np.ndarray]
+  decode: Callable[[np.ndarray], np.ndarray]
+
+def _encode_axis(x: np.ndarray) -> np.ndarray:
+  return controller_lib.to_raw_axis(x).astype(np.int8)
+
+def _decode_axis(raw: np.ndarray) -> np.ndarray:
+  # Matches parse_peppi.to_libmelee_stick applied to peppi's raw / 80.
+  x = raw.astype(np.float32) / np.float32(80)
+  return x / np.float32(2) + np.float32(0.5)
+
+def _encode_trigger(x: np.ndarray) -> np.ndarray:
+  return controller_lib.to_raw_trigger(x).astype(np.uint8)
+
+def _decode_trigger(raw: np.ndarray) -> np.ndarray:
+  return raw.astype(np.float32) / np.float32(140)
+
+AXIS = Quantizer(np.dtype(np.int8), _encode_axis, _decode_axis)
+TRIGGER = Quantizer(np.dtype(np.uint8), _encode_trigger, _decode_trigger)
+
+def _controller_quantizers() -> dict[GamePath, Quantizer]:
+  quantizers = {}
+  for player in ['p0', 'p1']:
+    for stick in ['main_stick', 'c_stick']:
+      for axis in ['x', 'y']:
+        quantizers[(player, 'controller', stick, axis)] = AXIS
+    quantizers[(player, 'controller', 'shoulder')] = TRIGGER
+  return quantizers
+
+QUANTIZERS: dict[GamePath, Quantizer] = _controller_quantizers()
+
+def quantize(game: Game) -> Game:
+  """Stores quantizable leaves as raw values where that is lossless."""
+  leaves = []
+  for path, leaf in zip(GAME_PATHS, utils.flatten_nt(game)):
+    quantizer = QUANTIZERS.get(path)
+    if quantizer is not None:
+      raw = quantizer.encode(leaf)
+      if np.array_equal(quantizer.decode(raw), leaf):
+        leaf = raw
+    leaves.append(leaf)
+  return utils.unflatten_nt(_GAME_TEMPLATE, leaves)
+
+def dequantize_leaf(path: GamePath, leaf: np.ndarray) -> np.ndarray:
+  quantizer = QUANTIZERS.get(path)
+  if quantizer is None or leaf.dtype != quantizer.dtype:
+    return leaf
+  return quantizer.decode(leaf)
+
+def dequantize(game: Game) -> Game:
+  """Inverse of quantize; games stored without quantization are unchanged."""
+  leaves = [
+      dequantize_leaf(path, leaf)
+      for path, leaf in zip(GAME_PATHS, utils.flatten_nt(game))]
+  return utils.unflatten_nt(_GAME_TEMPLATE, leaves)
+
+# Few distinct values; actions also compress better this way than delta
+# encoded, as they change in large jumps.
+_DICTIONARY_FIELDS = ('stage', 'character', 'action', 'jumps_left')
+
+def _column_encoding(path: GamePath, dtype: np.dtype) -> Optional[str]:
+  """Parquet encoding of a leaf, or None for dictionary encoding."""
+  if path[-1] in _DICTIONARY_FIELDS or path in QUANTIZERS:
+    return None
+  if dtype == np.bool_:
+    return 'RLE'
+  if np.issubdtype(dtype, np.floating):
+    return 'BYTE_STREAM_SPLIT'
+  return 'DELTA_BINARY_PACKED'
+
+def parquet_options(
+    profile: StorageProfile,
+    root: str = 'root',
+) -> dict:
+  """Keyword arguments to pq.write_table for a storage profile."""
+  if profile is StorageProfile.DEFAULT:
+    return dict(use_dictionary=False)
+
+  use_dictionary = []
+  column_encoding = {}
+  for path, dtype in zip(GAME_PATHS, GAME_DTYPES):
+    name = '.'.join((root,) + path)
+    encoding = _column_encoding(path, dtype)
+    if encoding is None:
+      use_dictionary.append(name)
+    else:
+      column_encoding[name] = encoding
+  return dict(use_dictionary=use_dictionary, column_encoding=column_encoding)
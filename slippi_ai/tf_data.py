@@ -0,0 +1,117 @@
+"""Serves batches from a data source through a prefetching tf.data pipeline.
+
+Without this, the trainer fetches a batch, runs the embedding's from_state on
+the host and only then launches the compiled step. Here the next batches are
+fetched, preprocessed and (optionally) copied to the accelerator in the
+background while the current step runs.
+
+Only the frames and counts go through tf.data; the chunk metadata, which is
+made of strings and python objects, is kept on the host and rejoined with its
+frames when the batch is taken.
+"""
+
+import dataclasses
+import itertools
+import threading
+from typing import Callable, Iterator, Optional, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+from slippi_ai import utils
+from slippi_ai.data import Batch, ChunkMeta, Frames
+
+@dataclasses.dataclass
+class TFDataConfig:
+  enabled: bool = False
+  # Number of batches to prepare ahead on the host.
+  prefetch: int = 2
+  # If set, e.g. '/gpu:0', batches are also prefetched onto this device.
+  device: Optional[str] = None
+
+def frames_signature(
+    spec: Frames,
+    preprocess: Callable[[Frames], Frames],
+) -> Frames:
+  """TensorSpecs of preprocessed frames.
+
+  The dtypes come from running preprocess (i.e. the embedding's from_state)
+  on an empty batch laid out according to spec.
+  """
+  example = preprocess(utils.map_nt(
+      lambda s: np.zeros(s.shape, s.dtype), spec))
+  return utils.map_nt(
+      lambda x: tf.TensorSpec(x.shape, tf.as_dtype(x.dtype)), example)
+
+class TFDataSource:
+  """Wraps a data source, yielding batches of preprocessed tensors."""
+
+  def __init__(
+      self,
+      data_source: Iterator[Tuple[Batch, float]],
+      spec: Frames,
+      preprocess: Callable[[Frames], Frames],
+      prefetch: int = 2,
+      device: Optional[str] = None,
+  ):
+    """
+    Args:
+      data_source: Yields (batch, epoch) pairs, e.g. a data_lib.DataSource.
+      spec: ArraySpecs of the batch frames, see data_lib.frames_spec.
+      preprocess: Host-side preprocessing, e.g. Learner.preprocess.
+      prefetch: Number of batches to prepare ahead.
+      device: Optionally prefetch batches onto this device.
+    """
+    self.data_source = data_source
+    self.batch_size = data_source.batch_size
+    self.preprocess = preprocess
+
+    # Chunk metadata, epochs and source cursors of batches in flight.
+    self._pending: dict[int, Tuple[ChunkMeta, float, Optional[dict]]] = {}
+    self._cursor: Optional[dict] = data_source.get_cursor()
+    self._lock = threading.Lock()
+    self._ids = itertools.count()
+
+    signature = (
+        frames_signature(spec, preprocess),
+        tf.TensorSpec([self.batch_size], tf.int64),  # count
+        tf.TensorSpec([], tf.int64),  # batch id
+    )
+    dataset = tf.data.Dataset.from_generator(
+        self._generate, output_signature=signature)
+    dataset = dataset.prefetch(prefetch)
+    if device is not None:
+      dataset = dataset.apply(
+          tf.data.experimental.prefetch_to_device(device, buffer_size=1))
+    self._iterator = iter(dataset)
+
+  def _generate(self):
+    while True:
+      batch, epoch = next(self.data_source)
+      cursor = self.data_source.get_cursor()
+      # Sources may reuse their buffers, and from_state may return views.
+      frames = utils.map_nt(np.array, self.preprocess(batch.frames))
+      batch_id = next(self._ids)
+      with self._lock:
+        self._pending[batch_id] = (batch.meta, epoch, cursor)
+      yield frames, batch.count.astype(np.int64), batch_id
+
+  def __iter__(self):
+    return self
+
+  def __next__(self) -> Tuple[Batch, float]:
+    frames, count, batch_id = next(self._iterator)
+    with self._lock:
+      meta, epoch, self._cursor = self._pending.pop(int(batch_id))
+    return Batch(frames=frames, count=count, meta=meta), epoch
+
+  def get_stats(self) -> dict:
+    return self.data_source.get_stats()
+
+  def get_cursor(self) -> Optional[dict]:
+    """The wrapped source's cursor as of the last batch taken.
+
+    Batches prefetched by tf.data are not counted, so resuming from this
+    cursor produces them again.
+    """
+    return self._cursor
@@ -3,6 +3,7 @@
 import collections
 import dataclasses
 import datetime
+import functools
 import json
 import os
 import pickle
@@ -31,6 +32,8 @@ from slippi_ai import (
 )
 from slippi_ai import learner as learner_lib
 from slippi_ai import data as data_lib
+from slippi_ai import sources as sources_lib
+from slippi_ai import tf_data as tf_data_lib
 from slippi_ai import value_function as vf_lib
 from slippi_ai import embed as embed_lib
 
@@ -105,6 +108,8 @@ class Config:
 
   dataset: data_lib.DatasetConfig = _field(data_lib.DatasetConfig)
   data: data_lib.DataConfig = _field(data_lib.DataConfig)
+  # Prefetch and preprocess batches through tf.data.
+  tf_data: tf_data_lib.TFDataConfig = _field(tf_data_lib.TFDataConfig)
 
   learner: learner_lib.LearnerConfig = _field(learner_lib.LearnerConfig)
 
@@ -126,6 +131,11 @@ class Config:
   # TODO: group these into their own subconfig
   restore_pickle: tp.Optional[str] = None
 
+  # JSON list of config overrides, one per model to train on the same batches.
+  # Each may have a "name" and override keys in VARIANT_KEYS; models are saved
+  # under expt_dir/<name> and log under their name.
+  variants_path: tp.Optional[str] = None
+
   is_test: bool = False  # for db management
   version: int = saving.VERSION
 
@@ -133,16 +143,14 @@ def _get_loss(stats: dict):
   return stats['total_loss'].numpy().mean()
 
 def create_name_map(
-    replays: list[data_lib.ReplayInfo],
+    replays: data_lib.ReplayTable,
     max_names: int,
 ) -> dict[str, int]:
   name_map = {}
   name_counts = collections.Counter()
 
-  normalized_names = [
-      nametags.normalize_name(replay.main_player.name)
-      for replay in replays]
-  name_counts.update(normalized_names)
+  for name, count in replays.main_player_name_counts().items():
+    name_counts[nametags.normalize_name(name)] += count
 
   for i, (name, _) in enumerate(name_counts.most_common(max_names)):
     name_map[name] = i
@@ -156,43 +164,153 @@ def create_name_map(
 
   return name_map
 
-def train(config: Config):
-  tag = config.tag or train_lib.get_experiment_tag()
-  # Might want to use wandb.run.dir instead, but it doesn't seem
-  # to be set properly even when we try to override it.
-  expt_dir = config.expt_dir
-  if expt_dir is None:
-    expt_dir = os.path.join(config.expt_root, tag)
-    os.makedirs(expt_dir, exist_ok=True)
-  config.expt_dir = expt_dir  # for wandb logging
-  logging.info('experiment directory: %s', expt_dir)
+def _merge(base: dict, overrides: dict) -> dict:
+  merged = dict(base)
+  for key, value in overrides.items():
+    if isinstance(value, dict) and isinstance(base.get(key), dict):
+      value = _merge(base[key], value)
+    merged[key] = value
+  return merged
 
-  runtime = config.runtime
+# The parts of the config that may differ between variants; the others
+# determine the batches, which all variants share.
+VARIANT_KEYS = (
+    'network', 'controller_head', 'learner', 'policy', 'value_function')
 
-  pickle_path = os.path.join(expt_dir, 'latest.pkl')
+def load_variants(config: Config) -> list[tuple[tp.Optional[str], Config]]:
+  """The (name, config) of each model to train, see Config.variants_path."""
+  if config.variants_path is None:
+    return [(None, config)]
 
+  if config.restore_pickle:
+    raise ValueError('restore_pickle is not supported with variants.')
+
+  with open(config.variants_path) as f:
+    all_overrides: list[dict] = json.load(f)
+
+  base = dataclasses.asdict(config)
+  variants = []
+  for i, overrides in enumerate(all_overrides):
+    overrides = dict(overrides)
+    name = overrides.pop('name', f'variant_{i}')
+    unknown = set(overrides) - set(VARIANT_KEYS)
+    if unknown:
+      raise ValueError(
+          f'Variant {name} sets {sorted(unknown)}; only {VARIANT_KEYS} '
+          'can differ between variants.')
+    variant = flag_utils.dataclass_from_dict(Config, _merge(base, overrides))
+    if variant.policy.delay != config.policy.delay:
+      raise ValueError(
+          f'Variant {name} changes the delay, which the batches depend on.')
+    variants.append((name, variant))
+
+  names = [name for name, _ in variants]
+  if len(set(names)) != len(names):
+    raise ValueError(f'Variant names must be unique: {names}')
+  return variants
+
+class MultiTrainManager:
+  """Steps several learners on each batch of one data source.
+
+  The learners must share the embedding, so that the host-side preprocessing
+  is done once per batch.
+  """
 
+  def __init__(
+      self,
+      learners: list[learner_lib.Learner],
+      data_source: data_lib.DataSource,
+      step_kwargs={},
+  ):
+    self.learners = learners
+    self.data_source = data_source
+    self.hidden_states = [
+        learner.initial_state(data_source.batch_size) for learner in learners]
+    self.step_kwargs = dict(step_kwargs)
+    self.preprocess = None
+    if not self.step_kwargs.pop('preprocessed', False):
+      self.preprocess = functools.partial(
+          learners[0].preprocess,
+          embedded=self.step_kwargs.pop('embedded', False))
+    self.data_profiler = utils.Profiler()
+    self.step_profiler = utils.Profiler()
 
-  # attempt to restore parameters
-  restored = False
-  if config.restore_pickle:
-    logging.info('restoring from %s', config.restore_pickle)
-    with open(config.restore_pickle, 'rb') as f:
-      combined_state = pickle.load(f)
-    restored = True
-  elif os.path.exists(pickle_path):
-    logging.info('restoring from %s', pickle_path)
-    with open(pickle_path, 'rb') as f:
-      combined_state = pickle.load(f)
-    restored = True
-  else:
-    logging.info('not restoring any params')
+  def step(self, compiled: bool = True) -> tuple[list[dict], data_lib.Batch]:
+    with self.data_profiler:
+      batch, epoch = next(self.data_source)
+      if self.preprocess is not None:
+        batch = batch._replace(frames=self.preprocess(batch.frames))
+    all_stats = []
+    with self.step_profiler:
+      for i, learner in enumerate(self.learners):
+        stats, self.hidden_states[i] = learner.step(
+            batch, self.hidden_states[i], compile=compiled, preprocessed=True,
+            **self.step_kwargs)
+        stats.update(epoch=epoch)
+        all_stats.append(stats)
+    return all_stats, batch
 
-  # Initialize the best eval loss to infinity
-  best_eval_loss = float('inf')
+class _ModelRun:
+  """One of the models that train() trains, with its own checkpoint."""
 
-  if restored:
-    best_eval_loss = combined_state.get('best_eval_loss', float('inf'))
+  def __init__(
+      self,
+      name: tp.Optional[str],
+      config: Config,
+      expt_dir: str,
+      step: tf.Variable,
+  ):
+    self.name = name
+    self.config = config
+    if name is not None:
+      expt_dir = os.path.join(expt_dir, name)
+      os.makedirs(expt_dir, exist_ok=True)
+    self.pickle_path = os.path.join(expt_dir, 'latest.pkl')
+
+    self.combined_state = None
+    self.best_eval_loss = float('inf')
+    self._restore_config()
+
+    self.policy = saving.policy_from_config(dataclasses.asdict(config))
+
+    self.value_function = None
+    if config.value_function.train_separate_network:
+      value_net_config = config.network
+      if config.value_function.separate_network_config:
+        value_net_config = config.value_function.network
+      self.value_function = vf_lib.ValueFunction(
+          network_config=value_net_config,
+          embed_state_action=self.policy.embed_state_action,
+      )
+
+    learner_kwargs = dataclasses.asdict(config.learner)
+    learning_rate = tf.Variable(
+        learner_kwargs['learning_rate'], name='learning_rate', trainable=False)
+    learner_kwargs.update(learning_rate=learning_rate)
+    self.learner = learner_lib.Learner(
+        policy=self.policy,
+        value_function=self.value_function,
+        **learner_kwargs,
+    )
+
+    self.step = step
+
+  def _restore_config(self):
+    """Reads the checkpoint, if any, and adopts its fixed settings."""
+    config = self.config
+    if config.restore_pickle:
+      path = config.restore_pickle
+    elif os.path.exists(self.pickle_path):
+      path = self.pickle_path
+    else:
+      logging.info('not restoring any params')
+      return
+
+    logging.info('restoring from %s', path)
+    with open(path, 'rb') as f:
+      self.combined_state = combined_state = pickle.load(f)
+
+    self.best_eval_loss = combined_state.get('best_eval_loss', float('inf'))
 
     restore_config = flag_utils.dataclass_from_dict(
         Config, saving.upgrade_config(combined_state['config']))
@@ -200,7 +318,7 @@ def train(config: Config):
     # We can update the delay as it doesn't affect the network architecture.
     if restore_config.policy.delay != config.policy.delay:
       logging.warning(f'Changing delay from {restore_config.policy.delay} to {config.policy.delay}.')
-      best_eval_loss = float('inf')  # Old losses don't apply to new delay.
+      self.best_eval_loss = float('inf')  # Old losses don't apply to new delay.
 
     # These we can't change after the fact.
     for key in ['network', 'controller_head', 'embed']:
@@ -210,31 +328,100 @@ def train(config: Config):
         logging.warning(f'Requested {key} config doesn\'t match, overriding from checkpoint.')
         setattr(config, key, previous)
 
-  policy = saving.policy_from_config(dataclasses.asdict(config))
+  @property
+  def tf_state(self) -> dict:
+    state = dict(
+        policy=self.policy.variables,
+        value_function=(
+            self.value_function.variables if self.value_function else []),
+        optimizers=dict(
+            policy=self.learner.policy_optimizer.variables,
+            value=self.learner.value_optimizer.variables,
+        ),
+    )
+    # Variants share the step, which goes in the run checkpoint instead.
+    if self.name is None:
+      state.update(step=self.step)
+    return state
+
+  def get_tf_state(self):
+    return tf.nest.map_structure(lambda v: v.numpy(), self.tf_state)
 
-  value_function = None
-  if config.value_function.train_separate_network:
-    value_net_config = config.network
-    if config.value_function.separate_network_config:
-      value_net_config = config.value_function.network
-    value_function = vf_lib.ValueFunction(
-        network_config=value_net_config,
-        embed_state_action=policy.embed_state_action,
+  def set_tf_state(self, state):
+    tf.nest.map_structure(
+      lambda var, val: var.assign(val),
+      self.tf_state, state)
+
+  def save(self, name_map: dict, data_cursors: tp.Optional[dict] = None):
+    # easier to always bundle the config with the state
+    combined_state = dict(
+        state=self.get_tf_state(),
+        config=dataclasses.asdict(self.config),
+        name_map=name_map,
+        best_eval_loss=self.best_eval_loss,
     )
+    if data_cursors is not None:
+      combined_state.update(data_cursors=data_cursors)
+    pickled_state = pickle.dumps(combined_state)
 
-  learner_kwargs = dataclasses.asdict(config.learner)
-  learning_rate = tf.Variable(
-      learner_kwargs['learning_rate'], name='learning_rate', trainable=False)
-  learner_kwargs.update(learning_rate=learning_rate)
-  learner = learner_lib.Learner(
-      policy=policy,
-      value_function=value_function,
-      **learner_kwargs,
-  )
+    logging.info('saving state to %s', self.pickle_path)
+    with open(self.pickle_path, 'wb') as f:
+      f.write(pickled_state)
+
+  def namespace(self, stats: dict) -> dict:
+    """Nests stats under the model's name, so that variants log apart."""
+    if self.name is None:
+      return stats
+    return {self.name: stats}
+
+def train(config: Config):
+  tag = config.tag or train_lib.get_experiment_tag()
+  # Might want to use wandb.run.dir instead, but it doesn't seem
+  # to be set properly even when we try to override it.
+  expt_dir = config.expt_dir
+  if expt_dir is None:
+    expt_dir = os.path.join(config.expt_root, tag)
+    os.makedirs(expt_dir, exist_ok=True)
+  config.expt_dir = expt_dir  # for wandb logging
+  logging.info('experiment directory: %s', expt_dir)
+
+  runtime = config.runtime
+
+  with tf.device('/cpu:0'):
+    step = tf.Variable(0, trainable=False, name="step", dtype=tf.int64)
+
+  # Each model restores its own checkpoint, if there is one.
+  models = [
+      _ModelRun(name, variant_config, expt_dir, step)
+      for name, variant_config in load_variants(config)]
+  restored = [model for model in models if model.combined_state is not None]
+
+  # The models share the step and the batches. A single model checkpoints
+  # them with its own state, while variants use a run-level checkpoint.
+  run_pickle_path = os.path.join(expt_dir, 'run.pkl')
+  run_state = None
+  if models[0].name is None:
+    run_state = models[0].combined_state
+  elif os.path.exists(run_pickle_path):
+    logging.info('restoring run state from %s', run_pickle_path)
+    with open(run_pickle_path, 'rb') as f:
+      run_state = pickle.load(f)
+    step.assign(run_state['step'])
+
+  # The batches are shared, so the models must agree on how to embed them.
+  for model in models[1:]:
+    if model.config.embed != models[0].config.embed:
+      raise ValueError(
+          f'Variant {model.name} embeds the data differently from '
+          f'{models[0].name}.')
+  policy = models[0].policy
 
   logging.info("Network configuration")
-  for comp in ['network', 'controller_head']:
-    logging.info(f'Using {comp}: {getattr(config, comp)["name"]}')
+  for model in models:
+    for comp in ['network', 'controller_head']:
+      logging.info(
+          f'{model.name or "model"} uses {comp}: '
+          f'{getattr(model.config, comp)["name"]}')
 
   ### Dataset Creation ###
   dataset_config = config.dataset
@@ -248,8 +435,10 @@ def train(config: Config):
   train_replays, test_replays = data_lib.train_test_split(dataset_config)
   logging.info(f'Training on {len(train_replays)} replays, testing on {len(test_replays)}')
 
-  if restored:
-    name_map: dict[str, int] = combined_state['name_map']
+  if run_state is not None:
+    name_map: dict[str, int] = run_state['name_map']
+  elif restored:
+    name_map = restored[0].combined_state['name_map']
   else:
     name_map = create_name_map(train_replays, config.max_names)
 
@@ -270,82 +459,119 @@ def train(config: Config):
       dataclasses.asdict(config.data),
       extra_frames=1 + policy.delay,
       name_map=name_map,
+      # Only decode the columns that the model and rewards use.
+      columns=data_lib.required_game_paths(
+          policy.embed_state_action.paths()),
       **char_filters,
   )
-  train_data = data_lib.make_source(replays=train_replays, **data_config)
-  test_data = data_lib.make_source(replays=test_replays, **data_config)
+  embedded = data_config.pop('embed_in_workers')
+  if embedded:
+    data_config.update(
+        preprocess=policy.embed_state_action.from_state_narrow)
+  # Resume the data sources where they were, if they are set up the same.
+  data_cursors = dict(train=None, test=None)
+  if run_state is not None and 'data_cursors' in run_state:
+    restore_config = flag_utils.dataclass_from_dict(
+        Config, saving.upgrade_config(run_state['config']))
+    same_data = all(
+        getattr(config, key) == getattr(restore_config, key)
+        for key in ['dataset', 'data'])
+    if same_data:
+      data_cursors = run_state['data_cursors']
+    else:
+      logging.warning('Data config changed, not resuming the data sources.')
+  del run_state  # free up memory
+  sources = sources_lib.make_sources(
+      dict(train=train_replays, test=test_replays),
+      cursors=data_cursors,
+      # Test batches are only needed every log_interval.
+      prefetch=dict(test=0),
+      dataset=dataset_config,
+      **data_config)
+  train_data, test_data = sources['train'], sources['test']
   del train_replays, test_replays  # free up memory
 
-  train_manager = train_lib.TrainManager(learner, train_data, dict(train=True))
-  test_manager = train_lib.TrainManager(learner, test_data, dict(train=False))
+  step_kwargs = dict(time_major=config.data.time_major, embedded=embedded)
+  train_batches, test_batches = train_data, test_data
+  if config.tf_data.enabled:
+    frames_spec = data_lib.frames_spec(
+        config.data.unroll_length + data_config['extra_frames'],
+        config.data.batch_size, config.data.time_major,
+        data_config.get('preprocess'))
+    preprocess = functools.partial(
+        models[0].learner.preprocess, embedded=embedded)
+    train_batches, test_batches = [
+        tf_data_lib.TFDataSource(
+            source, frames_spec, preprocess,
+            prefetch=config.tf_data.prefetch,
+            device=config.tf_data.device)
+        for source in (train_data, test_data)]
+    step_kwargs.update(preprocessed=True)
+
+  learners = [model.learner for model in models]
+  train_manager = train_lib.MultiTrainManager(
+      learners, train_batches, dict(train=True, **step_kwargs))
+  test_manager = train_lib.MultiTrainManager(
+      learners, test_batches, dict(train=False, **step_kwargs))
 
   # initialize variables
-  train_stats, _ = train_manager.step()
-  logging.info('loss initial: %f', _get_loss(train_stats))
-
-  with tf.device('/cpu:0'):
-    step = tf.Variable(0, trainable=False, name="step", dtype=tf.int64)
-
-  # saving and restoring
-  tf_state = dict(
-      step=step,
-      policy=policy.variables,
-      value_function=value_function.variables if value_function else [],
-      optimizers=dict(
-          policy=learner.policy_optimizer.variables,
-          value=learner.value_optimizer.variables,
-      ),
-  )
-
-  def get_tf_state():
-    return tf.nest.map_structure(lambda v: v.numpy(), tf_state)
-
-  def set_tf_state(state):
-    tf.nest.map_structure(
-      lambda var, val: var.assign(val),
-      tf_state, state)
+  all_train_stats, _ = train_manager.step()
+  for model, train_stats in zip(models, all_train_stats):
+    logging.info(
+        'loss initial%s: %f', f' ({model.name})' if model.name else '',
+        _get_loss(train_stats))
+
+  def save(saved_models: list[_ModelRun]):
+    data_cursors = dict(
+        train=train_batches.get_cursor(),
+        test=test_batches.get_cursor(),
+    )
+    if models[0].name is None:
+      models[0].save(name_map, data_cursors)
+      return
 
-  def save(eval_loss=None):
-    # Local Save
-    tf_state = get_tf_state()
+    for model in saved_models:
+      model.save(name_map)
 
-    # easier to always bundle the config with the state
-    combined_state = dict(
-        state=tf_state,
+    run_state = dict(
+        step=int(step.numpy()),
         config=dataclasses.asdict(config),
         name_map=name_map,
-        best_eval_loss=eval_loss if eval_loss is not None else best_eval_loss,
+        data_cursors=data_cursors,
     )
-    pickled_state = pickle.dumps(combined_state)
-
-    logging.info('saving state to %s', pickle_path)
-    with open(pickle_path, 'wb') as f:
-      f.write(pickled_state)
-
+    logging.info('saving run state to %s', run_pickle_path)
+    with open(run_pickle_path, 'wb') as f:
+      pickle.dump(run_state, f)
 
   if restored:
-    set_tf_state(combined_state['state'])
-    train_loss = _get_loss(train_manager.step()[0])
-    logging.info('loss post-restore: %f', train_loss)
+    for model in restored:
+      model.set_tf_state(model.combined_state['state'])
+      model.combined_state = None  # free up memory
+    all_train_stats, _ = train_manager.step()
+    for model in restored:
+      train_loss = _get_loss(all_train_stats[models.index(model)])
+      logging.info(
+          'loss post-restore%s: %f', f' ({model.name})' if model.name else '',
+          train_loss)
 
   FRAMES_PER_MINUTE = 60 * 60
   FRAMES_PER_STEP = config.data.batch_size * config.data.unroll_length
 
   step_tracker = utils.Tracker(step.numpy())
-  epoch_tracker = utils.Tracker(train_stats['epoch'])
+  epoch_tracker = utils.Tracker(all_train_stats[0]['epoch'])
   log_tracker = utils.Tracker(time.time())
 
   @utils.periodically(runtime.log_interval)
-  def maybe_log(train_stats: dict):
+  def maybe_log(all_train_stats: list[dict]):
     """Do a test step, then log both train and test stats."""
-    test_stats, _ = test_manager.step()
+    all_test_stats, _ = test_manager.step()
 
     elapsed_time = log_tracker.update(time.time())
     total_steps = step.numpy()
     steps = step_tracker.update(total_steps)
     num_frames = steps * FRAMES_PER_STEP
 
-    epoch = train_stats['epoch']
+    epoch = all_train_stats[0]['epoch']
     delta_epoch = epoch_tracker.update(epoch)
 
     sps = steps / elapsed_time
@@ -362,32 +588,41 @@ def train(config: Config):
         step=step_time,
     )
 
+    hit_rates = data_lib.cache_hit_rates(train_data.get_stats())
+    for name, hit_rate in hit_rates.items():
+      timings[f'{name}_hit_rate'] = hit_rate
+
     all_stats = dict(
-        train=train_stats,
-        test=test_stats,
         timings=timings,
         num_frames=num_frames,
     )
+    for model, train_stats, test_stats in zip(
+        models, all_train_stats, all_test_stats):
+      all_stats.update(model.namespace(dict(train=train_stats, test=test_stats)))
     train_lib.log_stats(all_stats, total_steps)
 
-    train_loss = _get_loss(train_stats)
-    test_loss = _get_loss(test_stats)
-
     print(f'step={total_steps} epoch={epoch:.3f}')
     print(f'sps={sps:.2f} mps={mps:.2f} eph={eph:.2e}')
-    print(f'losses: train={train_loss:.4f} test={test_loss:.4f}')
+    for model, train_stats, test_stats in zip(
+        models, all_train_stats, all_test_stats):
+      train_loss = _get_loss(train_stats)
+      test_loss = _get_loss(test_stats)
+      losses = f'losses[{model.name}]' if model.name else 'losses'
+      print(f'{losses}: train={train_loss:.4f} test={test_loss:.4f}')
     print(f'timing:'
           f' data={data_time:.3f}'
           f' step={step_time:.3f}')
+    if hit_rates:
+      print('cache hit rates: ' + ' '.join(
+          f'{name}={hit_rate:.2f}' for name, hit_rate in hit_rates.items()))
     print()
 
   def maybe_eval():
-    nonlocal best_eval_loss  # Allow modification of the best_eval_loss variable
     total_steps = int(step.numpy())
     if total_steps % runtime.eval_every_n != 0:
       return
 
-    eval_stats = []
+    all_eval_stats = [[] for _ in models]
     metas: list[data_lib.ChunkMeta] = []
 
     def time_mean(x):
@@ -399,16 +634,14 @@ def train(config: Config):
       return np.mean(x, axis=0)
 
     for _ in range(runtime.num_eval_steps):
-      stats, batch = test_manager.step()
+      all_stats, batch = test_manager.step()
 
-      # Convert to numpy and take time-mean to free up memory.
-      stats = utils.map_single_structure(time_mean, stats)
+      for eval_stats, stats in zip(all_eval_stats, all_stats):
+        # Convert to numpy and take time-mean to free up memory.
+        eval_stats.append(utils.map_single_structure(time_mean, stats))
 
-      eval_stats.append(stats)
       metas.append(batch.meta)
 
-    eval_stats = tf.nest.map_structure(utils.stack, *eval_stats)
-
     data_time = test_manager.data_profiler.mean_time()
     step_time = test_manager.step_profiler.mean_time()
 
@@ -421,25 +654,6 @@ def train(config: Config):
         step_time=step_time,
     )
 
-    to_log = dict(eval=eval_stats, **counters)
-    train_lib.log_stats(to_log, total_steps)
-
-    # Calculate the mean eval loss
-    eval_loss = eval_stats['policy']['loss'].mean()
-    logging.info('eval loss: %.4f data: %.3f step: %.3f', eval_loss, data_time, step_time)
-
-    # Save if the eval loss is the best so far
-    if eval_loss < best_eval_loss:
-      logging.info('New best eval loss: %f (previous: %f)', eval_loss, best_eval_loss)
-      best_eval_loss = eval_loss
-      save(eval_loss=best_eval_loss)
-
-    # Log losses aggregated by name.
-
-    # Stats have shape [num_eval_steps, batch_size]
-    loss = eval_stats['policy']['loss']
-    assert loss.shape == (runtime.num_eval_steps, config.data.batch_size)
-
     meta: data_lib.ChunkMeta = tf.nest.map_structure(utils.stack, *metas)
 
     # Name of the player we're imitating.
@@ -447,26 +661,55 @@ def train(config: Config):
         meta.info.swap, meta.info.meta.p1.name, meta.info.meta.p0.name)
     encoded_name = batch_encode_name(name)
     assert encoded_name.dtype == np.uint8
-    assert encoded_name.shape == loss.shape
 
-    loss_sums_and_counts = []
-    for i in range(num_codes):
-      mask = encoded_name == i
-      loss_sums_and_counts.append((np.sum(loss * mask), np.sum(mask)))
+    saved_models: list[_ModelRun] = []
+    for model, eval_stats in zip(models, all_eval_stats):
+      eval_stats = tf.nest.map_structure(utils.stack, *eval_stats)
 
-    losses, counts = zip(*loss_sums_and_counts)
-    to_log = dict(
-        losses=np.array(losses, dtype=np.float32),
-        counts=np.array(counts, dtype=np.uint32),
-    )
+      to_log = dict(model.namespace(dict(eval=eval_stats)), **counters)
+      train_lib.log_stats(to_log, total_steps)
+
+      # Calculate the mean eval loss
+      eval_loss = eval_stats['policy']['loss'].mean()
+      logging.info(
+          'eval loss%s: %.4f data: %.3f step: %.3f',
+          f' ({model.name})' if model.name else '',
+          eval_loss, data_time, step_time)
+
+      # Save if the eval loss is the best so far
+      if eval_loss < model.best_eval_loss:
+        logging.info('New best eval loss: %f (previous: %f)', eval_loss, model.best_eval_loss)
+        model.best_eval_loss = eval_loss
+        saved_models.append(model)
+
+      # Log losses aggregated by name.
+
+      # Stats have shape [num_eval_steps, batch_size]
+      loss = eval_stats['policy']['loss']
+      assert loss.shape == (runtime.num_eval_steps, config.data.batch_size)
+      assert encoded_name.shape == loss.shape
+
+      loss_sums_and_counts = []
+      for i in range(num_codes):
+        mask = encoded_name == i
+        loss_sums_and_counts.append((np.sum(loss * mask), np.sum(mask)))
+
+      losses, counts = zip(*loss_sums_and_counts)
+      to_log = dict(
+          losses=np.array(losses, dtype=np.float32),
+          counts=np.array(counts, dtype=np.uint32),
+      )
+
+      to_log = dict(model.namespace(dict(eval_names=to_log)), **counters)
+      train_lib.log_stats(to_log, total_steps, take_mean=False)
 
-    to_log = dict(eval_names=to_log, **counters)
-    train_lib.log_stats(to_log, total_steps, take_mean=False)
+    if saved_models:
+      save(saved_models)
 
   start_time = time.time()
 
   while time.time() - start_time < runtime.max_runtime:
-    train_stats, _ = train_manager.step()
+    all_train_stats, _ = train_manager.step()
     step.assign_add(1)
-    maybe_log(train_stats)
+    maybe_log(all_train_stats)
     maybe_eval()
@@ -2,6 +2,7 @@
 """Train (and test) a network via imitation learning."""
 
 import dataclasses
+import itertools
 import json
 import os
 import pickle
@@ -29,6 +30,7 @@ from slippi_ai import (
 )
 from slippi_ai import q_learner as learner_lib
 from slippi_ai import data as data_lib
+from slippi_ai import sources as sources_lib
 from slippi_ai import q_function as q_lib
 from slippi_ai import embed as embed_lib
 from slippi_ai import dolphin as dolphin_lib
@@ -119,6 +121,11 @@ def _get_loss(stats: dict):
   return stats['total_loss'].numpy().mean()
 
 def train(config: Config):
+  if config.data.pack_games:
+    # The q-function and policies here unroll without resetting their state
+    # mid-chunk, and their returns would bootstrap across game boundaries.
+    raise ValueError('data.pack_games is not supported for q-learning.')
+
   tag = config.tag or train_lib.get_experiment_tag()
   # Might want to use wandb.run.dir instead, but it doesn't seem
   # to be set properly even when we try to override it.
@@ -228,13 +235,29 @@ def train(config: Config):
       dataclasses.asdict(config.data),
       extra_frames=1 + q_policy.delay,
       name_map=name_map,
+      # Only decode the columns that the model and rewards use.
+      columns=data_lib.required_game_paths(
+          itertools.chain(
+              sample_policy.embed_state_action.paths(),
+              q_policy.embed_state_action.paths())),
       **char_filters,
   )
-  train_data = data_lib.make_source(replays=train_replays, **data_config)
-  test_data = data_lib.make_source(replays=test_replays, **data_config)
-
-  train_manager = train_lib.TrainManager(learner, train_data, dict(train=True))
-  test_manager = train_lib.TrainManager(learner, test_data, dict(train=False))
+  embedded = data_config.pop('embed_in_workers')
+  if embedded:
+    data_config.update(
+        preprocess=sample_policy.embed_state_action.from_state_narrow)
+  sources = sources_lib.make_sources(
+      dict(train=train_replays, test=test_replays),
+      prefetch=dict(test=0),
+      dataset=dataset_config,
+      **data_config)
+  train_data, test_data = sources['train'], sources['test']
+
+  step_kwargs = dict(time_major=config.data.time_major, embedded=embedded)
+  train_manager = train_lib.TrainManager(
+      learner, train_data, dict(train=True, **step_kwargs))
+  test_manager = train_lib.TrainManager(
+      learner, test_data, dict(train=False, **step_kwargs))
 
   stats, _ = train_manager.step()
   logging.info('loss initial: %f', _get_loss(stats))
@@ -321,6 +344,10 @@ def train(config: Config):
         step=step_time,
     )
 
+    hit_rates = data_lib.cache_hit_rates(train_data.get_stats())
+    for name, hit_rate in hit_rates.items():
+      timings[f'{name}_hit_rate'] = hit_rate
+
     all_stats = dict(
         train=train_stats,
         test=test_stats,
@@ -337,6 +364,9 @@ def train(config: Config):
     print(f'timing:'
           f' data={data_time:.3f}'
           f' step={step_time:.3f}')
+    if hit_rates:
+      print('cache hit rates: ' + ' '.join(
+          f'{name}={hit_rate:.2f}' for name, hit_rate in hit_rates.items()))
     print()
 
   def maybe_eval(force: bool = False):
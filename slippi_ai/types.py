@@ -22,6 +22,24 @@ class Buttons(NamedTuple):
 
 LIBMELEE_BUTTONS = {name: Button(name) for name in Buttons._fields}
 
+# Buttons can also be packed into one uint8 mask, with bit i holding
+# Buttons._fields[i]. This is one leaf instead of eight when batching,
+# pickling or copying to the accelerator.
+PackedButtons = np.uint8
+BUTTON_BITS = {name: 1 << i for i, name in enumerate(Buttons._fields)}
+
+def pack_buttons(buttons: Buttons) -> np.ndarray:
+  mask = np.zeros(np.shape(buttons[0]), PackedButtons)
+  for pressed, bit in zip(buttons, BUTTON_BITS.values()):
+    mask |= np.where(pressed, PackedButtons(bit), PackedButtons(0))
+  return mask
+
+def unpack_buttons(mask: np.ndarray) -> Buttons:
+  return Buttons(**{
+      name: np.bitwise_and(mask, bit) != 0
+      for name, bit in BUTTON_BITS.items()
+  })
+
 class Stick(NamedTuple):
   x: np.float32
   y: np.float32
@@ -68,6 +86,17 @@ def nt_to_pa(nt: type) -> pa.StructType:
   PA_TO_NT[struct_type] = nt
   return struct_type
 
+def leaf_paths(nt: type) -> list[tuple[str, ...]]:
+  """Field paths to the leaves of a NamedTuple type, in traversal order."""
+  if not issubclass(nt, tuple):
+    return [()]
+
+  return [
+      (name,) + path
+      for name in nt._fields
+      for path in leaf_paths(nt.__annotations__[name])
+  ]
+
 BUTTONS_TYPE = nt_to_pa(Buttons)
 STICK_TYPE = nt_to_pa(Stick)
 CONTROLLER_TYPE = nt_to_pa(Controller)
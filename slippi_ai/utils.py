@@ -130,6 +130,17 @@ def map_nt(f, *nt: T) -> T:
   # Not a nest.
   return f(*nt)
 
+def flatten_nt(nest) -> list:
+  """Leaves of a nest, in the traversal order of map_nt."""
+  leaves = []
+  map_nt(leaves.append, nest)
+  return leaves
+
+def unflatten_nt(template: T, leaves: tp.Iterable) -> T:
+  """Inverse of flatten_nt; the template supplies the structure."""
+  leaves = iter(leaves)
+  return map_nt(lambda _: next(leaves), template)
+
 def batch_nest_nt(nests: tp.Sequence[T]) -> T:
   # More efficient than batch_nest
   return map_nt(stack, *nests)
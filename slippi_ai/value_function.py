@@ -6,7 +6,7 @@ import sonnet as snt
 from melee.enums import Action
 
 from slippi_ai import data, embed, networks, tf_utils, types
-from slippi_ai.rl_lib import discounted_returns
+from slippi_ai.rl_lib import cut_at_resets, discounted_returns
 from slippi_ai.networks import RecurrentState
 
 class ValueOutputs(tp.NamedTuple):
@@ -67,6 +67,7 @@ class ValueFunction(snt.Module):
         last_input, frames.is_resetting[-1], final_state)
     last_value = tf.squeeze(self.value_head(last_output), -1)
     discounts = tf.fill(tf.shape(rewards), tf.cast(discount, tf.float32))
+    discounts = cut_at_resets(discounts, frames.is_resetting)
 
     if discount_on_death is not None:
       respawn_happened = tf.logical_or(
@@ -0,0 +1,370 @@
+"""Worker processes that serve batches for several named streams.
+
+See SharedWorkerPool, which sources.make_sources uses with DataConfig.shared_pool.
+"""
+
+import atexit
+import collections
+import multiprocessing as mp
+import queue
+import threading
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from slippi_ai import data, shm, utils
+
+def serve_streams(
+    requests: mp.Queue,
+    results: mp.Queue,
+    reader_kwargs: Optional[dict] = None,
+):
+  """Worker loop of a SharedWorkerPool.
+
+  Requests are ('add', stream, kwargs, weight, ring, rows), ('remove',
+  stream) and ('next', stream, slot). Pending requests of several streams
+  are served by smooth weighted round-robin, and each stream's DataSource is
+  only created once it is first requested. Results are (stream, result)
+  pairs, where the result is the exception if making the batch failed.
+
+  With reader_kwargs, streams that decode the same columns share one
+  GameReader (see data.make_game_reader) and thus its caches.
+  """
+  stream_kwargs: dict[str, dict] = {}
+  weights: dict[str, float] = {}
+  rings: dict[str, Optional[shm.SharedRing[data.Frames]]] = {}
+  rows: dict[str, slice] = {}
+  sources: dict[str, data.DataSource] = {}
+  pending: dict[str, collections.deque] = {}
+  credits: dict[str, float] = {}
+  readers: dict[Optional[frozenset], data.GameReader] = {}
+
+  def handle(request: tuple):
+    kind, name, *args = request
+    if kind == 'add':
+      stream_kwargs[name], weights[name], rings[name], rows[name] = args
+      pending[name] = collections.deque()
+      credits[name] = 0.
+    elif kind == 'remove':
+      for streams in [
+          stream_kwargs, weights, rings, rows, sources, pending, credits]:
+        streams.pop(name, None)
+    else:
+      slot, = args
+      pending[name].append(slot)
+
+  def make_source(name: str) -> data.DataSource:
+    kwargs = stream_kwargs[name]
+    if reader_kwargs is not None:
+      columns = kwargs.get('columns')
+      key = None if columns is None else frozenset(columns)
+      if key not in readers:
+        readers[key] = data.make_game_reader(columns=columns, **reader_kwargs)
+      kwargs = dict(kwargs, reader=readers[key])
+    return data.DataSource(num_buffers=0, **kwargs)
+
+  while True:
+    block = not any(pending.values())
+    try:
+      while True:
+        handle(requests.get(block=block))
+        block = not any(pending.values())
+    except queue.Empty:
+      pass
+
+    ready = [name for name, slots in pending.items() if slots]
+    for name in ready:
+      credits[name] += weights[name]
+    name = max(ready, key=credits.__getitem__)
+    credits[name] -= sum(weights[n] for n in ready)
+    slot = pending[name].popleft()
+
+    try:
+      source = sources.get(name)
+      if source is None:
+        source = sources[name] = make_source(name)
+
+      ring = rings[name]
+      if ring is None:
+        batch, epoch = next(source)
+        result = (batch, epoch, source.get_stats(), source.get_cursor())
+      else:
+        index = (slice(None), rows[name]) if source.time_major else rows[name]
+        frames = utils.map_nt(lambda x: x[index], ring[slot])
+        batch, epoch = source.next_into(frames)
+        result = (
+            batch.count, batch.meta, epoch, source.get_stats(),
+            source.get_cursor())
+    except Exception as e:
+      result = e
+    results.put((name, result))
+
+class PoolStream:
+  """A named stream of a SharedWorkerPool or BatchClient.
+
+  Used like a DataSource. The pool sends requests for the stream's batches
+  and receives one result per worker.
+
+  Up to prefetch batches are requested ahead, so with prefetch=0 batches are
+  only made when asked for. With shared memory, the frames of a batch are
+  valid until the next call to __next__.
+  """
+
+  def __init__(
+      self,
+      pool: Union['SharedWorkerPool', 'batch_server.BatchClient'],
+      name: str,
+      batch_size: int,
+      time_major: bool,
+      prefetch: int,
+      ring: Optional[shm.SharedRing[data.Frames]],
+      cursors: List[Optional[dict]],
+  ):
+    self.pool = pool
+    self.name = name
+    self.batch_size = batch_size
+    self.time_major = time_major
+    self.prefetch = prefetch
+    self.ring = ring
+
+    num_slots = ring.num_slots if ring is not None else prefetch + 1
+    self._free_slots = collections.deque(range(num_slots))
+    self._requested: collections.deque[int] = collections.deque()
+    self._last_slot: Optional[int] = None
+
+    self._stats = {}
+    self._cursors = cursors
+
+  def _request(self):
+    while len(self._requested) <= self.prefetch and self._free_slots:
+      slot = self._free_slots.popleft()
+      self.pool.request(self.name, slot)
+      self._requested.append(slot)
+
+  def __next__(self) -> Tuple[data.Batch, float]:
+    if self._last_slot is not None:
+      self._free_slots.append(self._last_slot)
+    self._request()
+    slot = self._requested.popleft()
+    if self.ring is not None:
+      # Other slots are only reused once the trainer is done with this one.
+      self._last_slot = slot
+    else:
+      self._free_slots.append(slot)
+
+    results = self.pool.receive(self.name)
+    if self.ring is None:
+      batches, epochs, stats, self._cursors = zip(*results)
+      frames = utils.concat_nest_nt(
+          [b.frames for b in batches], axis=1 if self.time_major else 0)
+      counts = [b.count for b in batches]
+      metas = [b.meta for b in batches]
+    else:
+      counts, metas, epochs, stats, self._cursors = zip(*results)
+      frames = self.ring[slot]
+
+    self._stats = list(stats)
+    batch = data.Batch(
+        frames=frames,
+        count=np.concatenate(counts),
+        meta=utils.concat_nest_nt(metas),
+    )
+    return batch, np.mean(epochs)
+
+  def get_stats(self) -> dict:
+    if not self._stats or not all(self._stats):
+      return {}
+    return utils.map_nt(lambda *xs: sum(xs), *self._stats)
+
+  def get_cursor(self) -> dict:
+    """Same format as MultiDataSourceMP.get_cursor."""
+    return dict(workers=list(self._cursors))
+
+class SharedWorkerPool:
+  """Worker processes that serve batches for several named streams.
+
+  Unlike separate MultiDataSourceMPs, e.g. for train and test data, one set
+  of processes holds the DataSources of all streams, and only works on a
+  stream when its batches are requested. A stream that is rarely pulled,
+  like test data, thus doesn't compete with the others for CPU while idle,
+  and only allocates its games and caches once used.
+
+  Each stream's replays are split across all workers, as in
+  MultiDataSourceMP, so every worker takes part in every batch. Streams can
+  also be added and removed while the workers run, see BatchServer.
+  """
+
+  def __init__(
+      self,
+      streams: dict[str, Union[data.ReplayTable, List[data.ReplayInfo]]],
+      num_workers: int,
+      batch_size: int = 64,
+      shared_memory: bool = False,
+      prefetch: Optional[dict[str, int]] = None,
+      weights: Optional[dict[str, float]] = None,
+      cursors: Optional[dict[str, Optional[dict]]] = None,
+      reader_kwargs: Optional[dict] = None,
+      **kwargs,
+  ):
+    """
+    Args:
+      streams: The replays of each stream, by name.
+      prefetch: Batches to request ahead per stream; defaults to 2. 0 only
+        produces a batch when the stream is pulled.
+      weights: How workers share their time between streams with pending
+        requests; defaults to 1 for each stream.
+      cursors: Per-stream cursors to resume from, see PoolStream.get_cursor.
+      reader_kwargs: If given, each worker reads the games of all streams
+        through shared GameReaders made with these arguments, one per column
+        projection, see data.make_game_reader.
+      kwargs: Passed to every stream's DataSources.
+    """
+    prefetch = prefetch or {}
+    weights = weights or {}
+    cursors = cursors or {}
+    self.num_workers = num_workers
+    self.batch_size = batch_size
+    self.shared_memory = shared_memory
+    self._kwargs = kwargs
+
+    self.streams: dict[str, PoolStream] = {}
+    # Each worker's results for each stream, filled by the _route threads.
+    self._results: dict[str, list[queue.Queue]] = {}
+    self._rings: dict[str, Optional[shm.SharedRing[data.Frames]]] = {}
+    self._lock = threading.Lock()
+
+    context = mp.get_context('spawn')
+    self._requests: list[mp.Queue] = []
+    self.processes = []
+    for i in range(num_workers):
+      requests = context.Queue()
+      results = context.Queue()
+      process = context.Process(
+          target=serve_streams,
+          args=(requests, results, reader_kwargs),
+          name='SharedWorkerPool')
+      process.start()
+      atexit.register(process.terminate)
+      threading.Thread(
+          target=self._route, args=(i, results), name='SharedWorkerPool',
+          daemon=True).start()
+
+      self._requests.append(requests)
+      self.processes.append(process)
+
+    for name, replays in streams.items():
+      self.add_stream(
+          name, replays, prefetch=prefetch.get(name, 2),
+          weight=weights.get(name, 1.), cursor=cursors.get(name))
+
+  def _route(self, worker: int, results: mp.Queue):
+    while True:
+      name, result = results.get()
+      with self._lock:
+        stream_results = self._results.get(name)
+      # Results of removed streams are dropped.
+      if stream_results is not None:
+        stream_results[worker].put(result)
+
+  def add_stream(
+      self,
+      name: str,
+      replays: Union[data.ReplayTable, List[data.ReplayInfo]],
+      batch_size: Optional[int] = None,
+      prefetch: int = 2,
+      weight: float = 1.,
+      cursor: Optional[dict] = None,
+      **kwargs,
+  ) -> PoolStream:
+    """Adds a stream; kwargs extend those given to the pool.
+
+    Args:
+      batch_size: Defaults to the pool's.
+      prefetch: Batches to request ahead, see PoolStream.
+      weight: The stream's share of the workers' time, see serve_streams.
+      cursor: A stream cursor to resume from, see PoolStream.get_cursor.
+    """
+    if name in self.streams:
+      raise ValueError(f'Stream {name} already exists.')
+    num_workers = self.num_workers
+    batch_size = batch_size or self.batch_size
+    kwargs = dict(self._kwargs, **kwargs)
+    time_major = kwargs.get('time_major', False)
+    worker_batch_size = batch_size // num_workers
+    worker_replays = data.split_replays(
+        replays, num_workers, batch_size, kwargs)
+
+    worker_cursors = [None] * num_workers
+    if cursor is not None:
+      worker_cursors = cursor['workers']
+      if len(worker_cursors) != num_workers:
+        raise ValueError(
+            f'Cursor has {len(worker_cursors)} workers, not {num_workers}.')
+
+    ring = None
+    if self.shared_memory:
+      chunk_size = (
+          kwargs.get('unroll_length', 64) + kwargs.get('extra_frames', 1))
+      spec = data.frames_spec(
+          chunk_size, batch_size, time_major, kwargs.get('preprocess'))
+      # Requested slots plus the one the trainer is using.
+      ring = shm.SharedRing(shm.NestLayout(spec), prefetch + 2)
+      atexit.register(ring.unlink)
+
+    with self._lock:
+      self._results[name] = [queue.Queue() for _ in range(num_workers)]
+      self._rings[name] = ring
+    for i, requests in enumerate(self._requests):
+      worker_kwargs = dict(
+          kwargs,
+          replays=worker_replays[i],
+          batch_size=worker_batch_size,
+          cursor=worker_cursors[i])
+      rows = slice(i * worker_batch_size, (i + 1) * worker_batch_size)
+      requests.put(('add', name, worker_kwargs, weight, ring, rows))
+
+    stream = PoolStream(
+        self, name, batch_size, time_major, prefetch, ring, worker_cursors)
+    self.streams[name] = stream
+    return stream
+
+  def remove_stream(self, name: str):
+    """Stops serving the stream and frees its shared memory."""
+    for requests in self._requests:
+      requests.put(('remove', name))
+    del self.streams[name]
+    with self._lock:
+      del self._results[name]
+      ring = self._rings.pop(name)
+    if ring is not None:
+      ring.unlink()
+
+  def request(self, name: str, slot: int):
+    for requests in self._requests:
+      requests.put(('next', name, slot))
+
+  def receive(self, name: str) -> list[tuple]:
+    with self._lock:
+      stream_results = self._results[name]
+    # Take every worker's result for this round before raising any error,
+    # so that the next round's results stay aligned.
+    results = [worker_results.get() for worker_results in stream_results]
+    for result in results:
+      if isinstance(result, Exception):
+        raise result
+    return results
+
+  def __getitem__(self, name: str) -> PoolStream:
+    return self.streams[name]
+
+  def close(self):
+    """Stops the workers and frees the shared memory of all streams."""
+    for process in self.processes:
+      process.terminate()
+    with self._lock:
+      for ring in self._rings.values():
+        if ring is not None:
+          ring.unlink()
+
+  def __del__(self):
+    self.close()
@@ -8,6 +8,7 @@ Root
   Parsed
   parsed.pkl
   meta.json
+  ZstdDicts
 
 Raw contains .zip and .7z archives of .slp files, possibly nested under
 subdirectories. The raw.json metadata file contains information about each
@@ -19,6 +20,9 @@ processed .slp file. These files are named by the MD5 hash of the .slp file,
 and are used by imitation learning. The parsed.pkl pickle file contains
 metadata about each processed .slp in Parsed.
 
+ZstdDicts holds zstd dictionaries trained on a sample of Parsed by
+slippi_db/scripts/train_zstd_dict.py, for --compression=zstd_dict.
+
 The meta.json file is created by scripts/make_local_dataset.py and is used by
 imitation learning to know which files to train on.
 TODO: consider merging meta.json and parsed.pkl
@@ -45,6 +49,8 @@ from slippi_db import preprocessing
 from slippi_db import utils
 from slippi_db import parsing_utils
 from slippi_db.parsing_utils import CompressionType
+from slippi_ai import compression as slippi_compression
+from slippi_ai.storage import StorageProfile
 
 def parse_slp(
     file: utils.LocalFile,
@@ -52,6 +58,9 @@ def parse_slp(
     tmpdir: str,
     compression: CompressionType = CompressionType.NONE,
     compression_level: Optional[int] = None,
+    row_group_size: Optional[int] = None,
+    profile: StorageProfile = StorageProfile.DEFAULT,
+    zstd_dict_path: Optional[str] = None,
 ) -> dict:
   result = dict(name=file.name)
 
@@ -81,12 +90,19 @@ def parse_slp(
 
       if is_training:
         game = parse_peppi.from_peppi(game)
+        zstd_dict = None
+        if compression == CompressionType.ZSTD_DICT:
+          zstd_dict = slippi_compression.load_dict(zstd_dict_path)
         game_bytes = parsing_utils.convert_game(
-          game, compression=compression, compression_level=compression_level)
+          game, compression=compression, compression_level=compression_level,
+          row_group_size=row_group_size, profile=profile, zstd_dict=zstd_dict)
         result.update(
             pq_size=len(game_bytes),
             compression=compression.value,
+            storage_profile=profile.value,
         )
+        if zstd_dict is not None:
+          result.update(zstd_dict_id=zstd_dict.dict_id())
 
         # TODO: consider writing to raw_name/slp_name
         with open(os.path.join(output_dir, md5), 'wb') as f:
@@ -359,6 +375,17 @@ if __name__ == '__main__':
       enum_class=parsing_utils.CompressionType,
       help='Type of compression to use.')
   COMPRESSION_LEVEL = flags.DEFINE_integer('compression_level', None, 'Compression level.')
+  ROW_GROUP_SIZE = flags.DEFINE_integer(
+      'row_group_size', None,
+      'Frames per parquet row group, for reading windows of frames.')
+  STORAGE_PROFILE = flags.DEFINE_enum_class(
+      name='storage_profile',
+      default=StorageProfile.DEFAULT,
+      enum_class=StorageProfile,
+      help='Column quantization and encodings, see slippi_ai/storage.py.')
+  ZSTD_DICT = flags.DEFINE_string(
+      'zstd_dict', None,
+      'Dictionary for --compression=zstd_dict, e.g. Root/ZstdDicts/<id>.zdict.')
   REPROCESS = flags.DEFINE_bool('reprocess', False, 'Reprocess raw archives.')
   DRY_RUN = flags.DEFINE_bool('dry_run', False, 'dry run')
 
@@ -371,6 +398,9 @@ if __name__ == '__main__':
         compression_options=dict(
             compression=COMPRESSION.value,
             compression_level=COMPRESSION_LEVEL.value,
+            row_group_size=ROW_GROUP_SIZE.value,
+            profile=STORAGE_PROFILE.value,
+            zstd_dict_path=ZSTD_DICT.value,
         ),
         reprocess=REPROCESS.value,
         dry_run=DRY_RUN.value,
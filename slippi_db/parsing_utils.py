@@ -5,13 +5,18 @@ import zlib
 
 import pyarrow as pa
 import pyarrow.parquet as pq
+import zstandard
 
-from slippi_ai import types
+from slippi_ai import storage, types
+from slippi_ai import compression as slippi_compression
 
 class CompressionType(enum.Enum):
   # zlib compresses parquet file itself
   # To read it, set compress=True in slippi_ai.data.make_source
   ZLIB = 'zlib'
+  # zstd with a trained dictionary, also of the whole file; see
+  # slippi_ai.compression. Read like ZLIB, with compressed=True.
+  ZSTD_DICT = 'zstd_dict'
   SNAPPY = 'snappy'
   GZIP = 'gzip'
   BROTLI = 'brotli'
@@ -19,8 +24,11 @@ class CompressionType(enum.Enum):
   ZSTD = 'zstd'
   NONE = 'none'
 
+  def is_whole_file(self) -> bool:
+    return self in (CompressionType.ZLIB, CompressionType.ZSTD_DICT)
+
   def for_parquet(self) -> str:
-    if self is CompressionType.ZLIB:
+    if self.is_whole_file():
       return CompressionType.NONE.value
     return self.value
 
@@ -29,11 +37,31 @@ def convert_game(
     pq_version: str = '2.4',
     compression: CompressionType = CompressionType.NONE,
     compression_level: Optional[int] = None,
+    row_group_size: Optional[int] = None,
+    profile: storage.StorageProfile = storage.StorageProfile.DEFAULT,
+    zstd_dict: Optional[zstandard.ZstdCompressionDict] = None,
 ) -> bytes:
+  """Converts a game to parquet bytes.
+
+  Args:
+    game: The game as a pyarrow StructArray.
+    pq_version: Parquet format version.
+    compression: How to compress the game.
+    compression_level: Compression level, if applicable.
+    row_group_size: Frames per parquet row group; None for a single group.
+      Fixed-size row groups let readers fetch a window of frames without
+      decoding the whole game (see data.read_frames). With whole-file
+      compression (ZLIB, ZSTD_DICT) the file still needs to be decompressed,
+      so prefer parquet's compression.
+    profile: Column quantization and encodings, see slippi_ai.storage.
+    zstd_dict: The dictionary to use with ZSTD_DICT.
+  """
+  if profile is storage.StorageProfile.COMPACT:
+    game = types.array_from_nt(storage.quantize(types.game_array_to_nt(game)))
   table = pa.Table.from_arrays([game], names=['root'])
   pq_file = io.BytesIO()
 
-  if compression == CompressionType.ZLIB:
+  if compression.is_whole_file():
     pq_compression_level = None
   else:
     pq_compression_level = compression_level
@@ -43,11 +71,17 @@ def convert_game(
       version=pq_version,
       compression=compression.for_parquet(),
       compression_level=pq_compression_level,
-      use_dictionary=False,
+      row_group_size=row_group_size,
+      **storage.parquet_options(profile),
   )
   pq_bytes = pq_file.getvalue()
 
   if compression == CompressionType.ZLIB:
     level = -1 if compression_level is None else compression_level
     pq_bytes = zlib.compress(pq_bytes, level=level)
+  elif compression == CompressionType.ZSTD_DICT:
+    if zstd_dict is None:
+      raise ValueError('ZSTD_DICT compression requires a zstd_dict.')
+    pq_bytes = slippi_compression.compress_zstd(
+        pq_bytes, zstd_dict, compression_level)
   return pq_bytes
@@ -13,7 +13,7 @@ from typing import Optional
 
 from absl import app, flags
 
-from slippi_ai import nametags
+from slippi_ai import meta_index, nametags
 
 ROOT = flags.DEFINE_string('root', None, 'root directory', required=True)
 WINNER_ONLY = flags.DEFINE_boolean(
@@ -123,8 +123,13 @@ def main(_):
   with open(meta_path, 'w') as f:
     json.dump(valid, f, indent=2)
 
+  # Columnar version of the metadata, for faster dataset selection.
+  index_path = os.path.join(ROOT.value, 'meta' + meta_index.INDEX_SUFFIX)
+  meta_index.write_index(index_path, meta_index.build_index(valid))
+
   if make_tar:
     tar.add(meta_path, arcname='meta.json')
+    tar.add(index_path, arcname='meta' + meta_index.INDEX_SUFFIX)
     tar.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,35 @@
+"""Converts meta.json into a columnar metadata index.
+
+python slippi_db/scripts/make_meta_index.py --meta_path=Root/meta.json
+
+Writes Root/meta.parquet by default, which can then be used as the
+dataset's meta_path in place of meta.json.
+"""
+
+import json
+import os
+
+from absl import app, flags
+
+from slippi_ai import meta_index
+
+META_PATH = flags.DEFINE_string(
+    'meta_path', None, 'Path to meta.json.', required=True)
+OUTPUT = flags.DEFINE_string(
+    'output', None, 'Output path; defaults to meta.parquet next to meta.json.')
+
+def main(_):
+  with open(META_PATH.value) as f:
+    meta_rows: list[dict] = json.load(f)
+
+  output = OUTPUT.value
+  if output is None:
+    output = os.path.join(
+        os.path.dirname(META_PATH.value), 'meta' + meta_index.INDEX_SUFFIX)
+
+  table = meta_index.build_index(meta_rows)
+  meta_index.write_index(output, table)
+  print(f'Wrote {table.num_rows} rows to {output}.')
+
+if __name__ == '__main__':
+  app.run(main)
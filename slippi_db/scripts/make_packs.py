@@ -0,0 +1,66 @@
+"""Packs a directory of parsed games into a few large pack files.
+
+python slippi_db/scripts/make_packs.py \
+  --data_dir=Root/Parsed --meta_path=Root/meta.json --pack_dir=Root/Packed \
+  --partition=matchup
+
+The resulting pack directory can be used as the dataset's data_dir. With
+--partition=matchup each pack only holds games of a single character pair,
+so runs that filter by character only touch the packs they need.
+"""
+
+import json
+import os
+
+from absl import app, flags
+
+from slippi_ai import compression, pack_files
+
+DATA_DIR = flags.DEFINE_string('data_dir', None, 'Parsed games.', required=True)
+PACK_DIR = flags.DEFINE_string('pack_dir', None, 'Output dir.', required=True)
+META_PATH = flags.DEFINE_string(
+    'meta_path', None, 'meta.json; if given, only pack the games listed.')
+PARTITION = flags.DEFINE_enum(
+    'partition', 'none', ['none', 'matchup'], 'How to partition the packs.')
+MAX_PACK_SIZE = flags.DEFINE_float(
+    'max_pack_size', 1.0, 'Maximum pack size in GB.')
+COMPRESSED = flags.DEFINE_boolean(
+    'compressed', True, 'Whether the games are compressed.')
+ZSTD_DICT_DIR = flags.DEFINE_string(
+    'zstd_dict_dir', None, 'Dictionaries of zstd_dict-compressed games.')
+
+def main(_):
+  if ZSTD_DICT_DIR.value:
+    compression.load_dir(ZSTD_DICT_DIR.value)
+
+  if META_PATH.value:
+    with open(META_PATH.value) as f:
+      meta_rows: list[dict] = json.load(f)
+    md5s = [row['slp_md5'] for row in meta_rows]
+  else:
+    meta_rows = []
+    md5s = sorted(os.listdir(DATA_DIR.value))
+
+  partition_fn = None
+  if PARTITION.value == 'matchup':
+    if not META_PATH.value:
+      raise ValueError('Partitioning by matchup requires --meta_path.')
+    matchups = {row['slp_md5']: pack_files.matchup_key(row) for row in meta_rows}
+    partition_fn = matchups.__getitem__
+    # Pack each partition contiguously.
+    md5s.sort(key=lambda md5: (matchups[md5], md5))
+
+  index = pack_files.pack_games(
+      data_dir=DATA_DIR.value,
+      pack_dir=PACK_DIR.value,
+      md5s=md5s,
+      compressed=COMPRESSED.value,
+      partition_fn=partition_fn,
+      max_pack_size_gb=MAX_PACK_SIZE.value,
+  )
+
+  num_packs = len(set(entry.pack for entry in index.values()))
+  print(f'Packed {len(index)} games into {num_packs} packs.')
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,53 @@
+"""Trains a zstd dictionary on a sample of parsed games.
+
+python slippi_db/scripts/train_zstd_dict.py --root=Root
+
+The dictionary is written to Root/ZstdDicts/<id>.zdict. Games can then be
+parsed with it:
+
+python slippi_db/parse_local.py --root=Root --compression=zstd_dict \
+  --zstd_dict=Root/ZstdDicts/<id>.zdict
+
+and read by setting data.zstd_dict_dir=Root/ZstdDicts.
+"""
+
+import os
+import zlib
+
+from absl import app, flags
+
+from slippi_ai import compression
+
+ROOT = flags.DEFINE_string('root', None, 'root directory', required=True)
+NUM_SAMPLES = flags.DEFINE_integer(
+    'num_samples', 1000, 'Number of games to train on.')
+NUM_EVAL = flags.DEFINE_integer(
+    'num_eval', 100, 'Number of other games to compare against zlib on.')
+DICT_SIZE_KB = flags.DEFINE_integer('dict_size_kb', 112, 'Dictionary size.')
+LEVEL = flags.DEFINE_integer(
+    'level', compression.DEFAULT_ZSTD_LEVEL, 'Compression level.')
+SEED = flags.DEFINE_integer('seed', 0, 'Seed for sampling games.')
+
+def main(_):
+  parsed_dir = os.path.join(ROOT.value, 'Parsed')
+  samples = compression.sample_games(
+      parsed_dir, NUM_SAMPLES.value + NUM_EVAL.value, seed=SEED.value)
+  train, test = samples[:NUM_SAMPLES.value], samples[NUM_SAMPLES.value:]
+
+  dictionary = compression.train_dict(
+      train, dict_size=DICT_SIZE_KB.value * 1024, level=LEVEL.value)
+  path = compression.save_dict(
+      dictionary, os.path.join(ROOT.value, 'ZstdDicts'))
+  print(f'Wrote dictionary {dictionary.dict_id()} to {path}.')
+
+  if test:
+    raw_size = sum(map(len, test))
+    zlib_size = sum(len(zlib.compress(game)) for game in test)
+    zstd_size = sum(
+        len(compression.compress_zstd(game, dictionary, LEVEL.value))
+        for game in test)
+    print(f'Held-out ratios: zlib={raw_size / zlib_size:.1f} '
+          f'zstd_dict={raw_size / zstd_size:.1f}')
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,217 @@
+"""Synthetic parsed datasets, for benchmarking the data pipeline.
+
+Games follow the Game schema with roughly the statistics of real ones:
+actions, buttons, sticks and velocities change in runs of several frames,
+and controller values lie on the raw grid (so they quantize, see
+slippi_ai/storage.py). The layout matches parse_local.py:
+
+Root
+  Parsed
+  meta.json
+"""
+
+import hashlib
+import json
+import os
+from typing import Callable, Optional
+
+import numpy as np
+
+import melee
+
+from slippi_ai import compression, storage, types
+from slippi_ai import meta_index
+from slippi_db import parsing_utils
+
+# Characters that appear in the usual training sets.
+CHARACTERS = [
+    melee.Character.FOX, melee.Character.FALCO, melee.Character.MARTH,
+    melee.Character.SHEIK, melee.Character.CPTFALCON, melee.Character.PEACH,
+    melee.Character.JIGGLYPUFF,
+]
+STAGES = [
+    melee.Stage.FINAL_DESTINATION, melee.Stage.BATTLEFIELD,
+    melee.Stage.POKEMON_STADIUM, melee.Stage.DREAMLAND,
+    melee.Stage.YOSHIS_STORY, melee.Stage.FOUNTAIN_OF_DREAMS,
+]
+
+def _runs(
+    rng: np.random.Generator,
+    num_frames: int,
+    mean_length: float,
+    sample: Callable[[int], np.ndarray],
+) -> np.ndarray:
+  """Piecewise-constant values, with geometric run lengths."""
+  changes = rng.random(num_frames) < 1 / mean_length
+  changes[0] = True
+  run_ids = np.cumsum(changes) - 1
+  return sample(run_ids[-1] + 1)[run_ids]
+
+def _position(
+    rng: np.random.Generator, num_frames: int, speed: float) -> np.ndarray:
+  """Integrates piecewise-constant velocities; still half of the time."""
+  velocity = _runs(rng, num_frames, 15, lambda n: np.where(
+      rng.random(n) < 0.5, 0, rng.normal(scale=speed, size=n)))
+  return np.cumsum(velocity.astype(np.float32), dtype=np.float32)
+
+def _controller(rng: np.random.Generator, num_frames: int) -> types.Controller:
+  def axis():
+    raw = _runs(rng, num_frames, 6, lambda n: np.where(
+        rng.random(n) < 0.4, 0, rng.integers(-80, 81, n)).astype(np.int8))
+    return storage.AXIS.decode(raw)
+
+  def stick():
+    return types.Stick(x=axis(), y=axis())
+
+  shoulder = _runs(rng, num_frames, 20, lambda n: np.where(
+      rng.random(n) < 0.9, 0, rng.integers(43, 141, n)).astype(np.uint8))
+
+  # Mostly one button at a time.
+  buttons = _runs(rng, num_frames, 5, lambda n: np.where(
+      rng.random(n) < 0.7, 0, 1 << rng.integers(0, 8, n)).astype(np.uint8))
+
+  return types.Controller(
+      main_stick=stick(),
+      c_stick=stick(),
+      shoulder=storage.TRIGGER.decode(shoulder),
+      buttons=types.unpack_buttons(buttons),
+  )
+
+def _player(
+    rng: np.random.Generator,
+    num_frames: int,
+    character: int,
+) -> types.Player:
+  bools = lambda mean_length: _runs(
+      rng, num_frames, mean_length, lambda n: rng.random(n) < 0.5)
+
+  hits = rng.random(num_frames) < 0.01
+  damage = np.where(hits, rng.integers(1, 20, num_frames), 0)
+  percent = np.cumsum(damage)
+  # Back to 0% at the start of each of the four stocks.
+  stock = np.arange(num_frames) * 4 // num_frames
+  stock_start = np.searchsorted(stock, stock)
+  percent -= percent[stock_start] - damage[stock_start]
+
+  return types.Player(
+      percent=np.minimum(percent, 999).astype(np.uint16),
+      facing=bools(60),
+      x=_position(rng, num_frames, 1.),
+      y=_position(rng, num_frames, 0.5),
+      action=_runs(rng, num_frames, 10, lambda n: rng.integers(
+          0, 0x18F, n, dtype=np.uint16)),
+      invulnerable=_runs(rng, num_frames, 50, lambda n: rng.random(n) < 0.1),
+      character=np.full(num_frames, character, np.uint8),
+      jumps_left=_runs(rng, num_frames, 40, lambda n: rng.integers(
+          0, 3, n, dtype=np.uint8)),
+      shield_strength=np.full(num_frames, 60, np.float32),
+      on_ground=bools(30),
+      controller=_controller(rng, num_frames),
+  )
+
+def random_game(
+    rng: np.random.Generator,
+    num_frames: int,
+    characters: tuple[int, int],
+    stage: int,
+) -> types.Game:
+  return types.Game(
+      p0=_player(rng, num_frames, characters[0]),
+      p1=_player(rng, num_frames, characters[1]),
+      stage=np.full(num_frames, stage, np.uint8),
+  )
+
+def _player_meta(port: int, character: int, name: str) -> dict:
+  return dict(
+      port=port,
+      character=character,
+      type=0,
+      name_tag='',
+      netplay=dict(name=name, code='', suid=''),
+  )
+
+def make_dataset(
+    root: str,
+    num_games: int,
+    num_frames: int = 8000,
+    compression_type: parsing_utils.CompressionType = (
+        parsing_utils.CompressionType.ZLIB),
+    compression_level: Optional[int] = None,
+    profile: storage.StorageProfile = storage.StorageProfile.DEFAULT,
+    row_group_size: Optional[int] = None,
+    zstd_dict_dir: Optional[str] = None,
+    seed: int = 0,
+) -> list[dict]:
+  """Writes num_games random games to root/Parsed and root/meta.json.
+
+  Args:
+    num_frames: Mean game length; lengths vary by up to 25%.
+    compression_type: As in parse_local.py. With ZSTD_DICT, a dictionary is
+      first trained on a few of the games and saved to zstd_dict_dir.
+  Returns:
+    The meta.json rows.
+  """
+  rng = np.random.default_rng(seed)
+  parsed_dir = os.path.join(root, 'Parsed')
+  os.makedirs(parsed_dir, exist_ok=True)
+
+  def sample_game(index: int) -> tuple[dict, types.Game]:
+    length = int(num_frames * rng.uniform(0.75, 1.25))
+    characters = tuple(
+        CHARACTERS[i].value for i in rng.integers(len(CHARACTERS), size=2))
+    stage = STAGES[rng.integers(len(STAGES))].value
+    game = random_game(rng, length, characters, stage)
+    md5 = hashlib.md5(f'synthetic-{seed}-{index}'.encode()).hexdigest()
+    row = dict(
+        name=f'synthetic/{md5}.slp',
+        slp_md5=md5,
+        lastFrame=length + meta_index.FIRST_FRAME - 1,
+        num_players=2,
+        players=[
+            _player_meta(port, character, f'Player {index}-{port}')
+            for port, character in zip([1, 2], characters)],
+        stage=stage,
+        is_teams=False,
+        winner=None,
+        valid=True,
+        is_training=True,
+        not_training_reason='',
+        raw='synthetic.7z',
+        compression=compression_type.value,
+    )
+    return row, game
+
+  zstd_dict = None
+  if compression_type == parsing_utils.CompressionType.ZSTD_DICT:
+    if zstd_dict_dir is None:
+      raise ValueError('ZSTD_DICT compression requires a zstd_dict_dir.')
+    # Train on games that aren't part of the dataset.
+    train_rng = np.random.default_rng([seed, 1])
+    characters = (CHARACTERS[0].value, CHARACTERS[1].value)
+    samples = [
+        parsing_utils.convert_game(types.array_from_nt(random_game(
+            train_rng, num_frames, characters, STAGES[0].value)),
+            profile=profile)
+        for _ in range(8)]
+    zstd_dict = compression.train_dict(samples)
+    compression.save_dict(zstd_dict, zstd_dict_dir)
+
+  rows = []
+  for index in range(num_games):
+    row, game = sample_game(index)
+    game_bytes = parsing_utils.convert_game(
+        types.array_from_nt(game),
+        compression=compression_type,
+        compression_level=compression_level,
+        row_group_size=row_group_size,
+        profile=profile,
+        zstd_dict=zstd_dict,
+    )
+    with open(os.path.join(parsed_dir, row['slp_md5']), 'wb') as f:
+      f.write(game_bytes)
+    row.update(pq_size=len(game_bytes), storage_profile=profile.value)
+    rows.append(row)
+
+  with open(os.path.join(root, 'meta.json'), 'w') as f:
+    json.dump(rows, f)
+  return rows
@@ -0,0 +1,1011 @@
+import copy
+import itertools
+import json
+import multiprocessing as mp
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from multiprocessing import connection as mp_connection
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from slippi_ai import data, game_cache, meta_index, pack_files, paths, utils
+from slippi_ai import batch_server, compression, storage, worker_pool
+from slippi_ai import types
+from slippi_db import parsing_utils, synthetic
+
+TOY_GAMES = sorted(os.listdir(paths.TOY_DATA_DIR))
+
+def toy_dataset() -> data.DatasetConfig:
+  return data.DatasetConfig(
+      data_dir=str(paths.TOY_DATA_DIR),
+      meta_path=str(paths.TOY_META_PATH),
+  )
+
+def toy_replays() -> list[data.ReplayInfo]:
+  return data.replays_from_meta(toy_dataset())
+
+def assert_games_equal(g1: data.Game, g2: data.Game):
+  utils.map_nt(np.testing.assert_array_equal, g1, g2)
+
+class PackFilesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.pack_dir = tempfile.mkdtemp()
+    pack_files.pack_games(
+        data_dir=str(paths.TOY_DATA_DIR),
+        pack_dir=self.pack_dir,
+        md5s=TOY_GAMES,
+    )
+
+  def tearDown(self):
+    shutil.rmtree(self.pack_dir)
+
+  def test_index(self):
+    index = pack_files.read_index(self.pack_dir)
+    self.assertEqual(sorted(index), TOY_GAMES)
+
+    for md5, entry in index.items():
+      game = data.read_table(
+          os.path.join(paths.TOY_DATA_DIR, md5), compressed=True)
+      self.assertEqual(entry.num_frames, data.game_len(game))
+
+  def test_read_from_pack(self):
+    reader = data.GameReader(compressed=True)
+    for md5 in TOY_GAMES:
+      expected = data.read_table(
+          os.path.join(paths.TOY_DATA_DIR, md5), compressed=True)
+      actual = reader.read(os.path.join(self.pack_dir, md5))
+      assert_games_equal(expected, actual)
+
+  def test_train_test_split(self):
+    config = data.DatasetConfig(
+        data_dir=self.pack_dir,
+        meta_path=str(paths.TOY_META_PATH),
+        test_ratio=0.5,
+    )
+    train, test = data.train_test_split(config)
+    source = data.DataSource(
+        list(train) + list(test), batch_size=2, unroll_length=8)
+    next(source)
+
+class MetaIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    with open(paths.TOY_META_PATH) as f:
+      [row] = json.load(f)
+
+    # Vary characters and names so that the filters have something to do.
+    rows = []
+    characters = [1, 2, 20, 22]  # fox, captain falcon, falco, marth
+    for i, (c0, c1) in enumerate(itertools.product(characters, repeat=2)):
+      new_row = copy.deepcopy(row)
+      new_row['slp_md5'] = f'{i:032x}'
+      new_row['players'][0]['character'] = c0
+      new_row['players'][1]['character'] = c1
+      name = ['Mang0', 'Foo', 'Bar'][i % 3]
+      new_row['players'][i % 2]['netplay']['name'] = name
+      rows.append(new_row)
+
+    self.tmpdir = tempfile.mkdtemp()
+    self.meta_path = os.path.join(self.tmpdir, 'meta.json')
+    with open(self.meta_path, 'w') as f:
+      json.dump(rows, f)
+    self.index_path = os.path.join(self.tmpdir, 'meta.parquet')
+    meta_index.write_index(self.index_path, meta_index.build_index(rows))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_matches_meta_json(self):
+    configs = [
+        dict(),
+        dict(swap=False),
+        dict(allowed_characters='fox,falco'),
+        dict(allowed_characters='fox', allowed_opponents='marth', swap=False),
+        dict(allowed_names='Foo,Master Player'),
+        dict(banned_names='Bar', allowed_opponents='falco'),
+    ]
+    for kwargs in configs:
+      config = data.DatasetConfig(
+          data_dir='games', meta_path=self.meta_path, **kwargs)
+      expected = data.replays_from_meta(config)
+      config.meta_path = self.index_path
+      actual = data.load_replays(config)
+      self.assertEqual(expected, actual, kwargs)
+
+class ReplayTableTest(unittest.TestCase):
+
+  def setUp(self):
+    replays = toy_replays()
+    info = replays[0]
+    self.replays = []
+    for i in range(10):
+      md5 = f'{i // 2:032x}'
+      self.replays.append(info._replace(
+          path=os.path.join('dir', md5),
+          swap=bool(i % 2),
+          meta=info.meta._replace(slp_md5=md5)))
+
+  def test_round_trip(self):
+    table = data.ReplayTable.from_replays(self.replays)
+    self.assertEqual(list(table), self.replays)
+    self.assertEqual(list(table.take(np.arange(1, 10, 3))), self.replays[1::3])
+
+  def test_group_by_path(self):
+    table = data.ReplayTable.from_replays(self.replays[::-1])
+    groups = table.group_by_path()
+    self.assertEqual(len(groups), 5)
+    for group in groups:
+      paths = {table[i].path for i in group}
+      self.assertEqual(len(paths), 1)
+
+  def test_name_codes(self):
+    main_name = self.replays[0].main_player.name
+    table = data.ReplayTable.from_replays(self.replays, {main_name: 3})
+    for i, replay in enumerate(self.replays):
+      expected = 3 if replay.main_player.name == main_name else 4
+      self.assertEqual(table.name_code(i), expected)
+
+  def test_shared_pickle(self):
+    replays = self.replays * 100
+    table = data.ReplayTable.from_replays(replays)
+    size = len(pickle.dumps(table))
+    table.share()
+    try:
+      view = table.take(np.arange(10))
+      pickled = pickle.dumps(view)
+      self.assertLess(len(pickled), size / 4)
+      self.assertEqual(list(pickle.loads(pickled)), replays[:10])
+    finally:
+      table.unlink()
+
+  def test_views_share_once(self):
+    table = data.ReplayTable.from_replays(self.replays)
+    train, test = table.take(np.arange(8)), table.take(np.arange(8, 10))
+    train.share()
+    try:
+      test.share()
+      self.assertIs(test.columns, train.columns)
+      self.assertIs(table.columns, train.columns)
+    finally:
+      table.unlink()
+
+class TrainTestSplitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    with open(paths.TOY_META_PATH) as f:
+      [self.row] = json.load(f)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def split(self, num_games: int) -> tuple[set[str], set[str]]:
+    rows = [dict(self.row, slp_md5=f'{i:032x}') for i in range(num_games)]
+    meta_path = os.path.join(self.tmpdir, 'meta.json')
+    with open(meta_path, 'w') as f:
+      json.dump(rows, f)
+
+    config = data.DatasetConfig(
+        data_dir='games', meta_path=meta_path, test_ratio=0.2)
+    train, test = data.train_test_split(config)
+    key = lambda info: (info.path, info.swap)
+    return set(map(key, train)), set(map(key, test))
+
+  def test_stable_as_dataset_grows(self):
+    train, test = self.split(100)
+    self.assertFalse(train & test)
+    self.assertEqual(len(train) + len(test), 200)
+    self.assertAlmostEqual(len(test) / 200, 0.2, delta=0.1)
+
+    more_train, more_test = self.split(150)
+    self.assertLessEqual(train, more_train)
+    self.assertLessEqual(test, more_test)
+
+  def test_perspectives_share_split(self):
+    train, test = self.split(100)
+    train_games = {path for path, _ in train}
+    test_games = {path for path, _ in test}
+    self.assertFalse(train_games & test_games)
+    self.assertEqual(len(train), 2 * len(train_games))
+
+class MemoryGameCacheTest(unittest.TestCase):
+
+  def test_lru(self):
+    game = data.read_table(
+        os.path.join(paths.TOY_DATA_DIR, TOY_GAMES[0]), compressed=True)
+    game_size = game_cache.game_nbytes(game)
+
+    cache = game_cache.MemoryGameCache(max_size_gb=2.5 * game_size / 1024 ** 3)
+    cache.put('a', game)
+    cache.put('b', game)
+    cache.get('a')
+    cache.put('c', game)
+
+    self.assertEqual(len(cache), 2)
+    self.assertIsNone(cache.get('b'))
+    self.assertIs(cache.get('a'), game)
+    self.assertIs(cache.get('c'), game)
+
+  def test_swapped_replays_share_decode(self):
+    source = data.DataSource(
+        toy_replays(), batch_size=2, unroll_length=8, cache_size_gb=1)
+    batch, _ = next(source)
+
+    self.assertEqual(
+        source.get_stats(), dict(memory_cache=dict(hits=1, misses=1)))
+    p0 = batch.frames.state_action.state.p0
+    p1 = batch.frames.state_action.state.p1
+    np.testing.assert_array_equal(p0.x[0], p1.x[1])
+
+class DiskGameCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def test_round_trip(self):
+    cache = game_cache.DiskGameCache(self.cache_dir, max_size_gb=1)
+    reader = data.GameReader(compressed=True, disk_cache=cache)
+
+    for md5 in TOY_GAMES:
+      path = os.path.join(paths.TOY_DATA_DIR, md5)
+      expected = data.read_table(path, compressed=True)
+      assert_games_equal(expected, reader.read(path))  # miss
+      cached = reader.read(path)  # hit
+      self.assertIsInstance(cached.p0.x, np.memmap)
+      assert_games_equal(expected, cached)
+
+    self.assertEqual(cache.hits, len(TOY_GAMES))
+    self.assertEqual(cache.misses, len(TOY_GAMES))
+
+  def test_projection_placeholders_not_stored(self):
+    path = os.path.join(paths.TOY_DATA_DIR, TOY_GAMES[0])
+    columns = {('p0', 'x'), ('stage',)}
+    game = data.read_table(path, compressed=True)
+    projected = data.read_table(path, compressed=True, columns=columns)
+
+    cache = game_cache.DiskGameCache(self.cache_dir, max_size_gb=1)
+    cache.put('full', game)
+    cache.put('projected', projected)
+    self.assertLess(
+        os.path.getsize(cache._path('projected')),
+        os.path.getsize(cache._path('full')) / 10)
+
+    cached = cache.get('projected')
+    assert_games_equal(projected, cached)
+    self.assertIsInstance(cached.p0.x, np.memmap)
+    self.assertEqual(cached.p0.y.strides, (0,))
+
+  def test_eviction(self):
+    game = data.read_table(
+        os.path.join(paths.TOY_DATA_DIR, TOY_GAMES[0]), compressed=True)
+    cache = game_cache.DiskGameCache(self.cache_dir, max_size_gb=1)
+    cache.put('a', game)
+    game_size = os.path.getsize(cache._path('a'))
+
+    # Room for two games.
+    cache.max_size = 2.5 * game_size
+    cache.put('b', game)
+    os.utime(cache._path('a'), (0, 0))
+    os.utime(cache._path('b'), (1, 1))
+    cache.put('c', game)
+
+    self.assertIsNone(cache.get('a'))
+    self.assertIsNotNone(cache.get('b'))
+    self.assertIsNotNone(cache.get('c'))
+
+  def test_replace_keeps_size(self):
+    game = data.read_table(
+        os.path.join(paths.TOY_DATA_DIR, TOY_GAMES[0]), compressed=True)
+    cache = game_cache.DiskGameCache(self.cache_dir, max_size_gb=1)
+    cache.put('a', game)
+    size = cache._size
+    cache.put('a', game)
+    self.assertEqual(cache._size, size)
+
+class SharedGameArenaTest(unittest.TestCase):
+
+  def test_preload(self):
+    replays = data.ReplayTable.from_replays(toy_replays())
+    columns = {('p0', 'x'), ('p0', 'controller', 'shoulder'), ('stage',)}
+    arena = data.preload_games(replays, columns=columns)
+    self.assertEqual(len(arena), len(replays.group_by_path()))
+
+    attached = pickle.loads(pickle.dumps(arena))
+    reader = data.GameReader(columns=columns)
+    for info in replays:
+      expected = reader.read(info.path, info.swap)
+      # Both perspectives' columns are stored.
+      actual = attached.get(info.path)
+      self.assertFalse(actual.p1.x.flags.writeable)
+      main = actual.p1 if info.swap else actual.p0
+      expected_main = expected.p1 if info.swap else expected.p0
+      np.testing.assert_array_equal(main.x, expected_main.x)
+      np.testing.assert_array_equal(actual.stage, expected.stage)
+      self.assertEqual(actual.p0.y.strides, (0,))
+
+    self.assertIsNone(arena.get('missing'))
+    arena.unlink()
+
+  def test_non_ascii_keys(self):
+    path = os.path.join(paths.TOY_DATA_DIR, TOY_GAMES[0])
+    game = data.read_table(path, compressed=True)
+    keys = ['b/ゲーム', 'a/jeu-é']
+    arena = game_cache.SharedGameArena.build(
+        keys, [data.game_len(game)] * 2, lambda _: game)
+    try:
+      for key in keys:
+        assert_games_equal(game, arena.get(key))
+    finally:
+      arena.unlink()
+
+class ColumnProjectionTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = os.path.join(paths.TOY_DATA_DIR, TOY_GAMES[0])
+    self.game = data.read_table(self.path, compressed=True)
+
+  def test_all_columns(self):
+    projected = data.read_table(
+        self.path, compressed=True, columns=data.GAME_PATHS)
+    assert_games_equal(self.game, projected)
+
+  def test_placeholders(self):
+    columns = {('p0', 'x'), ('p1', 'controller', 'shoulder'), ('stage',)}
+    projected = data.read_table(self.path, compressed=True, columns=columns)
+
+    for path, expected, actual in zip(
+        data.GAME_PATHS,
+        utils.flatten_nt(self.game),
+        utils.flatten_nt(projected)):
+      self.assertEqual(expected.dtype, actual.dtype)
+      if path in columns:
+        np.testing.assert_array_equal(expected, actual)
+      else:
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertEqual(actual.strides, (0,))
+        self.assertFalse(np.any(actual))
+
+  def test_required_game_paths(self):
+    columns = data.required_game_paths(
+        [('state', 'p1', 'jumps_left'), ('action', 'shoulder'), ('name',)])
+    self.assertIn(('p1', 'jumps_left'), columns)
+    self.assertIn(('p0', 'controller', 'shoulder'), columns)
+    self.assertNotIn(('p1', 'controller', 'shoulder'), columns)
+    self.assertTrue(set(columns) <= set(data.GAME_PATHS))
+
+  def test_swapped_projection(self):
+    reader = data.GameReader(columns=[('p0', 'controller', 'shoulder')])
+    game = reader.read(self.path, swap=True)
+    np.testing.assert_array_equal(
+        game.p1.controller.shoulder, self.game.p1.controller.shoulder)
+    self.assertEqual(game.p0.controller.shoulder.strides, (0,))
+
+class RangeReadTest(unittest.TestCase):
+
+  def setUp(self):
+    self.game = data.read_table(
+        os.path.join(paths.TOY_DATA_DIR, TOY_GAMES[0]), compressed=True)
+    self.data_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.data_dir, TOY_GAMES[0])
+    contents = parsing_utils.convert_game(
+        types.array_from_nt(self.game), row_group_size=16)
+    with open(self.path, 'wb') as f:
+      f.write(contents)
+
+  def tearDown(self):
+    shutil.rmtree(self.data_dir)
+
+  def assert_range(self, actual: data.Game, start: int, end: int):
+    expected = utils.map_nt(lambda a: a[start:end], self.game)
+    assert_games_equal(expected, actual)
+
+  def test_read_frames(self):
+    for start, end in [(0, 16), (5, 40), (16, 17), (100, 300)]:
+      game = data.read_frames(self.path, compressed=False, start=start, end=end)
+      self.assert_range(game, start, end)
+
+    num_frames = data.game_len(self.game)
+    game = data.read_frames(self.path, False, num_frames - 20, num_frames)
+    self.assert_range(game, num_frames - 20, num_frames)
+
+    with self.assertRaises(ValueError):
+      data.read_frames(self.path, False, num_frames - 20, num_frames + 1)
+
+  def test_projection(self):
+    columns = {('p0', 'x'), ('stage',)}
+    game = data.read_frames(self.path, False, 10, 50, columns=columns)
+    np.testing.assert_array_equal(game.p0.x, self.game.p0.x[10:50])
+    self.assertEqual(game.p1.x.shape, (40,))
+    self.assertEqual(game.p1.x.strides, (0,))
+
+  def test_reader_from_pack(self):
+    pack_dir = os.path.join(self.data_dir, 'packs')
+    pack_files.pack_games(
+        self.data_dir, pack_dir, TOY_GAMES[:1], compressed=False)
+    reader = data.GameReader(compressed=False)
+    game = reader.read_range(
+        os.path.join(pack_dir, TOY_GAMES[0]), swap=False, start=30, end=70)
+    self.assert_range(game, 30, 70)
+
+class StorageProfileTest(unittest.TestCase):
+
+  def setUp(self):
+    self.game = data.read_table(
+        os.path.join(paths.TOY_DATA_DIR, TOY_GAMES[0]), compressed=True)
+    self.data_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.data_dir, TOY_GAMES[0])
+    contents = parsing_utils.convert_game(
+        types.array_from_nt(self.game), row_group_size=16,
+        profile=storage.StorageProfile.COMPACT)
+    with open(self.path, 'wb') as f:
+      f.write(contents)
+
+  def tearDown(self):
+    shutil.rmtree(self.data_dir)
+
+  def test_quantized_columns(self):
+    schema = pq.read_schema(self.path)
+    main_stick = schema.field('root').type.field('p0').type.field(
+        'controller').type.field('main_stick').type
+    self.assertEqual(main_stick.field('x').type, pa.int8())
+
+    game = types.array_from_nt(self.game)
+    default = parsing_utils.convert_game(game)
+    compact = parsing_utils.convert_game(
+        game, profile=storage.StorageProfile.COMPACT)
+    self.assertLess(len(compact), len(default))
+
+  def test_read_table(self):
+    game = data.read_table(self.path, compressed=False)
+    assert_games_equal(self.game, game)
+    for expected, actual in zip(
+        utils.flatten_nt(self.game), utils.flatten_nt(game)):
+      self.assertEqual(expected.dtype, actual.dtype)
+
+  def test_read_frames(self):
+    game = data.read_frames(self.path, compressed=False, start=10, end=50)
+    assert_games_equal(utils.map_nt(lambda a: a[10:50], self.game), game)
+
+    columns = {('p0', 'controller', 'shoulder'), ('stage',)}
+    game = data.read_frames(self.path, False, 10, 50, columns=columns)
+    np.testing.assert_array_equal(
+        game.p0.controller.shoulder, self.game.p0.controller.shoulder[10:50])
+    self.assertEqual(game.p0.controller.shoulder.dtype, np.float32)
+
+class ZstdDictTest(unittest.TestCase):
+
+  def setUp(self):
+    self.game = data.read_table(
+        os.path.join(paths.TOY_DATA_DIR, TOY_GAMES[0]), compressed=True)
+    game_array = types.array_from_nt(self.game)
+    self.tmp_dir = tempfile.mkdtemp()
+
+    raw = parsing_utils.convert_game(game_array)
+    dictionary = compression.train_dict([raw], dict_size=16 * 1024)
+    self.dict_dir = os.path.join(self.tmp_dir, 'dicts')
+    compression.save_dict(dictionary, self.dict_dir)
+
+    self.data_dir = os.path.join(self.tmp_dir, 'games')
+    os.makedirs(self.data_dir)
+    self.path = os.path.join(self.data_dir, TOY_GAMES[0])
+    self.contents = parsing_utils.convert_game(
+        game_array, compression=parsing_utils.CompressionType.ZSTD_DICT,
+        zstd_dict=dictionary)
+    with open(self.path, 'wb') as f:
+      f.write(self.contents)
+    self.dict_id = dictionary.dict_id()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_read(self):
+    self.assertTrue(compression.is_zstd(self.contents))
+    self.assertEqual(compression.dict_id(self.contents), self.dict_id)
+
+    reader = data.GameReader(compressed=True, zstd_dict_dir=self.dict_dir)
+    assert_games_equal(self.game, reader.read(self.path))
+    game = reader.read_range(self.path, swap=False, start=10, end=50)
+    assert_games_equal(utils.map_nt(lambda a: a[10:50], self.game), game)
+    self.assertEqual(reader.num_frames(self.path), data.game_len(self.game))
+
+  def test_pack(self):
+    compression.load_dir(self.dict_dir)
+    pack_dir = os.path.join(self.tmp_dir, 'packs')
+    pack_files.pack_games(self.data_dir, pack_dir, TOY_GAMES[:1])
+    reader = data.GameReader(compressed=True)
+    game = reader.read(os.path.join(pack_dir, TOY_GAMES[0]))
+    assert_games_equal(self.game, game)
+
+class SyntheticDatasetTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def test_make_dataset(self):
+    rows = synthetic.make_dataset(
+        self.root, num_games=3, num_frames=500,
+        profile=storage.StorageProfile.COMPACT)
+    replays = data.replays_from_meta(data.DatasetConfig(
+        data_dir=os.path.join(self.root, 'Parsed'),
+        meta_path=os.path.join(self.root, 'meta.json')))
+    self.assertEqual(len(replays), 2 * len(rows))
+
+    for replay in replays:
+      game = data.read_table(replay.path, compressed=True)
+      self.assertEqual(data.game_len(game), replay.meta.num_frames)
+      # Controller values are on the raw grid, so they were quantized.
+      with open(replay.path, 'rb') as f:
+        contents = compression.decompress(f.read())
+      schema = pq.read_schema(pa.BufferReader(contents))
+      shoulder = schema.field('root').type.field('p0').type.field(
+          'controller').type.field('shoulder')
+      self.assertEqual(shoulder.type, pa.uint8())
+
+    source = data.DataSource(replays, batch_size=2, unroll_length=16)
+    batch, _ = next(source)
+    self.assertEqual(batch.frames.is_resetting.shape, (2, 17))
+
+def swap_frames(frames: data.Frames) -> data.Frames:
+  return utils.map_nt(lambda x: np.swapaxes(x, 0, 1), frames)
+
+class DataSourceTest(unittest.TestCase):
+
+  def test_time_major_matches_batch_major(self):
+    kwargs = dict(replays=toy_replays(), batch_size=3, unroll_length=8)
+    bm_source = data.DataSource(**kwargs)
+    tm_source = data.DataSource(time_major=True, **kwargs)
+
+    for _ in range(3):
+      expected, _ = next(bm_source)
+      actual, _ = next(tm_source)
+      self.assertEqual(actual.frames.reward.shape, (8, 3))
+      utils.map_nt(
+          np.testing.assert_array_equal,
+          expected.frames, swap_frames(actual.frames))
+      utils.map_nt(np.testing.assert_array_equal, expected.meta, actual.meta)
+
+  def test_frames_match_per_chunk_processing(self):
+    source = data.DataSource(
+        replays=toy_replays(), batch_size=2, unroll_length=8, damage_ratio=0.1)
+    reader = data.GameReader()
+
+    for _ in range(3):
+      batch, _ = next(source)
+      for i in range(2):
+        meta: data.ChunkMeta = utils.map_nt(lambda x: x[i], batch.meta)
+        game = reader.read(meta.info.path)
+        if meta.info.swap:
+          game = data.swap_players(game)
+        chunk = utils.map_nt(lambda x: x[meta.start:meta.end], game)
+        expected = data.make_frames(
+            chunk, source.encode_name(meta.info.main_player.name),
+            needs_reset=meta.start == 0, damage_ratio=0.1)
+        actual = utils.map_nt(lambda x: x[i], batch.frames)
+        utils.map_nt(np.testing.assert_array_equal, expected, actual)
+
+  def test_random_sampler(self):
+    source = data.DataSource(
+        replays=toy_replays(), batch_size=4, unroll_length=8,
+        sampler='random')
+    reader = data.GameReader()
+    num_frames = toy_replays()[0].meta.num_frames
+
+    for _ in range(3):
+      batch, epoch = next(source)
+      self.assertTrue(np.all(batch.frames.is_resetting[:, 0]))
+      for i in range(4):
+        meta: data.ChunkMeta = utils.map_nt(lambda x: x[i], batch.meta)
+        self.assertLessEqual(meta.end, num_frames)
+        game = reader.read(meta.info.path)
+        if meta.info.swap:
+          game = data.swap_players(game)
+        chunk = utils.map_nt(lambda x: x[meta.start:meta.end], game)
+        expected = data.make_frames(
+            chunk, source.encode_name(meta.info.main_player.name),
+            needs_reset=True, damage_ratio=source.damage_ratio)
+        actual = utils.map_nt(lambda x: x[i], batch.frames)
+        utils.map_nt(np.testing.assert_array_equal, expected, actual)
+    self.assertGreater(epoch, 0)
+
+  def test_random_sampler_skips_short_games(self):
+    replays = data.ReplayTable.from_replays(toy_replays())
+    with self.assertRaises(ValueError):
+      data.DataSource(
+          replays, unroll_length=replays[0].meta.num_frames, sampler='random')
+
+  def test_buffers_are_reused(self):
+    source = data.DataSource(
+        replays=toy_replays(), batch_size=2, unroll_length=8, num_buffers=2)
+    batches = [next(source)[0] for _ in range(3)]
+    self.assertIs(batches[0].frames.reward, batches[2].frames.reward)
+    self.assertIsNot(batches[0].frames.reward, batches[1].frames.reward)
+
+  def test_batches_not_overwritten_by_default(self):
+    source = data.DataSource(
+        replays=toy_replays(), batch_size=2, unroll_length=8)
+    batch, _ = next(source)
+    expected = utils.map_nt(np.copy, batch)
+    next(source)
+    next(source)
+    utils.map_nt(np.testing.assert_array_equal, expected, batch)
+
+  def test_read_ahead_matches_on_demand(self):
+    for cache_size_gb in [0, 1]:
+      kwargs = dict(
+          replays=toy_replays(), batch_size=3, unroll_length=8, num_buffers=0,
+          cache_size_gb=cache_size_gb)
+      source = data.DataSource(**kwargs)
+      read_ahead_source = data.DataSource(read_ahead=4, **kwargs)
+
+      for _ in range(3):
+        expected, _ = next(source)
+        actual, _ = next(read_ahead_source)
+        utils.map_nt(np.testing.assert_array_equal, expected, actual)
+
+  def test_preprocess(self):
+    def preprocess(state_action: data.StateAction) -> data.StateAction:
+      return state_action._replace(
+          name=state_action.name.astype(np.uint8),
+          state=state_action.state._replace(
+              stage=state_action.state.stage.astype(np.int32)))
+
+    kwargs = dict(replays=toy_replays(), batch_size=2, unroll_length=8)
+    source = data.DataSource(**kwargs)
+    preprocessed_source = data.DataSource(preprocess=preprocess, **kwargs)
+
+    for _ in range(2):
+      expected, _ = next(source)
+      actual, _ = next(preprocessed_source)
+      self.assertEqual(actual.frames.state_action.name.dtype, np.uint8)
+      expected = expected.frames._replace(
+          state_action=preprocess(expected.frames.state_action))
+      utils.map_nt(np.testing.assert_array_equal, expected, actual.frames)
+      utils.map_nt(
+          lambda x, y: self.assertEqual(x.dtype, y.dtype),
+          expected, actual.frames)
+
+  def test_preload_matches_on_demand(self):
+    kwargs = dict(
+        replays=toy_replays(), batch_size=3, unroll_length=8, num_buffers=0)
+    source = data.DataSource(**kwargs)
+    preloaded_source = data.DataSource(preload=True, **kwargs)
+
+    for _ in range(3):
+      expected, _ = next(source)
+      actual, _ = next(preloaded_source)
+      utils.map_nt(np.testing.assert_array_equal, expected, actual)
+
+  def test_pack_games(self):
+    replays = toy_replays()
+    unroll_length = 1000
+    source = data.DataSource(
+        replays=replays, batch_size=1, unroll_length=unroll_length,
+        pack_games=True)
+
+    # The source cycles through the replays, which pack into one stream.
+    games = []
+    for info in replays * 3:
+      game = data.read_table(info.path, compressed=True)
+      if info.swap:
+        game = data.swap_players(game)
+      games.append(data.make_frames(
+          game, source.encode_name(info.main_player.name),
+          needs_reset=True, damage_ratio=source.damage_ratio))
+    stream = data.pack_frames(games)
+    boundaries = np.cumsum([len(g.is_resetting) for g in games])[:-1]
+    np.testing.assert_array_equal(
+        np.flatnonzero(stream.is_resetting), np.concatenate([[0], boundaries]))
+    self.assertTrue(np.all(stream.reward[boundaries - 1] == 0))
+
+    num_chunks = 12
+    self.assertLess(num_chunks * unroll_length, boundaries[-1])
+    for i in range(num_chunks):
+      batch, _ = next(source)
+      start = i * unroll_length
+      expected = data.slice_frames(stream, start, start + unroll_length + 1)
+      actual = utils.map_nt(lambda x: x[0], batch.frames)
+      utils.map_nt(np.testing.assert_array_equal, expected, actual)
+
+  def test_pack_games_requires_sequential(self):
+    with self.assertRaises(ValueError):
+      data.DataSource(
+          replays=toy_replays(), sampler='random', pack_games=True)
+
+  def test_resume_from_cursor(self):
+    configs = [
+        dict(),
+        dict(read_ahead=2),
+        dict(pack_games=True),
+        dict(sampler='random'),
+    ]
+    for config in configs:
+      kwargs = dict(
+          replays=toy_replays(), batch_size=2, unroll_length=1000,
+          num_buffers=0, **config)
+      source = data.DataSource(**kwargs)
+      for _ in range(4):
+        next(source)
+      cursor = pickle.loads(pickle.dumps(source.get_cursor()))
+      resumed = data.DataSource(cursor=cursor, **kwargs)
+
+      for _ in range(3):
+        expected, expected_epoch = next(source)
+        actual, actual_epoch = next(resumed)
+        utils.map_nt(np.testing.assert_array_equal, expected, actual)
+        self.assertEqual(expected_epoch, actual_epoch)
+
+  def test_cursor_must_match(self):
+    source = data.DataSource(replays=toy_replays(), batch_size=2)
+    with self.assertRaises(ValueError):
+      data.DataSource(
+          replays=toy_replays(), batch_size=3, cursor=source.get_cursor())
+
+class ReadAheadTest(unittest.TestCase):
+
+  def test_order_and_errors(self):
+    def load(x: int) -> int:
+      if x == 5:
+        raise ValueError(x)
+      return x * x
+
+    read_ahead = data.ReadAhead(iter(range(10)), load, size=3, num_threads=2)
+    for x in range(5):
+      self.assertEqual(next(read_ahead), (x, x * x))
+    with self.assertRaises(ValueError):
+      next(read_ahead)
+    self.assertEqual([x for x, _ in read_ahead], [6, 7, 8, 9])
+    read_ahead.close()
+
+def pack_action_buttons(state_action: data.StateAction) -> data.StateAction:
+  action = state_action.action
+  return state_action._replace(action=action._replace(
+      buttons=types.pack_buttons(action.buttons)))
+
+class MultiDataSourceMPTest(unittest.TestCase):
+
+  def test_shared_memory_matches_queue(self, time_major: bool = False):
+    kwargs = dict(
+        replays=toy_replays(), num_workers=2, batch_size=4, unroll_length=8,
+        time_major=time_major)
+    queue_source = data.MultiDataSourceMP(shared_memory=False, **kwargs)
+    ring_source = data.MultiDataSourceMP(shared_memory=True, **kwargs)
+
+    for _ in range(6):  # more than the number of slots
+      expected, _ = next(queue_source)
+      actual, _ = next(ring_source)
+      utils.map_nt(np.testing.assert_array_equal, expected, actual)
+
+  def test_time_major(self):
+    self.test_shared_memory_matches_queue(time_major=True)
+
+  def test_preload(self):
+    kwargs = dict(
+        replays=toy_replays(), num_workers=2, batch_size=4, unroll_length=8,
+        shared_memory=True)
+    source = data.MultiDataSourceMP(**kwargs)
+    preloaded_source = data.MultiDataSourceMP(preload=True, **kwargs)
+
+    for _ in range(3):
+      expected, _ = next(source)
+      actual, _ = next(preloaded_source)
+      utils.map_nt(np.testing.assert_array_equal, expected, actual)
+
+  def test_packed_buttons(self):
+    kwargs = dict(
+        replays=toy_replays(), num_workers=2, batch_size=4, unroll_length=8,
+        shared_memory=True)
+    source = data.MultiDataSourceMP(**kwargs)
+    packed_source = data.MultiDataSourceMP(
+        preprocess=pack_action_buttons, **kwargs)
+
+    for _ in range(3):
+      expected, _ = next(source)
+      actual, _ = next(packed_source)
+      buttons = actual.frames.state_action.action.buttons
+      self.assertEqual(buttons.dtype, np.uint8)
+      utils.map_nt(
+          np.testing.assert_array_equal,
+          expected.frames.state_action.action.buttons,
+          types.unpack_buttons(buttons))
+
+  def test_resume_from_cursor(self):
+    kwargs = dict(
+        replays=toy_replays(), num_workers=2, batch_size=4, unroll_length=8,
+        shared_memory=True)
+    source = data.MultiDataSourceMP(**kwargs)
+    for _ in range(3):
+      next(source)
+    resumed = data.MultiDataSourceMP(cursor=source.get_cursor(), **kwargs)
+
+    for _ in range(3):
+      expected, _ = next(source)
+      actual, _ = next(resumed)
+      utils.map_nt(np.testing.assert_array_equal, expected, actual)
+
+  def test_shared_pool_matches_separate_sources(self):
+    for shared_memory in [False, True]:
+      kwargs = dict(
+          num_workers=2, batch_size=4, unroll_length=8,
+          shared_memory=shared_memory)
+      pool = worker_pool.SharedWorkerPool(
+          dict(train=toy_replays(), test=toy_replays()),
+          prefetch=dict(test=0), weights=dict(train=3), **kwargs)
+      train_source = data.MultiDataSourceMP(replays=toy_replays(), **kwargs)
+      test_source = data.MultiDataSourceMP(replays=toy_replays(), **kwargs)
+
+      for i in range(4):
+        expected, _ = next(train_source)
+        actual, _ = next(pool['train'])
+        utils.map_nt(np.testing.assert_array_equal, expected, actual)
+        if i % 2:
+          expected, _ = next(test_source)
+          actual, _ = next(pool['test'])
+          utils.map_nt(np.testing.assert_array_equal, expected, actual)
+
+      resumed = worker_pool.SharedWorkerPool(
+          dict(train=toy_replays()),
+          cursors=dict(train=pool['train'].get_cursor()), **kwargs)
+      expected, _ = next(pool['train'])
+      actual, _ = next(resumed['train'])
+      utils.map_nt(np.testing.assert_array_equal, expected, actual)
+
+  def test_shared_pool_worker_failure(self):
+    replays = toy_replays()
+    # Each worker gets one perspective; only the first one's fails.
+    failing = replays[0].meta.p0.character
+    self.assertNotEqual(failing, replays[1].meta.p1.character)
+    pool = worker_pool.SharedWorkerPool(
+        dict(train=replays), num_workers=2, batch_size=2, unroll_length=8,
+        prefetch=dict(train=0), preprocess=FailOnce(failing))
+
+    with self.assertRaisesRegex(ValueError, 'Injected'):
+      next(pool['train'])
+    for i in range(2):
+      next(pool['train'])
+      cursors = pool['train'].get_cursor()['workers']
+      # The failing worker made a batch in every round but the first, the
+      # other one in every round.
+      self.assertEqual([c['batch_counter'] for c in cursors], [i + 1, i + 2])
+
+class FailOnce:
+  """A preprocess that fails on the first game of the given main character."""
+
+  def __init__(self, character: int):
+    self.character = character
+    self.failed = False
+
+  def __call__(self, state_action: data.StateAction) -> data.StateAction:
+    character = state_action.state.p0.character[0]
+    if not self.failed and character == self.character:
+      self.failed = True
+      raise ValueError('Injected failure.')
+    return state_action
+
+class BatchServerPreloadTest(unittest.TestCase):
+
+  def test_preload_without_metadata(self):
+    config = batch_server.ServerConfig(
+        dataset=data.DatasetConfig(data_dir=str(paths.TOY_DATA_DIR)),
+        preload=True)
+    arena = batch_server.reader_kwargs(config)['arena']
+    self.assertEqual(len(arena), len(TOY_GAMES))
+    arena.unlink()
+
+class BatchServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.socket_dir = os.path.join(self.tmpdir, 'server')
+    # A separate program, like in real use, rather than a child process.
+    script = os.path.join(
+        os.path.dirname(__file__), '..', 'scripts', 'batch_server.py')
+    self.server = subprocess.Popen([
+        sys.executable, script,
+        f'--config.socket_dir={self.socket_dir}',
+        '--config.num_workers=2',
+        f'--config.dataset.data_dir={paths.TOY_DATA_DIR}',
+        f'--config.dataset.meta_path={paths.TOY_META_PATH}',
+        f'--config.disk_cache_dir={os.path.join(self.tmpdir, "cache")}',
+    ])
+    socket_path = os.path.join(self.socket_dir, batch_server.SOCKET_NAME)
+    while not os.path.exists(socket_path):
+      self.assertIsNone(self.server.poll())
+      time.sleep(0.1)
+
+  def tearDown(self):
+    self.server.terminate()
+    self.server.wait()
+    shutil.rmtree(self.tmpdir)
+
+  def test_matches_local_source(self):
+    dataset = toy_dataset()
+    train_replays, _ = data.train_test_split(dataset)
+    kwargs = dict(batch_size=4, unroll_length=8, time_major=True)
+    client = batch_server.BatchClient(self.socket_dir)
+    local = worker_pool.SharedWorkerPool(
+        dict(train=train_replays, other=train_replays), num_workers=2,
+        **kwargs)
+    remote = client.open('train', dataset, **kwargs)
+    # Each stream has its own sampler and seed.
+    other = client.open(
+        'other', dataset, sampler='random', seed=0, **kwargs)
+    local_other = worker_pool.SharedWorkerPool(
+        dict(other=train_replays), num_workers=2, sampler='random', seed=0,
+        **kwargs)
+
+    for _ in range(3):
+      expected, _ = next(local['train'])
+      actual, _ = next(remote)
+      utils.map_nt(np.testing.assert_array_equal, expected, actual)
+      expected, _ = next(local_other['other'])
+      actual, _ = next(other)
+      utils.map_nt(np.testing.assert_array_equal, expected, actual)
+
+    resumed = batch_server.BatchClient(self.socket_dir).open(
+        'train', dataset, cursor=remote.get_cursor(), **kwargs)
+    utils.map_nt(
+        np.testing.assert_array_equal,
+        next(local['train'])[0], next(resumed)[0])
+    client.close()
+
+  def test_column_projection(self):
+    dataset = toy_dataset()
+    train_replays, _ = data.train_test_split(dataset)
+    kwargs = dict(
+        batch_size=2, unroll_length=8,
+        columns=data.required_game_paths([('state', 'p0', 'x')]))
+    local = data.MultiDataSourceMP(
+        replays=train_replays, num_workers=2, **kwargs)
+    remote = batch_server.BatchClient(self.socket_dir).open(
+        'train', dataset, **kwargs)
+
+    expected, _ = next(local)
+    actual, _ = next(remote)
+    utils.map_nt(np.testing.assert_array_equal, expected, actual)
+    state = actual.frames.state_action.state
+    self.assertTrue(np.any(state.p0.x))
+    self.assertFalse(np.any(state.p0.shield_strength))
+
+  def test_errors(self):
+    dataset = toy_dataset()
+    client = batch_server.BatchClient(self.socket_dir)
+    with self.assertRaises(ValueError):
+      client.open('train', dataset, split='validation')
+    # DataSources are made by the workers when first pulled.
+    stream = client.open('test', dataset, split='test', sampler='unknown')
+    with self.assertRaises(ValueError):
+      next(stream)
+
+  def test_authentication(self):
+    address = os.path.join(self.socket_dir, batch_server.SOCKET_NAME)
+    with self.assertRaises(mp.AuthenticationError):
+      mp_connection.Client(address, family='AF_UNIX', authkey=b'wrong')
+    # The server keeps accepting clients with the right key.
+    client = batch_server.BatchClient(self.socket_dir)
+    dataset = toy_dataset()
+    next(client.open('train', dataset, batch_size=2))
+    client.close()
+
+  def test_private_dir(self):
+    self.assertEqual(os.stat(self.socket_dir).st_mode & 0o777, 0o700)
+    os.chmod(self.socket_dir, 0o755)
+    with self.assertRaises(PermissionError):
+      batch_server.BatchClient(self.socket_dir)
+
+if __name__ == '__main__':
+  unittest.main(failfast=True)
@@ -0,0 +1,35 @@
+# train two variants on demo data, then resume each from its own checkpoint
+
+set -eo pipefail
+
+EXPT_DIR=$(mktemp -d)
+trap 'rm -rf $EXPT_DIR' EXIT
+
+cat > $EXPT_DIR/variants.json <<EOF
+[
+  {"name": "narrow"},
+  {"name": "wide", "network": {"gru": {"hidden_size": 2}}}
+]
+EOF
+
+run() {
+  bash tests/training_test.sh \
+    --config.expt_dir=$EXPT_DIR \
+    --config.variants_path=$EXPT_DIR/variants.json \
+    --config.runtime.max_runtime=60 \
+    --config.runtime.eval_every_n=20 \
+    "$@" 2>&1 | tee $EXPT_DIR/log.txt
+}
+
+run "$@"
+test -f $EXPT_DIR/run.pkl
+for name in narrow wide; do
+  test -f $EXPT_DIR/$name/latest.pkl
+done
+
+run "$@"
+grep -q "restoring run state from $EXPT_DIR/run.pkl" $EXPT_DIR/log.txt
+for name in narrow wide; do
+  grep -q "restoring from $EXPT_DIR/$name/latest.pkl" $EXPT_DIR/log.txt
+done
+echo "Resumed both variants."
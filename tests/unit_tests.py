@@ -1,9 +1,14 @@
+import dataclasses
+import json
+import os
+import tempfile
 import unittest
 
 import numpy as np
 import tensorflow as tf
 
-from slippi_ai import embed, utils, tf_utils
+from slippi_ai import data, embed, rl_lib, tf_data, utils, tf_utils
+from slippi_ai import policies, saving, train_lib
 
 def static_rnn(core, inputs, initial_state):
   unroll_length = tf.nest.flatten(inputs)[0].shape[0]
@@ -95,6 +100,44 @@ class UtilsTest(unittest.TestCase):
 
     self.assertTrue(q.empty())
 
+class RLLibTest(unittest.TestCase):
+
+  def test_returns_stop_at_resets(self):
+    # Two episodes packed into one unroll; the second starts at frame 2.
+    is_resetting = tf.constant([[True], [False], [True], [False]])
+    rewards = tf.constant([[1.], [0.], [1.]])
+    discounts = rl_lib.cut_at_resets(tf.fill([3, 1], 0.5), is_resetting)
+    returns = rl_lib.discounted_returns(
+        rewards, discounts, bootstrap=tf.constant([2.]))
+    np.testing.assert_allclose(returns.numpy(), [[1.], [0.], [2.]])
+
+class PolicyTest(unittest.TestCase):
+
+  def test_delayed_returns_stop_at_resets(self):
+    delay, unroll_length = 2, 6
+    config = train_lib.Config(policy=policies.PolicyConfig(delay=delay))
+    policy = saving.policy_from_config(dataclasses.asdict(config))
+
+    # Game B starts at frame 5, and the reward of its first step is 1.
+    num_frames = unroll_length + delay + 1
+    is_resetting = np.zeros([num_frames, 1], bool)
+    is_resetting[5] = True
+    rewards = np.zeros([num_frames - 1, 1], np.float32)
+    rewards[5] = 1
+    frames = data.Frames(
+        state_action=policy.embed_state_action.dummy([num_frames, 1]),
+        is_resetting=tf.constant(is_resetting),
+        reward=tf.constant(rewards),
+    )
+
+    _, _, metrics = policy.imitation_loss(
+        frames, policy.initial_state(1), discount=0.5)
+    returns = metrics['value']['return'].numpy()[:, 0]
+    # Delayed rewards [0, 2] are the steps of game A, so game B's reward
+    # mustn't leak into their returns.
+    np.testing.assert_array_equal(returns[:3], 0)
+    self.assertEqual(returns[3] - 0.5 * returns[4], 1)
+
 class EmbedTest(unittest.TestCase):
 
   def test_flatten_and_unflatten(self):
@@ -106,5 +149,107 @@ class EmbedTest(unittest.TestCase):
 
     self.assertEqual(embed_game_unflat, embed_game_struct)
 
+  def test_narrow_and_widen(self):
+    embed_game = embed.make_game_embedding()
+    game = data.read_table(
+        data.toy_data_source().replays[0].path, compressed=True)
+
+    expected = embed_game.from_state(game)
+    narrow = embed_game.from_state_narrow(game)
+    self.assertEqual(narrow.p0.action.dtype, np.uint16)
+    self.assertEqual(narrow.stage.dtype, np.uint8)
+    # Buttons are packed into one mask.
+    buttons = narrow.p0.controller.buttons
+    self.assertEqual(buttons.dtype, np.uint8)
+    self.assertEqual(buttons.shape, game.p0.controller.buttons.A.shape)
+
+    widened = embed_game.widen(tf.nest.map_structure(tf.constant, narrow))
+    tf.nest.map_structure(
+        lambda x, t: np.testing.assert_array_equal(x, t.numpy()),
+        expected, widened)
+    tf.nest.map_structure(
+        lambda x, t: self.assertEqual(tf.as_dtype(x.dtype), t.dtype),
+        expected, widened)
+
+class TFDataTest(unittest.TestCase):
+
+  def test_matches_data_source(self):
+    embed_game = embed.make_game_embedding()
+
+    def preprocess(frames: data.Frames) -> data.Frames:
+      state_action = frames.state_action
+      return frames._replace(state_action=state_action._replace(
+          state=embed_game.from_state(state_action.state)))
+
+    kwargs = dict(batch_size=2, unroll_length=8)
+    source = data.toy_data_source(**kwargs)
+    tf_source = tf_data.TFDataSource(
+        data.toy_data_source(**kwargs),
+        spec=source.spec, preprocess=preprocess, prefetch=2)
+
+    for _ in range(3):
+      expected, expected_epoch = next(source)
+      actual, epoch = next(tf_source)
+      self.assertEqual(epoch, expected_epoch)
+      utils.map_nt(
+          np.testing.assert_array_equal,
+          preprocess(expected.frames),
+          tf.nest.map_structure(lambda t: t.numpy(), actual.frames))
+      utils.map_nt(np.testing.assert_array_equal, expected.meta, actual.meta)
+
+class LoadVariantsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+
+  def load(self, variants: list[dict], **kwargs):
+    path = os.path.join(self.tmpdir.name, 'variants.json')
+    with open(path, 'w') as f:
+      json.dump(variants, f)
+    config = train_lib.Config(variants_path=path, **kwargs)
+    return train_lib.load_variants(config)
+
+  def test_no_variants(self):
+    config = train_lib.Config()
+    self.assertEqual(train_lib.load_variants(config), [(None, config)])
+
+  def test_overrides(self):
+    variants = self.load([
+        dict(name='fast', learner=dict(learning_rate=1e-3)),
+        dict(network=dict(name='gru')),
+    ])
+    self.assertEqual([name for name, _ in variants], ['fast', 'variant_1'])
+    fast, gru = [config for _, config in variants]
+    base = train_lib.Config()
+    self.assertEqual(fast.learner.learning_rate, 1e-3)
+    # Only the given keys are overridden.
+    self.assertEqual(fast.learner.value_cost, base.learner.value_cost)
+    self.assertEqual(gru.network['name'], 'gru')
+    self.assertEqual(gru.learner.learning_rate, base.learner.learning_rate)
+
+  def test_rejects_shared_keys(self):
+    # These determine the batches, which all variants share.
+    for key in ['data', 'dataset', 'embed']:
+      with self.assertRaisesRegex(ValueError, key):
+        self.load([{key: {}}])
+
+  def test_rejects_delay_change(self):
+    with self.assertRaisesRegex(ValueError, 'delay'):
+      self.load([dict(policy=dict(delay=3))])
+    # Keeping the base delay is fine.
+    self.load(
+        [dict(policy=dict(delay=3))], policy=policies.PolicyConfig(delay=3))
+
+  def test_rejects_duplicate_names(self):
+    with self.assertRaisesRegex(ValueError, 'unique'):
+      self.load([dict(name='a'), dict(name='a')])
+
+  def test_rejects_restore_pickle(self):
+    with self.assertRaisesRegex(ValueError, 'restore_pickle'):
+      self.load([{}], restore_pickle='model.pkl')
+
 if __name__ == '__main__':
   unittest.main(failfast=True)